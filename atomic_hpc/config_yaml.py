@@ -1,7 +1,16 @@
+import hashlib
+import itertools
 import logging
+import os
+import pickle
+import time
+import uuid
 from ruamel.yaml import YAML
-from jsonschema import validate, ValidationError
+from jsonschema import Draft4Validator, ValidationError
+from jsonschema.exceptions import best_match
 from jsonextended import edict
+import atomic_hpc
+from atomic_hpc.template import compile_template
 
 # python 2/3 compatibility
 try:
@@ -12,24 +21,66 @@ try:
     import pathlib
 except ImportError:
     import pathlib2 as pathlib
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
 
 logger = logging.getLogger(__name__)
 
+# a block of runs, expanded from the product (or zip) of lists of variable values
+_sweep_schema = {
+    "type": "object",
+    "required": ["variables"],
+    "additionalProperties": False,
+    "properties": {
+        "mode": {"type": "string", "enum": ["product", "zip"]},
+        "name": {"type": "string"},
+        # the id of the first run (by default, following on from the previous sweep, or the largest run id)
+        "start_id": {"type": "integer"},
+        "variables": {"type": "object", "minProperties": 1,
+                      "additionalProperties": {"type": "array", "minItems": 1}},
+        # run attributes shared by all runs of the sweep (overriding the defaults)
+        "run": {"type": "object"},
+    }
+}
+
 _config_schema = {
     "description": "config schema",
     "type": "object",
-    "required": ['runs'],
+    "anyOf": [{"required": ['runs']}, {"required": ['sweep']}],
     "properties": {
         "defaults": {"type": "object"},
         "runs": {"type": "array", "uniqueItems": True, "minItems": 1,
                  "items": {"type": "object"}},
+        "sweep": {"type": "array", "minItems": 1,
+                  "items": _sweep_schema},
     }
 }
 
+_SWEEP_NAME = "sweep_@v{index}"
+
+# glob patterns for the top-level paths to copy to/from $TMPDIR
+_stage_schema = {
+    "type": "object",
+    "required": ["include", "exclude"],
+    "properties": {
+        "include": {"type": ["array", "null"], "items": {"type": "string"}},
+        "exclude": {"type": ["array", "null"], "items": {"type": "string"}},
+    },
+    "additionalProperties": False,
+
+}
+
 _process_qsub_schema = {
     "type": "object",
     "required": ["nnodes", "cores_per_node", "walltime", "queue", "modules",
-                 "run", "jobname", "start_in_temp", "tmpspace", "memory_per_node"],
+                 "run", "jobname", "start_in_temp", "stage_parallel", "stage_in", "stage_out",
+                 "tmpspace", "memory_per_node"],
     "properties": {
 
         "cores_per_node": {"type": "integer"},
@@ -42,6 +93,9 @@ _process_qsub_schema = {
         "email": {"type": ["string", "null"]},
         "modules": {"type": ["array", "null"], "items": {"type": "string"}},
         "start_in_temp": {"type": "boolean"},
+        "stage_parallel": {"type": "integer", "minimum": 1},
+        "stage_in": _stage_schema,
+        "stage_out": _stage_schema,
         "run": {"type": ["array", "null"], "items": {"type": "string"}},
     },
     "additionalProperties": False,
@@ -60,7 +114,8 @@ _process_local_schema = {
 
 _remote_schema = {
     "type": ["object", "null"],
-    "required": ["hostname", "port", "username", "password", "pkey", "key_filename", "timeout"],
+    "required": ["hostname", "port", "username", "password", "pkey", "key_filename", "timeout",
+                 "transfer_streams"],
     "additionalProperties": False,
     "properties": {
         "hostname": {"type": ["string", "null"]},
@@ -70,6 +125,7 @@ _remote_schema = {
         "pkey": {"type": ["string", "null"]},
         "key_filename": {"type": ["string", "null"]},
         "timeout": {"type": ["integer", "null"]},
+        "transfer_streams": {"type": "integer", "minimum": 1},
     }
 }
 
@@ -137,6 +193,7 @@ _global_defaults = {
             "pkey": None,
             "key_filename": None,
             "timeout": None,
+            "transfer_streams": 1,
         },
     },
 
@@ -152,6 +209,7 @@ _global_defaults = {
             "pkey": None,
             "key_filename": None,
             "timeout": None,
+            "transfer_streams": 1,
         },
     },
 
@@ -168,6 +226,9 @@ _global_defaults = {
             "modules": None,
             "run": None,
             "start_in_temp": True,
+            "stage_parallel": 8,
+            "stage_in": {"include": None, "exclude": None},
+            "stage_out": {"include": None, "exclude": None},
             "memory_per_node": None,
             "tmpspace": None,
         },
@@ -175,20 +236,405 @@ _global_defaults = {
 }
 
 
-def format_config_yaml(file_obj, errormsg_only=False):
-    """read config, merge defaults into runs, for each run: drop local or qsub and check against schema
+class _Deleted(object):
+    """ marks a key of the defaults as deleted from a RunMapping """
+    __slots__ = ()
+
+    def __reduce__(self):
+        # pickle (and copy) by reference, so that the sentinel identity is preserved
+        return "_DELETED"
+
+    def __repr__(self):
+        return "_DELETED"
+
+
+_DELETED = _Deleted()
+_MISSING = object()
+
+
+class RunMapping(MutableMapping):
+    """ a run configuration, as its own (overriding) values overlaid on a shared, read-only, defaults mapping
+
+    nested mappings are overlaid recursively (as for ``edict.merge([defaults, run], overwrite=True)``),
+    but without copying the defaults; assignments are stored in the overlay,
+    and lists from the defaults are copied when first accessed, so the defaults are never mutated
+
+    Parameters
+    ----------
+    overrides: dict
+    defaults: dict
+
+    Examples
+    --------
+    >>> defaults = {"a": 1, "b": {"c": 2, "d": 3}, "e": [1]}
+    >>> run = RunMapping({"b": {"c": 4}}, defaults)
+    >>> run["b"]["c"], run["b"]["d"]
+    (4, 3)
+    >>> run["b"]["d"] = 5
+    >>> run["e"].append(2)
+    >>> del run["a"]
+    >>> run.to_dict() == {"b": {"c": 4, "d": 5}, "e": [1, 2]}
+    True
+    >>> defaults == {"a": 1, "b": {"c": 2, "d": 3}, "e": [1]}
+    True
+
+    """
+    __slots__ = ("_overrides", "_defaults", "_children")
+
+    def __init__(self, overrides, defaults):
+        self._overrides = dict(overrides)
+        self._defaults = defaults
+        # the overlays of nested mappings, created on first access
+        self._children = {}
+
+    def __getitem__(self, key):
+        child = self._children.get(key)
+        if child is not None:
+            return child
+        value = self._overrides.get(key, _MISSING)
+        if value is _DELETED:
+            raise KeyError(key)
+        if value is _MISSING:
+            value = self._defaults[key]
+            if isinstance(value, list):
+                value = self._overrides[key] = list(value)
+                return value
+            if not isinstance(value, Mapping):
+                return value
+            child = RunMapping({}, value)
+        else:
+            default = self._defaults.get(key, None)
+            if not (isinstance(value, Mapping) and isinstance(default, Mapping)):
+                return value
+            child = RunMapping(value, default)
+        self._children[key] = child
+        return child
+
+    def __setitem__(self, key, value):
+        self._overrides[key] = value
+        self._children.pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._defaults:
+            self._overrides[key] = _DELETED
+        else:
+            del self._overrides[key]
+        self._children.pop(key, None)
+
+    def __contains__(self, key):
+        value = self._overrides.get(key, _MISSING)
+        if value is _MISSING:
+            return key in self._defaults
+        return value is not _DELETED
+
+    def __iter__(self):
+        for key in self._defaults:
+            if self._overrides.get(key, _MISSING) is not _DELETED:
+                yield key
+        for key in self._overrides:
+            if key not in self._defaults:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.to_dict())
+
+    def copy(self):
+        """ a shallow copy, sharing the same defaults """
+        new = RunMapping.__new__(RunMapping)
+        new._overrides = self._overrides.copy()
+        new._defaults = self._defaults
+        new._children = self._children.copy()
+        return new
+
+    __copy__ = copy
+
+    def to_dict(self):
+        """ the run as (nested) plain dicts
+
+        Returns
+        -------
+        dct: dict
+
+        """
+        return dict([(key, value.to_dict() if isinstance(value, RunMapping) else value)
+                     for key, value in self.items()])
+
+
+def _to_dict(value):
+    """ convert a RunMapping to a (nested) dict, leaving other values unchanged """
+    return value.to_dict() if isinstance(value, RunMapping) else value
+
+
+# the schemas are checked and compiled once; the run schema both as a whole and for each top-level property
+Draft4Validator.check_schema(_config_schema)
+Draft4Validator.check_schema(_run_schema)
+_config_validator = Draft4Validator(_config_schema)
+_run_validator = Draft4Validator(_run_schema)
+_run_property_validators = dict([(key, Draft4Validator(schema)) for key, schema in _run_schema["properties"].items()])
+
+
+def _validate(validator, instance):
+    """ raise the most relevant ValidationError (if any) for an instance """
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+
+def _valid_defaults(defaults):
+    """ the top-level keys of the defaults, which are valid against the run schema
+
+    Parameters
+    ----------
+    defaults: dict
+
+    Returns
+    -------
+    keys: set
+
+    """
+    return set([key for key, value in defaults.items()
+                if key in _run_property_validators
+                and best_match(_run_property_validators[key].iter_errors(value)) is None])
+
+
+def _validate_run(new_run, run, valid_defaults):
+    """ validate a run (merged with the defaults) against the run schema
+
+    if all the top-level properties the run does not override are from the (shared) defaults,
+    and were already found to be valid, then only the overridden properties are validated
+
+    Parameters
+    ----------
+    new_run: RunMapping
+        the run overlaid on the defaults
+    run: dict
+        the run, as given in the config
+    valid_defaults: set
+        the top-level keys of the defaults known to be valid (see _valid_defaults)
+
+    """
+    if (all([key in _run_property_validators for key in run])
+            and all([key in new_run for key in _run_schema["required"]])
+            and all([key in valid_defaults for key in new_run if key not in run])):
+        for key in run:
+            _validate(_run_property_validators[key], _to_dict(new_run[key]))
+    else:
+        _validate(_run_validator, new_run.to_dict())
+
+
+def _sweep_size(sweep):
+    """ the number of runs a sweep expands to
+
+    Parameters
+    ----------
+    sweep: dict
+
+    Returns
+    -------
+    size: int
+
+    Examples
+    --------
+    >>> _sweep_size({"variables": {"a": [1, 2, 3], "b": [1, 2]}})
+    6
+    >>> _sweep_size({"mode": "zip", "variables": {"a": [1, 2], "b": [3, 4]}})
+    2
+
+    """
+    lengths = [len(values) for values in sweep["variables"].values()]
+    if sweep.get("mode", "product") == "zip":
+        if len(set(lengths)) != 1:
+            raise ValidationError("the variable lists of a zip sweep have different lengths: {}".format(lengths))
+        return lengths[0]
+    size = 1
+    for length in lengths:
+        size *= length
+    return size
+
+
+def _iter_sweep(sweep, start_id, run_ids=None):
+    """ lazily expand a sweep into runs (of its variable values), with consecutive ids and names rendered from
+    the sweep name (with the variable values and the 1-based index in the sweep)
+
+    Parameters
+    ----------
+    sweep: dict
+    start_id: int
+        the id of the first run
+    run_ids: None or set of int
+        if not None, only yield the runs with these ids
+
+    Yields
+    -------
+    run: dict
+
+    Examples
+    --------
+    >>> sweep = {"name": "run_@v{a}_@v{b}", "variables": {"a": [1, 2], "b": ["x", "y"]}}
+    >>> [(run["id"], run["name"]) for run in _iter_sweep(sweep, 3)]
+    [(3, 'run_1_x'), (4, 'run_1_y'), (5, 'run_2_x'), (6, 'run_2_y')]
+    >>> sweep = {"mode": "zip", "variables": {"a": [1, 2], "b": ["x", "y"]}}
+    >>> [(run["id"], run["name"], run["input"]) for run in _iter_sweep(sweep, 1, run_ids={2})]
+    [(2, 'sweep_2', {'variables': {'a': 2, 'b': 'y'}})]
+
+    """
+    names = list(sweep["variables"].keys())
+    values = [sweep["variables"][name] for name in names]
+    if sweep.get("mode", "product") == "zip":
+        combinations = izip(*values)
+    else:
+        combinations = itertools.product(*values)
+    name_template = compile_template(sweep.get("name", _SWEEP_NAME))
+
+    for index, combination in enumerate(combinations):
+        run_id = start_id + index
+        if run_ids is not None and run_id not in run_ids:
+            continue
+        variables = dict(zip(names, combination))
+        inserts = dict(variables)
+        inserts["index"] = index + 1
+        yield {"id": run_id, "name": name_template.render(inserts), "input": {"variables": variables}}
+
+
+def _cache_dir():
+    """ the directory to cache formatted configs in (following the XDG base directory specification) """
+    cache_home = os.environ.get("XDG_CACHE_HOME", "") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "atomic_hpc")
+
+
+# cache entries not used for this long (in seconds) are removed
+_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def _cache_path(file_path):
+    """ the cache file path for a config file, keyed by a hash of its (absolute) path,
+    then a hash of its content and the package version """
+    path_sha = hashlib.sha256(os.path.abspath(str(file_path)).encode("utf8"))
+    sha = hashlib.sha256(atomic_hpc.__version__.encode("utf8"))
+    with file_path.open("rb") as file_obj:
+        for block in iter(lambda: file_obj.read(2 ** 20), b""):
+            sha.update(block)
+    return os.path.join(_cache_dir(), "{0}-{1}.pickle".format(path_sha.hexdigest()[:16], sha.hexdigest()))
+
+
+def _prune_cache(cache_path, max_age=_CACHE_MAX_AGE):
+    """ remove the other entries for the same config file, and any entries not used within max_age seconds """
+    cache_dir, cache_name = os.path.split(cache_path)
+    path_prefix = cache_name.split("-")[0] + "-"
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name == cache_name or not name.endswith(".pickle"):
+            continue
+        try:
+            if name.startswith(path_prefix) or now - os.path.getmtime(entry) > max_age:
+                logger.debug("removing config cache: {}".format(entry))
+                os.remove(entry)
+        except (IOError, OSError) as err:
+            # e.g. removed concurrently
+            logger.debug("could not remove config cache: {0}: {1}".format(entry, err))
+
+
+def _read_cache(cache_path):
+    """ read formatted runs from the cache, returning None if not cached (or the cache is unreadable) """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "rb") as file_obj:
+            runs = pickle.load(file_obj)
+        # mark the entry as used, so that it is not pruned
+        os.utime(cache_path, None)
+        return runs
+    except Exception as err:
+        logger.warning("ignoring unreadable config cache: {0}: {1}".format(cache_path, err))
+        return None
+
+
+def _write_cache(cache_path, runs):
+    """ write formatted runs to the cache (atomically, via a temporary file), then prune the cache """
+    tmp_path = "{0}.{1}.tmp".format(cache_path, uuid.uuid4().hex)
+    try:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(tmp_path, "wb") as file_obj:
+            pickle.dump(runs, file_obj, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+        _prune_cache(cache_path)
+    except (IOError, OSError) as err:
+        logger.warning("could not write config cache: {0}: {1}".format(cache_path, err))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def iter_config_yaml(file_obj, errormsg_only=False, run_ids=None, cache=False):
+    """read config, then lazily yield each run; overlaid on the defaults, with local or qsub dropped,
+    and checked against schema
 
     Parameters
     ----------
     file_obj : str or file_like
     errormsg_only: bool
         only return the human readable message part of the jsonschema.ValidationError
+    run_ids: None or list of int
+        if not None, only yield the runs with these ids
+    cache: bool
+        if True (and file_obj is a path), the formatted runs are cached on disk (in $XDG_CACHE_HOME/atomic_hpc),
+        keyed by a hash of the file content and the package version, and read from there if the file is unchanged.
+        The cache is only written once all the runs have been yielded (and so not if run_ids is given).
+        Only the latest entry for each file is kept, and entries unused for 30 days are removed
+
+    Yields
+    -------
+    run: RunMapping
+        the run's values overlaid on the defaults, which are shared by all runs (and never mutated)
 
-    """
-    logger.info("reading config: {}".format(file_obj))
+    Notes
+    -----
+    the top-level config, and uniqueness of run ids, are checked before the first run is yielded,
+    but each run is only validated when it is reached.
+    The runs of each sweep block are expanded (after the runs list) only as they are reached,
+    with consecutive ids from its start_id (by default, continuing from the previous sweep, or the largest run id).
+    Sweep ids which clash with other runs raise a ValidationError (rather than being renumbered)
 
+    """
     if isinstance(file_obj, basestring):
         file_obj = pathlib.Path(file_obj)
+    if run_ids is not None:
+        run_ids = set(run_ids)
+
+    if not (cache and isinstance(file_obj, pathlib.Path)):
+        for run in _iter_config_yaml(file_obj, errormsg_only, run_ids):
+            yield run
+        return
+
+    cache_path = _cache_path(file_obj)
+    cached_runs = _read_cache(cache_path)
+    if cached_runs is not None:
+        logger.info("using cached config: {}".format(cache_path))
+        for run in cached_runs:
+            if run_ids is None or run["id"] in run_ids:
+                yield run
+        return
+
+    # the runs are still formatted lazily, and cached once they have all been formatted
+    runs = []
+    for run in _iter_config_yaml(file_obj, errormsg_only, run_ids):
+        if run_ids is None:
+            # copied before it is yielded, since the consumer may add to the run (e.g. deploy_runs)
+            runs.append(run.copy())
+        yield run
+    if run_ids is None:
+        _write_cache(cache_path, runs)
+
+
+def _iter_config_yaml(file_obj, errormsg_only, run_ids):
+    """ see iter_config_yaml (without the cache), run_ids is None or a set """
+    logger.info("reading config: {}".format(file_obj))
 
     ryaml = YAML()
     dct = ryaml.load(file_obj)
@@ -196,20 +642,56 @@ def format_config_yaml(file_obj, errormsg_only=False):
     logger.info("validating & formatting config: {}".format(file_obj))
 
     try:
-        validate(dct, _config_schema)
+        _validate(_config_validator, dct)
     except ValidationError as err:
         if errormsg_only:
             err = err.message
         raise ValidationError("error in top-level config: {0}".format(err))
 
-    runs = []
     defaults = edict.merge([_global_defaults, dct.get('defaults', {})], overwrite=True)
+    valid_defaults = _valid_defaults(defaults)
 
-    for i, run in enumerate(dct['runs']):
+    ids = [run.get("id", defaults.get("id", None)) for run in dct.get('runs', [])]
+    if not len(set(ids)) == len(ids):
+        raise ValidationError("the run ids are not unique: {}".format(ids))
 
-        new_run = edict.merge([defaults, run], overwrite=True)
+    def sweep_runs(sweep, start_id, start_index, sweep_defaults, sweep_valid_defaults):
+        for sweep_run in _iter_sweep(sweep, start_id, run_ids):
+            yield start_index + sweep_run["id"] - start_id, sweep_run, sweep_defaults, sweep_valid_defaults
+
+    runs = [[(i, run, defaults, valid_defaults) for i, run in enumerate(dct.get('runs', []))
+             if run_ids is None or ids[i] is None or ids[i] in run_ids]]
+
+    run_id_set = set([i for i in ids if isinstance(i, int)])
+    sweep_ranges = []
+    start_id = max(list(run_id_set) + [0]) + 1
+    num_runs = len(ids)
+    for s, sweep in enumerate(dct.get('sweep', [])):
+        size = _sweep_size(sweep)
+        start_id = sweep.get("start_id", start_id)
+        end_id = start_id + size
+        clashes = sorted([i for i in run_id_set if start_id <= i < end_id])
+        clashes += ["sweep #{}".format(t + 1) for t, (start, end) in enumerate(sweep_ranges)
+                    if start < end_id and start_id < end]
+        if clashes:
+            raise ValidationError("the ids of sweep #{0} ({1} to {2}) clash with: {3}".format(
+                s + 1, start_id, end_id - 1, clashes))
+        sweep_ranges.append((start_id, end_id))
+        missing = compile_template(sweep.get("name", _SWEEP_NAME)).names("v").difference(
+            list(sweep["variables"].keys()) + ["index"])
+        if missing:
+            raise ValidationError("the name of sweep #{0} has unknown variables: {1}".format(s + 1, sorted(missing)))
+        # the sweep's run config is merged into the defaults once, and shared by all its runs
+        sweep_defaults = edict.merge([defaults, sweep.get("run", {})], overwrite=True)
+        runs.append(sweep_runs(sweep, start_id, num_runs, sweep_defaults, _valid_defaults(sweep_defaults)))
+        start_id = end_id
+        num_runs += size
+
+    for i, run, run_defaults, run_valid_defaults in itertools.chain(*runs):
+
+        new_run = RunMapping(run, run_defaults)
         try:
-            validate(new_run, _run_schema)
+            _validate_run(new_run, run, run_valid_defaults)
         except ValidationError as err:
             if errormsg_only:
                 err = err.message
@@ -228,14 +710,28 @@ def format_config_yaml(file_obj, errormsg_only=False):
         if new_run["output"]["remote"]["hostname"] is None:
             new_run["output"]["remote"] = None
 
-        runs.append(new_run)
+        yield new_run
 
-    ids = edict.filter_keys(runs, ['id'], list_of_dicts=True)
-    ids = edict.combine_lists(ids)['id']
-    if not len(set(ids)) == len(ids):
-        raise ValidationError("the run ids are not unique: {}".format(ids))
 
-    return runs
+def format_config_yaml(file_obj, errormsg_only=False, cache=False):
+    """read config, merge defaults into runs, for each run: drop local or qsub and check against schema
+
+    Parameters
+    ----------
+    file_obj : str or file_like
+    errormsg_only: bool
+        only return the human readable message part of the jsonschema.ValidationError
+    cache: bool
+        if True (and file_obj is a path), the formatted runs are cached on disk (in $XDG_CACHE_HOME/atomic_hpc),
+        keyed by a hash of the file content and the package version, and read from there if the file is unchanged.
+        Only the latest entry for each file is kept, and entries unused for 30 days are removed
+
+    Returns
+    -------
+    runs: list of RunMapping
+
+    """
+    return list(iter_config_yaml(file_obj, errormsg_only=errormsg_only, cache=cache))
 
 
 def renumber_config_yaml(in_file_obj, out_file_obj, start_num=1):
@@ -260,8 +756,8 @@ def renumber_config_yaml(in_file_obj, out_file_obj, start_num=1):
 
     ryaml = YAML()
     config = ryaml.load(in_file_obj)
-    validate(config, _config_schema)
-    for i, _ in enumerate(config["runs"]):
+    _validate(_config_validator, config)
+    for i, _ in enumerate(config.get("runs", [])):
         config["runs"][i]["id"] = i+start_num
 
     logger.info("outputting renumbered config to: {}".format(out_file_obj))
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 from contextlib import contextmanager
@@ -184,6 +185,23 @@ class VirtualDir(object):
         """
         raise NotImplementedError
 
+    def link(self, path, linkpath):
+        """ create a hard link to a file, falling back to a copy where hard links are not supported
+
+        (symbolic links are not used, since they would dangle, or be rejected, once the linked file is
+        retrieved without its target)
+
+        Parameters
+        ----------
+        path: str
+        linkpath: str
+
+        Returns
+        -------
+
+        """
+        raise NotImplementedError
+
     def glob(self, pattern):
         """
 
@@ -255,6 +273,66 @@ class VirtualDir(object):
         """
         raise NotImplementedError
 
+    def copy_many_to(self, paths, target, compress=False):
+        """ copy multiple paths to a local target
+
+        Parameters
+        ----------
+        paths: list of str
+        target: str or path_like
+        compress: bool
+            whether to compress the data in transfer (where supported)
+
+        Returns
+        -------
+
+        """
+        for path in paths:
+            self.copy_to(path, target)
+
+    def walk_files(self, path):
+        """ walk all the files at, or below, a path
+
+        Parameters
+        ----------
+        path: str
+
+        Yields
+        -------
+        filepath: str
+            the path of each file, relative to the root
+        attr: object
+            the attributes of each file (see stat)
+
+        """
+        if self.isfile(path):
+            yield path, self.stat(path)
+            return
+        for subpath in self.glob(os.path.join(path, "**", "*")):
+            if self.isfile(subpath):
+                yield subpath, self.stat(subpath)
+
+    def checksums(self, paths):
+        """ compute the sha256 checksum of files
+
+        Parameters
+        ----------
+        paths: list of str
+
+        Returns
+        -------
+        checksums: dict
+            {path: hexdigest}
+
+        """
+        checksums = {}
+        for path in paths:
+            sha = hashlib.sha256()
+            with self.open(path, "rb") as file_obj:
+                for block in iter(lambda: file_obj.read(2 ** 20), b""):
+                    sha.update(block)
+            checksums[path] = sha.hexdigest()
+        return checksums
 
     # TODO improve command line security: https://security.openstack.org/guidelines/dg_avoid-shell-true.html,
     # https://docs.python.org/3/library/shlex.html#shlex.quote
@@ -301,7 +379,7 @@ class VirtualDir(object):
 
         return None
 
-    def exec_cmnd(self, cmnd, path, raise_error=False, timeout=None):
+    def exec_cmnd(self, cmnd, path, raise_error=False, timeout=None, stdout=None, stderr=None):
         """
 
         Parameters
@@ -312,6 +390,10 @@ class VirtualDir(object):
             raise error if a non zero exit code is received
         timeout: None or float
             seconds to wait for a pending read/write operation before raising an error
+        stdout: None or list
+            if a list, the lines of stdout are appended to it (as well as being logged)
+        stderr: None or list
+            if a list, the lines of stderr are appended to it (as well as being logged)
 
         Returns
         -------
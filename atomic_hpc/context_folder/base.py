@@ -4,9 +4,9 @@ folder, that can be either local, virtual or remote
 """
 import os
 import logging
-import paramiko
 from atomic_hpc.context_folder.local import LocalPath
 from atomic_hpc.context_folder.remote import RemotePath
+from atomic_hpc.context_folder.pool import default_pool
 
 try:
     basestring
@@ -24,7 +24,7 @@ logger = logging.getLogger(__name__)
 class change_dir(object):
     """a context manager for changing the current working directory"""
 
-    def __init__(self, path='.', remote=False, hostname='', **kwargs):
+    def __init__(self, path='.', remote=False, hostname='', pool=None, transfer_streams=1, **kwargs):
         """
 
         Parameters
@@ -34,10 +34,15 @@ class change_dir(object):
             whether connecting to a remote server
         hostname: str
             if remote, the server host to connect to
+        pool: atomic_hpc.context_folder.pool.SSHPool or None
+            if remote, the pool to lease the connection from (defaults to a global pool)
+        transfer_streams: int
+            if remote, the maximum number of sftp channels to concurrently transfer files over
         kwargs:
             additional keyword arguments for paramiko.client.SSHClient.connect
 
         """
+        self._folder = None
         if path == "":
             path = "."
 
@@ -45,7 +50,12 @@ class change_dir(object):
             self._remote = False
             if isinstance(path, basestring):
                 if not os.path.exists(path):
-                    os.makedirs(path)
+                    try:
+                        os.makedirs(path)
+                    except OSError:
+                        # the directory may have been concurrently created
+                        if not os.path.isdir(path):
+                            raise
                     #raise IOError("the path does not exist: {}".format(path))
                 if not os.path.isdir(path):
                     raise IOError(
@@ -56,7 +66,11 @@ class change_dir(object):
                 if not hasattr(path, "is_dir"):
                     raise IOError("path is not path_like: {}".format(path))
                 if not path.exists():
-                    path.mkdir(parents=True)
+                    try:
+                        path.mkdir(parents=True)
+                    except OSError:
+                        if not path.is_dir():
+                            raise
                     #raise IOError("the path does not exist: {}".format(path))
                 if not path.is_dir():
                     raise IOError("path is not a directory: {}".format(path))
@@ -68,32 +82,42 @@ class change_dir(object):
             self._path = path
             self._hostname = hostname
             self._kwargs = kwargs
-            self._ssh = paramiko.SSHClient()
-            self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            # try connecting
-            try:
-                self._ssh.connect(self._hostname, **self._kwargs)
-                _ = self._ssh.open_sftp()
-                # sftp.chdir(self._path)
-                self._ssh.close()
-            except Exception as err:
-                raise RuntimeError(
-                    "failed connecting to {0} with args: {1}\n{2}".format(
-                        self._hostname, self._kwargs, err))
+            self._transfer_streams = transfer_streams
+            self._pool = default_pool if pool is None else pool
 
     def __enter__(self):
 
         if not self._remote:
             logger.debug("entering local path")
-            return LocalPath(self._path)
+            self._folder = LocalPath(self._path)
         else:
             logger.debug("entering remote path")
-            return RemotePath(
-                self._ssh, self._hostname, self._path, **self._kwargs)
+            # the connection is only leased on entry, since __exit__ is the only place it is released
+            try:
+                self._ssh, self._sftp = self._pool.lease(self._hostname, **self._kwargs)
+            except Exception as err:
+                raise RuntimeError(
+                    "failed connecting to {0} with args: {1}\n{2}".format(
+                        self._hostname, self._kwargs, err))
+            entered = False
+            try:
+                self._folder = RemotePath(
+                    self._ssh, self._hostname, self._path, sftp=self._sftp,
+                    transfer_streams=self._transfer_streams, **self._kwargs)
+                entered = True
+            finally:
+                if not entered:
+                    # __exit__ is not called if __enter__ raises
+                    self._pool.discard(self._ssh, self._sftp)
+        return self._folder
 
     def __exit__(self, etype, value, traceback):
         logger.debug("exiting path")
-        try:
-            self._ssh.close()
-        except:
-            pass
+        if not self._remote:
+            return
+        # the folder may have renewed the sftp session
+        sftp = self._folder._sftp if self._folder is not None else self._sftp
+        if etype is None:
+            self._pool.release(self._ssh, sftp)
+        else:
+            self._pool.discard(self._ssh, sftp)
@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 from subprocess import Popen, PIPE  # , STDOUT
 from contextlib import contextmanager
@@ -20,9 +21,53 @@ try:
     from queue import Queue
 except:
     from Queue import Queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+# the linux ioctl request to clone a file (copy-on-write), on filesystems that support it (e.g. btrfs, xfs)
+_FICLONE = 0x40049409
+
+
+def copy_file(source, target):
+    """ copy a file, without reading it into (python) memory
+
+    the file is cloned (reflinked) where the filesystem supports it,
+    otherwise copied in-kernel (with os.copy_file_range or, via shutil, os.sendfile) where available
+
+    Parameters
+    ----------
+    source: str
+    target: str
+
+    """
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            shutil.copymode(source, target)
+            return
+        except (IOError, OSError):
+            pass
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining <= 0:
+                shutil.copymode(source, target)
+                return
+        except OSError:
+            pass
+    shutil.copy(source, target)
+
 
 class LocalPath(VirtualDir):
     def __init__(self, root):
@@ -30,10 +75,12 @@ class LocalPath(VirtualDir):
 
         Parameters
         ----------
-        root: pathlib.Path
+        root: pathlib.Path or path_like
 
         """
         self._root = root
+        # whether the root is virtual (e.g. a jsonextended.utils.MockPath), rather than on the filesystem
+        self._virtual = hasattr(root, "copy_path_obj")
         if not self._root.exists():
             self._root.mkdir(parents=True)
 
@@ -129,12 +176,20 @@ class LocalPath(VirtualDir):
 
         parts = splitall(path)
         newpath = self._root.joinpath(parts[0])
-        if not newpath.exists():
-            newpath.mkdir()
+        self._mkdir(newpath)
         for part in parts[1:]:
             newpath = newpath.joinpath(part)
-            if not newpath.exists():
-                newpath.mkdir()
+            self._mkdir(newpath)
+
+    @staticmethod
+    def _mkdir(path):
+        if not path.exists():
+            try:
+                path.mkdir()
+            except OSError:
+                # the directory may have been concurrently created
+                if not path.is_dir():
+                    raise
 
     def rmtree(self, path):
         """
@@ -196,6 +251,31 @@ class LocalPath(VirtualDir):
         newname = path.parent.joinpath(newname)
         path.rename(newname)
 
+    def link(self, path, linkpath):
+        """ create a hard link to a file, falling back to a copy where hard links are not supported
+
+        (symbolic links are not used, since they would dangle, or be rejected, once the linked file is
+        retrieved without its target)
+
+        Parameters
+        ----------
+        path: str
+        linkpath: str
+
+        Returns
+        -------
+
+        """
+        logger.debug("linking path: {0} to {1}".format(path, linkpath))
+        source = self._root.joinpath(path)
+        target = self._root.joinpath(linkpath)
+        try:
+            os.link(str(source), str(target))
+            return
+        except (OSError, AttributeError) as err:
+            logger.debug("hard link failed: {}".format(err))
+        copy_file(str(source), str(target))
+
     def getabs(self, path):
         """
 
@@ -302,7 +382,7 @@ class LocalPath(VirtualDir):
 
         source = pathlib.Path(source)
         if source.is_file() and source.exists():
-            shutil.copy(str(source), str(subpath.joinpath(source.name)))
+            copy_file(str(source), str(subpath.joinpath(source.name)))
         elif source.is_dir() and source.exists():
             shutil.copytree(str(source), str(subpath.joinpath(source.name)))
         else:
@@ -329,29 +409,26 @@ class LocalPath(VirtualDir):
             return
 
         target = pathlib.Path(target)
-        if target.is_file() and target.exists():
+        if not (target.exists() and target.is_dir()):
+            raise IOError("the target is not an existing directory: {}".format(target))
+        if subpath.is_file():
             shutil.copy(str(subpath), str(target.joinpath(subpath.name)))
-        elif target.is_dir() and target.exists():
+        elif subpath.is_dir():
             shutil.copytree(str(subpath), str(target.joinpath(subpath.name)))
         else:
-            raise IOError("the target is not an existing file or directory")
+            raise IOError("the path is not an existing file or directory: {}".format(path))
 
     @contextmanager
     def _exec_in_dir(self, path):
-        previous_path = os.getcwd()
+        """ yield the directory to execute in
+
+        NB: the process working directory is not changed, so that executions can run concurrently in threads
+        """
         if hasattr(path, "maketemp"):
             with path.maketemp(getoutput=True) as tempdir:
-                try:
-                    os.chdir(str(tempdir))
-                    yield
-                finally:
-                    os.chdir(previous_path)
+                yield str(tempdir)
         else:
-            try:
-                os.chdir(str(path))
-                yield
-            finally:
-                os.chdir(previous_path)
+            yield str(path)
 
     # def exec_cmnd(self, cmnd, path='.', raise_error=False, timeout=None):
     #     """ perform a command line execution
@@ -406,7 +483,7 @@ class LocalPath(VirtualDir):
             queue.put(None)
 
     # TODO timeout doesn't work in wait
-    def exec_cmnd(self, cmnd, path='.', raise_error=False, timeout=None):
+    def exec_cmnd(self, cmnd, path='.', raise_error=False, timeout=None, stdout=None, stderr=None):
         """ perform a command line execution
 
         Parameters
@@ -417,6 +494,10 @@ class LocalPath(VirtualDir):
             raise error if a non zero exit code is received
         timeout: None or float
             seconds to wait for a pending read/write operation before raising an error
+        stdout: None or list
+            if a list, the lines of stdout are appended to it (as well as being logged)
+        stderr: None or list
+            if a list, the lines of stderr are appended to it (as well as being logged)
 
         Returns
         -------
@@ -439,9 +520,9 @@ class LocalPath(VirtualDir):
 
         runpath = self._root.joinpath(path)
         runpath.absolute()
-        with self._exec_in_dir(runpath):
+        with self._exec_in_dir(runpath) as cwd:
             # subprocess.run(cmnd, shell=True, check=True)
-            process = Popen(cmnd, stdout=PIPE, stderr=PIPE, shell=True, bufsize=1)
+            process = Popen(cmnd, stdout=PIPE, stderr=PIPE, shell=True, bufsize=1, cwd=cwd)
             q = Queue()
             Thread(target=self._pipe_reader, args=[process.stdout, "out", q]).start()
             Thread(target=self._pipe_reader, args=[process.stderr, "error", q]).start()
@@ -450,8 +531,12 @@ class LocalPath(VirtualDir):
                 for source, name, line in iter(q.get, None):
                     if name == "out":
                         getattr(logger, "exec")(line.decode("utf-8").strip())
+                        if stdout is not None:
+                            stdout.append(line.decode("utf-8").rstrip("\r\n"))
                     elif name == "error":
                         logger.warning(line.decode("utf-8").strip())
+                        if stderr is not None:
+                            stderr.append(line.decode("utf-8").rstrip("\r\n"))
                     else:
                         raise ValueError("somethings gone wrong")
 
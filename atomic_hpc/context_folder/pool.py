@@ -0,0 +1,198 @@
+""" a module to pool authenticated SSH/SFTP connections, so that they can be reused
+across multiple folder contexts (e.g. multiple runs deployed to the same host)
+
+"""
+import atexit
+import logging
+import threading
+import time
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+class SSHPool(object):
+    """ a thread-safe pool of connected paramiko.SSHClient's, with an open SFTP session for each
+
+    connections are keyed by the hostname and connection keyword arguments (port, username, key, etc),
+    leased exclusively to a single user at a time, then returned to the pool on release
+
+    """
+
+    def __init__(self, max_idle=300., max_per_key=4):
+        """
+
+        Parameters
+        ----------
+        max_idle: float
+            seconds after which an unused connection is closed and evicted
+        max_per_key: int
+            maximum number of idle connections to keep per key
+
+        """
+        self.max_idle = max_idle
+        self.max_per_key = max_per_key
+        self._idle = {}
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(hostname, **kwargs):
+        """ create the key for a connection
+
+        Parameters
+        ----------
+        hostname: str
+        kwargs:
+            additional keyword arguments for paramiko.client.SSHClient.connect
+
+        Returns
+        -------
+        key: tuple
+
+        """
+        return hostname, _hashable(kwargs)
+
+    @staticmethod
+    def is_healthy(ssh, sftp=None):
+        """ whether a connection is still usable
+
+        Parameters
+        ----------
+        ssh: paramiko.client.SSHClient
+        sftp: paramiko.sftp_client.SFTPClient or None
+
+        Returns
+        -------
+        healthy: bool
+
+        """
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        if sftp is not None and sftp.sock.closed:
+            return False
+        return True
+
+    @staticmethod
+    def _close(ssh, sftp=None):
+        try:
+            if sftp is not None:
+                sftp.close()
+            ssh.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self):
+        """ close connections that have exceeded max_idle (must be called with the lock held) """
+        now = time.time()
+        for key in list(self._idle.keys()):
+            keep = []
+            for ssh, sftp, last_used in self._idle[key]:
+                if now - last_used > self.max_idle:
+                    logger.debug("evicting idle connection to {}".format(key[0]))
+                    self._close(ssh, sftp)
+                else:
+                    keep.append((ssh, sftp, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                self._idle.pop(key)
+
+    def lease(self, hostname, **kwargs):
+        """ lease a connection from the pool, creating a new one if no healthy idle connection is available
+
+        Parameters
+        ----------
+        hostname: str
+        kwargs:
+            additional keyword arguments for paramiko.client.SSHClient.connect
+
+        Returns
+        -------
+        ssh: paramiko.client.SSHClient
+        sftp: paramiko.sftp_client.SFTPClient
+
+        """
+        key = self.make_key(hostname, **kwargs)
+
+        with self._lock:
+            self._evict_idle()
+            idle = self._idle.get(key, [])
+            while idle:
+                ssh, sftp, _ = idle.pop()
+                if self.is_healthy(ssh, sftp):
+                    logger.debug("reusing pooled connection to {}".format(hostname))
+                    # reset the emulated working directory of the session
+                    sftp.chdir(None)
+                    self._leased[id(ssh)] = key
+                    return ssh, sftp
+                self._close(ssh, sftp)
+
+        logger.debug("opening new connection to {}".format(hostname))
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(hostname, **kwargs)
+        sftp = ssh.open_sftp()
+        with self._lock:
+            self._leased[id(ssh)] = key
+        return ssh, sftp
+
+    def release(self, ssh, sftp):
+        """ return a leased connection to the pool
+
+        Parameters
+        ----------
+        ssh: paramiko.client.SSHClient
+        sftp: paramiko.sftp_client.SFTPClient
+
+        """
+        with self._lock:
+            key = self._leased.pop(id(ssh), None)
+            if key is None or not self.is_healthy(ssh, sftp):
+                self._close(ssh, sftp)
+                return
+            idle = self._idle.setdefault(key, [])
+            if len(idle) >= self.max_per_key:
+                self._close(ssh, sftp)
+                return
+            idle.append((ssh, sftp, time.time()))
+            self._evict_idle()
+
+    def discard(self, ssh, sftp=None):
+        """ close a leased connection, without returning it to the pool
+
+        Parameters
+        ----------
+        ssh: paramiko.client.SSHClient
+        sftp: paramiko.sftp_client.SFTPClient or None
+
+        """
+        with self._lock:
+            self._leased.pop(id(ssh), None)
+        self._close(ssh, sftp)
+
+    def close_all(self):
+        """ close all idle connections in the pool """
+        with self._lock:
+            for connections in self._idle.values():
+                for ssh, sftp, _ in connections:
+                    self._close(ssh, sftp)
+            self._idle = {}
+
+
+default_pool = SSHPool()
+atexit.register(default_pool.close_all)
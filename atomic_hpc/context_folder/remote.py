@@ -3,7 +3,11 @@ import os
 import sys
 import codecs
 import select
+import tarfile
+import threading
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import paramiko
 try:
     basestring
 except NameError:
@@ -13,12 +17,20 @@ try:
     import pathlib
 except ImportError:
     import pathlib2 as pathlib
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 import logging
 logger = logging.getLogger(__name__)
 
 from atomic_hpc.context_folder.abstract import VirtualDir
-from atomic_hpc.utils import walk_path, glob_path, splitall
+from atomic_hpc.utils import walk_path_attr, glob_path, splitall, fnmatch_path
 
 
 # for writing binary output to stdout on windows
@@ -30,7 +42,8 @@ if sys.platform == "win32" or sys.platform == "win64":
 def renew_connection(func):
     def wrapper(*args, **kwargs):
         self = args[0]
-        if not self._ssh.get_transport().is_active():
+        transport = self._ssh.get_transport()
+        if transport is None or not transport.is_active():
             logger.debug("renewing connection to remote host")
             self._ssh.connect(self._hostname, **self._kwargs)
             self._sftp = self._ssh.open_sftp()
@@ -39,27 +52,92 @@ def renew_connection(func):
     return wrapper
 
 
+class _Progress(object):
+    """ thread-safe accumulation of the bytes transferred, over one or more files """
+
+    def __init__(self, total, callback=None):
+        """
+
+        Parameters
+        ----------
+        total: int
+            the total bytes to be transferred
+        callback: None or callable
+            called as callback(transferred, total) each time data is transferred
+
+        """
+        self.total = total
+        self.callback = callback
+        self._transferred = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        if self.callback is None:
+            return
+        with self._lock:
+            self._transferred += nbytes
+            self.callback(self._transferred, self.total)
+
+    def file_callback(self):
+        """ a callback for paramiko get/put methods, which report the cumulative bytes of a single file """
+        state = {"last": 0}
+
+        def callback(transferred, total):
+            self.add(transferred - state["last"])
+            state["last"] = transferred
+
+        return callback
+
+
 class RemotePath(VirtualDir):
 
-    def __init__(self, ssh, hostname, path, **kwargs):
+    # whether to run glob searches with a `find` execution on the remote host,
+    # rather than walking the directory tree over sftp (which requires one round trip per directory)
+    exec_glob = True
+    # whether to remove directory trees with a single `rm -rf` execution on the remote host,
+    # rather than removing each file and folder over sftp
+    exec_rmtree = True
+    # whether to copy multiple paths from the remote host as a single tar stream
+    exec_tar = True
+    # whether to compute file checksums with a `sha256sum` execution on the remote host
+    exec_checksum = True
+    # the maximum length of the command line arguments for a single execution
+    _max_cmnd_length = 100000
+    # the size of byte ranges that large files are split into, when downloading over multiple streams
+    _chunk_size = 8 * 1024 ** 2
+
+    def __init__(self, ssh, hostname, path, sftp=None, transfer_streams=1, **kwargs):
         """
 
         Parameters
         ----------
         ssh: paramiko.client.SSHClient
+            if not already connected, a connection will be made
+        hostname: str
         path: str
+        sftp: paramiko.sftp_client.SFTPClient or None
+            an open sftp session for ssh, if None a new session will be opened
+        transfer_streams: int
+            the maximum number of sftp channels to concurrently transfer files over
+        kwargs:
+            additional keyword arguments for paramiko.client.SSHClient.connect
 
         """
         self._root = path
         self._ssh = ssh
         self._hostname = hostname
+        self._exec_available = True
+        self._transfer_streams = max(int(transfer_streams), 1)
         self._kwargs = kwargs
         # if "allow_agent" not in kwargs:
         #     self._kwargs["allow_agent"] = False
         # if "look_for_keys" not in kwargs:
         #     self._kwargs["look_for_keys"] = False
-        self._ssh.connect(self._hostname, **self._kwargs)
-        self._sftp = self._ssh.open_sftp()
+        transport = self._ssh.get_transport()
+        if transport is None or not transport.is_active():
+            self._ssh.connect(self._hostname, **self._kwargs)
+            sftp = None
+        self._sftp = self._ssh.open_sftp() if sftp is None else sftp
         if not self.exists(self._root):
             self.makedirs(self._root)
         self._sftp.chdir(self._root)
@@ -180,7 +258,12 @@ class RemotePath(VirtualDir):
             curdir = os.path.join(curdir, part)
             if not self.exists(curdir):
                 logger.debug("making sub-directory: {}".format(curdir))
-                self._sftp.mkdir(curdir)
+                try:
+                    self._sftp.mkdir(curdir)
+                except IOError:
+                    # the directory may have been concurrently created
+                    if not self.exists(curdir):
+                        raise
 
     @renew_connection
     def glob(self, pattern):
@@ -199,25 +282,135 @@ class RemotePath(VirtualDir):
         if pattern.startswith(".."):
             raise IOError("cannot go outside folder context")
 
-        def walk_func(apath):
-            return walk_path(apath, listdir=self._sftp.listdir, isfile=self.isfile, isfolder=self.isdir)
+        patternlist = splitall(pattern)
+        if patternlist and patternlist[0] == ".":
+            patternlist = patternlist[1:]
 
         # can be time consuming to walk through paths, so don't start from root if possible
-        # TODO this may be able to be written better (or moved to glob_path)
         init_path = []
-        for pattern_piece in splitall(pattern):
+        for pattern_piece in patternlist:
             if any(c in pattern_piece for c in ('*', '?', "[", "]")):
                 break
             init_path.append(pattern_piece)
-        if init_path and init_path[0] == ".":
-            init_path = init_path[1:]
+        # the number of directory levels, below init_path, that the pattern can match
+        if any("**" in piece for piece in patternlist):
+            maxdepth = None
+        else:
+            maxdepth = len(patternlist) - len(init_path)
         init_path = os.path.join(*init_path) if init_path else ""
-        if self.exists(init_path):
-            for path in glob_path(init_path, pattern, walk_func):
-                    yield path
-            
+
+        if maxdepth == 0:
+            # no wildcards in the pattern
+            if init_path and self.exists(init_path):
+                yield init_path
+        elif self.exists(init_path):
+            paths = None
+            if self.exec_glob and self._exec_available and (maxdepth is None or maxdepth > 1):
+                paths = self._glob_exec(init_path, pattern, maxdepth)
+            if paths is None:
+                def walk_func(apath):
+                    for root, dirattrs, fileattrs in self._walk(apath, maxdepth):
+                        yield root, [a.filename for a in dirattrs], [a.filename for a in fileattrs]
+                paths = glob_path(init_path, pattern, walk_func)
+            for path in paths:
+                yield path
+
         logger.debug("finished yielding files for pattern: {}".format(pattern))
 
+    def _glob_exec(self, init_path, pattern, maxdepth=None):
+        """ find paths matching the pattern with a single `find` execution on the remote host
+
+        Parameters
+        ----------
+        init_path: str
+            the path to start searching from
+        pattern: str
+        maxdepth: int or None
+            the maximum depth, below init_path, to search
+
+        Returns
+        -------
+        paths: list of str or None
+            None if the execution was unsuccessful
+
+        Notes
+        -----
+        directories are output first, followed by an empty entry then the files,
+        all delimited by null characters (so any path names are allowed).
+        As for the sftp walk, symbolic links are listed as the type they link to (and broken links are ignored),
+        but are not walked into (except for init_path itself)
+
+        """
+        find_cmnd = "find -H {path} -mindepth 1{maxdepth} -xtype {{0}} -print0".format(
+            path=quote(init_path if init_path else "."),
+            maxdepth="" if maxdepth is None else " -maxdepth {}".format(maxdepth))
+        cmnd = "{0} && printf '\\0' && {1}".format(find_cmnd.format("d"), find_cmnd.format("f"))
+
+        exitcode, stdout, stderr = self._exec_capture(cmnd)
+        if exitcode:
+            logger.debug("server-side glob failed, falling back to sftp: {}".format(stderr.decode("utf-8").strip()))
+            return None
+
+        paths = []
+        isafile = False
+        for path in stdout.decode("utf-8").split("\0")[:-1]:
+            if not path:
+                isafile = True
+                continue
+            if not init_path and path.startswith("./"):
+                path = path[2:]
+            if fnmatch_path(path, pattern, isafile):
+                paths.append(path)
+        return paths
+
+    def _exec_capture(self, cmnd, timeout=None):
+        """ execute a command in the current directory and capture its output
+
+        Parameters
+        ----------
+        cmnd: str
+        timeout: None or float
+
+        Returns
+        -------
+        exitcode: int
+            -1 if the execution could not be started
+        stdout: bytes
+        stderr: bytes
+
+        """
+        stdout = []
+        stderr = []
+        cmnd = "cd {} && ".format(quote(self._sftp.getcwd())) + cmnd
+        try:
+            exitcode = self._stream_exec(self._ssh, cmnd, timeout,
+                                         stdout_func=stdout.append, stderr_func=stderr.append)
+        except paramiko.SSHException as err:
+            self._exec_available = False
+            return -1, b"", str(err).encode("utf-8")
+        return exitcode, b"".join(stdout), b"".join(stderr)
+
+    def _walk(self, path, maxdepth=None, followlinks=False):
+        """ walk the directory tree of path, with one listdir_attr round trip per directory
+
+        Parameters
+        ----------
+        path: str
+        maxdepth: int or None
+            the maximum number of directory levels to list
+        followlinks: bool
+            if True, walk into symbolic links to directories (except cycles)
+
+        Yields
+        -------
+        dirpath: str
+        dirattrs: list of paramiko.SFTPAttributes
+        fileattrs: list of paramiko.SFTPAttributes
+
+        """
+        return walk_path_attr(path, listdir_attr=self._sftp.listdir_attr, stat=self._sftp.stat, maxdepth=maxdepth,
+                              followlinks=followlinks, realpath=self._sftp.normalize)
+
     @renew_connection
     def rmtree(self, path):
         """remove all files and folders in path
@@ -232,18 +425,49 @@ class RemotePath(VirtualDir):
         """
         logger.debug("removing directories: {}".format(path))
 
-        if path == "" or path == ".":
+        cwd = self._sftp.getcwd()
+        if os.path.isabs(path):
+            relpath = os.path.relpath(os.path.normpath(path), cwd)
+        else:
+            relpath = os.path.normpath(path)
+        if relpath == ".":
             raise IOError("attempting to remove the root directory")
-        if not self.exists(path):
+        if relpath == ".." or relpath.startswith(".." + os.sep):
+            raise IOError("attempting to remove a directory outside the root directory: {}".format(path))
+        try:
+            attr = self._sftp.lstat(relpath)
+        except IOError:
             raise IOError("root doesn't exist: {}".format(path))
-        if not self.isdir(path):
+        if not stat.S_ISDIR(attr.st_mode):
+            # as for shutil.rmtree, symbolic links are not followed
             raise IOError("root is not a directory: {}".format(path))
-        print(os.path.join(path, "**", "*"))
-        logger.debug("removing: {0}".format(list(self.glob(os.path.join(path, "**", "*")))))
-        for subpath in reversed(sorted(self.glob(os.path.join(path, "**", "*")))):
-            self.remove(subpath)
-        if self.exists(path):
-            self.remove(path)
+
+        if self.exec_rmtree and self._exec_available:
+            cmnd = "rm -rf -- {}".format(quote(relpath))
+            if self.check_cmndline_security(cmnd) is None:
+                exitcode, _, stderr = self._exec_capture(cmnd)
+                if not exitcode:
+                    return
+                logger.debug("server-side rmtree failed, falling back to sftp: {}".format(
+                    stderr.decode("utf-8").strip()))
+
+        self._rmtree_sftp(relpath)
+
+    def _rmtree_sftp(self, path):
+        """ remove a directory tree, file by file, over sftp
+
+        symbolic links are removed themselves, and never walked into
+
+        """
+        for attr in self._sftp.listdir_attr(path):
+            subpath = os.path.join(path, attr.filename)
+            # listdir_attr should not follow links, but this is not guaranteed for all servers
+            if (attr.st_mode is not None and stat.S_ISDIR(attr.st_mode)
+                    and stat.S_ISDIR(self._sftp.lstat(subpath).st_mode)):
+                self._rmtree_sftp(subpath)
+            else:
+                self._sftp.remove(subpath)
+        self._sftp.rmdir(path)
 
     @renew_connection
     def rename(self, path, newname):
@@ -262,6 +486,40 @@ class RemotePath(VirtualDir):
         logger.debug("removing path: {0} to {1}".format(path, newname))
         self._sftp.rename(path, os.path.join(os.path.dirname(path), newname))
 
+    @renew_connection
+    def link(self, path, linkpath):
+        """ create a hard link to a file, falling back to a copy where hard links are not supported
+
+        (symbolic links are not used, since they would dangle, or be rejected, once the linked file is
+        retrieved without its target)
+
+        Parameters
+        ----------
+        path: str
+        linkpath: str
+
+        Returns
+        -------
+
+        """
+        logger.debug("linking path: {0} to {1}".format(path, linkpath))
+        if self._exec_available:
+            # sftp (v3) has no hard link operation
+            exitcode, _, stderr = self._exec_capture(
+                "ln -- {0} {1} 2>/dev/null || cp -p -- {0} {1}".format(quote(path), quote(linkpath)))
+            if not exitcode:
+                return
+            logger.debug("server-side link failed, falling back to sftp copy: {}".format(
+                stderr.decode("utf-8").strip()))
+        with self._sftp.open(path, "rb") as src, self._sftp.open(linkpath, "wb") as dst:
+            dst.set_pipelined(True)
+            while True:
+                data = src.read(32768)
+                if not data:
+                    break
+                dst.write(data)
+        self._sftp.chmod(linkpath, self._sftp.stat(path).st_mode)
+
     @renew_connection
     def remove(self, path):
         """
@@ -290,15 +548,17 @@ class RemotePath(VirtualDir):
             except IOError as err:
                 raise IOError("failed to remove folder; {0}, with error:\n{1}".format(path, err))
 
-    # TODO can get callbacks while uploading
     @renew_connection
-    def copy_from(self, source, path):
+    def copy_from(self, source, path, callback=None):
         """ copy from a local source outside the context folder
 
         Parameters
         ----------
         source: str or path_like
         path: str
+        callback: None or callable
+            called as callback(transferred, total) with the bytes transferred so far,
+            and the total bytes to be transferred
 
         Returns
         -------
@@ -311,23 +571,35 @@ class RemotePath(VirtualDir):
             source = pathlib.Path(source)
         if not source.exists():
             raise IOError("source doesn't exist: {}".format(source))
+
+        jobs = []
         if source.is_file():
-            with source.open() as file_obj:
-                self._sftp.putfo(file_obj, os.path.join(path, source.name))
+            jobs.append((os.path.join(path, source.name), source, source.stat().st_size))
         else:
-            self._sftp.mkdir(source.name)
-            for subsource in source.iterdir():
-                self.copy_from(subsource, os.path.join(path, source.name))
+            folders = [(source, os.path.join(path, source.name))]
+            while folders:
+                localdir, remotedir = folders.pop()
+                self._sftp.mkdir(remotedir)
+                for subsource in localdir.iterdir():
+                    remotepath = os.path.join(remotedir, subsource.name)
+                    if subsource.is_file():
+                        jobs.append((remotepath, subsource, subsource.stat().st_size))
+                    else:
+                        folders.append((subsource, remotepath))
+
+        self._transfer(jobs, download=False, callback=callback)
 
-    # TODO can get callbacks while downloading
     @renew_connection
-    def copy_to(self, path, target):
+    def copy_to(self, path, target, callback=None):
         """ copy to a local target outside the context folder
 
         Parameters
         ----------
         path: str
         target: str or path_like
+        callback: None or callable
+            called as callback(transferred, total) with the bytes transferred so far,
+            and the total bytes to be transferred
 
         Returns
         -------
@@ -335,7 +607,9 @@ class RemotePath(VirtualDir):
         """
         logger.debug("copying {0} to external target to {1}".format(path, target))
 
-        if not self.exists(path):
+        try:
+            attr = self._sftp.stat(path)
+        except IOError:
             raise IOError("path doesn't exist: {}".format(path))
         if isinstance(target, basestring):
             target = pathlib.Path(target)
@@ -345,16 +619,308 @@ class RemotePath(VirtualDir):
             targetchild = target.joinpath(os.path.basename(self._sftp.getcwd()))
         else:
             targetchild = target.joinpath(os.path.basename(path))
-        if self.isfile(path):
-            targetchild.touch()
-            #logger.debug("started copying file")
-            with targetchild.open("wb") as file_obj:
-                self._sftp.getfo(path, file_obj)
-            #logger.debug("finished copying file")
+
+        jobs = []
+        if stat.S_ISREG(attr.st_mode):
+            jobs.append((path, targetchild, attr.st_size))
         else:
             targetchild.mkdir()
-            for childpath in self.glob(os.path.join(path, "*")):
-                self.copy_to(childpath, targetchild)
+            for root, dirattrs, fileattrs in self._walk(path, followlinks=True):
+                localroot = targetchild.joinpath(os.path.relpath(root, path))
+                for dattr in dirattrs:
+                    localroot.joinpath(dattr.filename).mkdir()
+                for fattr in fileattrs:
+                    jobs.append((os.path.join(root, fattr.filename),
+                                 localroot.joinpath(fattr.filename), fattr.st_size))
+
+        self._transfer(jobs, download=True, callback=callback)
+
+    def _transfer(self, jobs, download=True, callback=None):
+        """ transfer files between the remote and local host
+
+        files are spread across (up to) transfer_streams sftp channels on the same transport
+        and, when downloading, files larger than two chunks are split into byte ranges,
+        which are read in parallel
+
+        Parameters
+        ----------
+        jobs: list of tuple
+            (remotepath, localpath, size) for each file
+        download: bool
+            if True, copy the remote paths to the local paths, otherwise the local paths to the remote paths
+        callback: None or callable
+            called as callback(transferred, total)
+
+        Returns
+        -------
+
+        """
+        progress = _Progress(sum([size for _, _, size in jobs]), callback)
+
+        tasks = []
+        for remotepath, localpath, size in jobs:
+            if not download:
+                tasks.append((self._put_file, (localpath, remotepath, size, progress)))
+            elif self._transfer_streams > 1 and size > 2 * self._chunk_size:
+                # preallocate the local file, so that ranges can be written in any order
+                with localpath.open("wb") as file_obj:
+                    file_obj.truncate(size)
+                for offset in range(0, size, self._chunk_size):
+                    length = min(self._chunk_size, size - offset)
+                    tasks.append((self._get_range, (remotepath, localpath, offset, length, progress)))
+            else:
+                tasks.append((self._get_file, (remotepath, localpath, progress)))
+
+        nstreams = min(self._transfer_streams, len(tasks))
+        if nstreams <= 1:
+            for func, args in tasks:
+                func(self._sftp, *args)
+            return
+
+        with self._sftp_streams(nstreams) as streams:
+
+            def run_task(task):
+                func, args = task
+                sftp = streams.get()
+                try:
+                    func(sftp, *args)
+                finally:
+                    streams.put(sftp)
+
+            threadpool = ThreadPool(nstreams)
+            try:
+                threadpool.map(run_task, tasks)
+            finally:
+                threadpool.close()
+                threadpool.join()
+
+    @contextmanager
+    def _sftp_streams(self, nstreams):
+        """ yield a queue of sftp sessions, the current session plus up to nstreams - 1 additional channels
+        (which are closed on exit)
+
+        """
+        streams = Queue()
+        streams.put(self._sftp)
+        extras = []
+        try:
+            cwd = self._sftp.getcwd()
+            for _ in range(nstreams - 1):
+                try:
+                    sftp = self._ssh.open_sftp()
+                except (paramiko.SSHException, EOFError) as err:
+                    logger.debug("could not open an additional sftp channel: {}".format(err))
+                    break
+                sftp.chdir(cwd)
+                extras.append(sftp)
+                streams.put(sftp)
+            logger.debug("transferring over {} sftp channels".format(len(extras) + 1))
+            yield streams
+        finally:
+            for sftp in extras:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _get_file(sftp, remotepath, localpath, progress):
+        with localpath.open("wb") as file_obj:
+            sftp.getfo(remotepath, file_obj, callback=progress.file_callback())
+
+    @staticmethod
+    def _get_range(sftp, remotepath, localpath, offset, length, progress):
+        with sftp.open(remotepath, "rb") as remote_obj:
+            data = b"".join(remote_obj.readv([(offset, length)]))
+        if len(data) != length:
+            raise IOError("short read of {0} at offset {1}: expected {2} bytes, got {3}".format(
+                remotepath, offset, length, len(data)))
+        with localpath.open("r+b") as file_obj:
+            file_obj.seek(offset)
+            file_obj.write(data)
+        progress.add(length)
+
+    @staticmethod
+    def _put_file(sftp, localpath, remotepath, size, progress):
+        with localpath.open("rb") as file_obj:
+            sftp.putfo(file_obj, remotepath, file_size=size, callback=progress.file_callback())
+
+    @renew_connection
+    def copy_many_to(self, paths, target, compress=False):
+        """ copy multiple paths to a local target outside the context folder
+
+        the paths are streamed as a single tar archive over one execution channel (per batch of paths),
+        falling back to copying each path over sftp, if the execution fails to start.
+        As for copy_to, symbolic links are followed, and a batch containing a link cycle or broken link
+        is copied over sftp (which skips cycles)
+
+        Parameters
+        ----------
+        paths: list of str
+        target: str or path_like
+        compress: bool
+            whether to gzip the tar stream
+
+        Returns
+        -------
+
+        """
+        logger.debug("copying {0} paths to external target {1}".format(len(paths), target))
+
+        if isinstance(target, basestring):
+            target = pathlib.Path(target)
+        if not target.exists():
+            raise IOError("target doesn't exist: {}".format(target))
+
+        cwd = self._sftp.getcwd()
+        # tar -h would never terminate on a link cycle, so the paths are first checked (with find -L,
+        # which fails on cycles, and finds broken links with -type l)
+        tar_cmnd = 'links=$(find -L{0} -type l -print -quit) && [ -z "$links" ] && tar -c{1}hf -{2}'
+        batches = [[]]
+        length = 0
+        for path in paths:
+            abspath = os.path.normpath(os.path.join(cwd, path))
+            # as for copy_to, each path is copied to the target by its basename
+            arg = " -C {0} {1}".format(quote(os.path.dirname(abspath)), quote(os.path.basename(abspath)))
+            find_arg = " {}".format(quote(abspath))
+            if length + len(arg) + len(find_arg) > self._max_cmnd_length and batches[-1]:
+                batches.append([])
+                length = 0
+            batches[-1].append((path, arg, find_arg))
+            length += len(arg) + len(find_arg)
+
+        for batch in batches:
+            if not batch:
+                continue
+            if self.exec_tar and self._exec_available:
+                cmnd = tar_cmnd.format("".join(find_arg for _, _, find_arg in batch), "z" if compress else "",
+                                       "".join(arg for _, arg, _ in batch))
+                if self._tar_to(cmnd, target, compress):
+                    continue
+            for path, _, _ in batch:
+                self.copy_to(path, target)
+
+    def _tar_to(self, cmnd, target, compress=False):
+        """ stream a tar archive, created by cmnd, and extract it to target
+
+        Parameters
+        ----------
+        cmnd: str
+        target: pathlib.Path
+        compress: bool
+
+        Returns
+        -------
+        success: bool
+            False if no archive was received (i.e. nothing has been copied)
+
+        """
+        security = self.check_cmndline_security(cmnd)
+        if security is not None:
+            logger.error(security)
+            return False
+        try:
+            stdin, stdout, stderr = self._ssh.exec_command(cmnd)
+        except paramiko.SSHException as err:
+            logger.debug("server-side tar failed, falling back to sftp: {}".format(err))
+            self._exec_available = False
+            return False
+        stdin.close()
+
+        extracted = False
+        try:
+            with tarfile.open(fileobj=stdout, mode="r|gz" if compress else "r|") as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extraction_filter = tarfile.data_filter
+                for member in tar:
+                    if os.path.isabs(member.name) or ".." in splitall(member.name):
+                        raise IOError("refusing to extract path outside of target: {}".format(member.name))
+                    tar.extract(member, str(target))
+                    extracted = True
+        except tarfile.TarError as err:
+            if extracted:
+                raise IOError("failed extracting tar stream: {}".format(err))
+        exitcode = stdout.channel.recv_exit_status()
+        errors = stderr.read().decode("utf-8").strip()
+        if exitcode or not extracted:
+            if extracted:
+                raise IOError("tar exited with error code {0}: {1}".format(exitcode, errors))
+            logger.debug("server-side tar failed, falling back to sftp: {}".format(errors))
+            return False
+        return True
+
+    @renew_connection
+    def walk_files(self, path):
+        """ walk all the files at, or below, a path
+
+        Parameters
+        ----------
+        path: str
+
+        Yields
+        -------
+        filepath: str
+            the path of each file, relative to the root
+        attr: paramiko.SFTPAttributes
+            the attributes of each file (see stat)
+
+        """
+        try:
+            attr = self._sftp.stat(path)
+        except IOError:
+            raise IOError("path doesn't exist: {}".format(path))
+        if stat.S_ISREG(attr.st_mode):
+            yield path, attr
+            return
+        for root, _, fileattrs in self._walk(path, followlinks=True):
+            for fattr in fileattrs:
+                yield os.path.normpath(os.path.join(root, fattr.filename)), fattr
+
+    @renew_connection
+    def checksums(self, paths):
+        """ compute the sha256 checksum of files
+
+        the checksums are computed by `sha256sum` on the remote host (per batch of paths),
+        falling back to reading the files over sftp, if the execution fails
+
+        Parameters
+        ----------
+        paths: list of str
+
+        Returns
+        -------
+        checksums: dict
+            {path: hexdigest}
+
+        """
+        batches = [[]]
+        length = 0
+        for path in paths:
+            if length + len(path) > self._max_cmnd_length and batches[-1]:
+                batches.append([])
+                length = 0
+            batches[-1].append(path)
+            length += len(path) + 3
+
+        checksums = {}
+        for batch in batches:
+            if not batch:
+                continue
+            if self.exec_checksum and self._exec_available:
+                exitcode, stdout, stderr = self._exec_capture(
+                    "sha256sum -- {}".format(" ".join([quote(p) for p in batch])))
+                if not exitcode:
+                    for line in stdout.decode("utf-8").splitlines():
+                        # escaped names (containing a backslash or newline) are left to the fallback
+                        if not line.startswith("\\"):
+                            checksums[line[66:]] = line[:64]
+                else:
+                    logger.debug("server-side checksum failed, falling back to sftp: {}".format(
+                        stderr.decode("utf-8").strip()))
+            missing = [p for p in batch if p not in checksums]
+            if missing:
+                checksums.update(super(RemotePath, self).checksums(missing))
+        return checksums
 
     @renew_connection
     @contextmanager
@@ -455,7 +1021,7 @@ class RemotePath(VirtualDir):
             logger.warning(line)
 
     @renew_connection
-    def exec_cmnd(self, cmnd, path='.', raise_error=False, timeout=None):
+    def exec_cmnd(self, cmnd, path='.', raise_error=False, timeout=None, stdout=None, stderr=None):
         """ perform a command line execution
 
         Parameters
@@ -466,6 +1032,10 @@ class RemotePath(VirtualDir):
             raise error if a non zero exit code is received
         timeout: None or float
             seconds to wait for a pending read/write operation before raising an error
+        stdout: None or list
+            if a list, the lines of stdout are appended to it (as well as being logged)
+        stderr: None or list
+            if a list, the lines of stderr are appended to it (as well as being logged)
 
         Returns
         -------
@@ -493,8 +1063,30 @@ class RemotePath(VirtualDir):
 
         # stdin, stdout, stderr = self._ssh.exec_command(cmnd)
         # exitcode = stdout.channel.recv_exit_status()
+        if stdout is None:
+            stdout_func = self._log_output
+        else:
+            chunks = []
+
+            def stdout_func(pipe):
+                chunks.append(pipe)
+                self._log_output(pipe)
+
+        if stderr is None:
+            stderr_func = self._log_error
+        else:
+            err_chunks = []
+
+            def stderr_func(pipe):
+                err_chunks.append(pipe)
+                self._log_error(pipe)
+
         exitcode = self._stream_exec(self._ssh, cmnd, timeout,
-                                     stderr_func=self._log_error, stdout_func=self._log_output)
+                                     stderr_func=stderr_func, stdout_func=stdout_func)
+        if stdout is not None:
+            stdout.extend(b"".join(chunks).decode("utf-8").splitlines())
+        if stderr is not None:
+            stderr.extend(b"".join(err_chunks).decode("utf-8").splitlines())
 
         if exitcode:
             err_msg = "the following line caused error code {0}: {1}\n".format(exitcode, cmnd)
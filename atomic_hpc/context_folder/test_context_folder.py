@@ -3,11 +3,18 @@ import os
 import shutil
 import pytest
 import inspect
+import hashlib
 import logging
+from tempfile import mkdtemp
 
 from atomic_hpc.mockssh import mockserver
 from atomic_hpc.context_folder import change_dir, LocalPath, RemotePath
+from atomic_hpc.context_folder.pool import SSHPool
 from jsonextended.utils import MockPath
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 # python 3 to 2 compatibility
 try:
@@ -192,3 +199,180 @@ def test_exec_cmnd_multiline_output(context):
                         level=logging.INFO, stream=sys.stdout)
     assert testdir.exec_cmnd(
         'bash -c \'for ((i = 0 ; i < 4 ; i++ )); do echo "abc" >&1; echo "efg" >&2; sleep 1; done\'')
+
+
+def test_remote_pooled_connection():
+    test_folder = os.path.join(os.path.dirname(__file__), 'test_tmp')
+    if os.path.exists(test_folder):
+        shutil.rmtree(test_folder)
+    os.mkdir(test_folder)
+
+    pool = SSHPool()
+    with mockserver.Server({"user": {"password": "password"}}, test_folder) as server:
+        kwargs = dict(remote=True, hostname=server.host, port=server.port,
+                      username="user", password="password", pool=pool)
+        with change_dir("subdir1", **kwargs) as testdir:
+            testdir.makedirs("subsubdir1")
+            first_ssh = testdir._ssh
+        with change_dir("subdir1/subsubdir1", **kwargs) as testdir:
+            assert testdir._ssh is first_ssh
+            assert testdir.exists(".")
+            assert list(testdir.glob("*")) == []
+        with change_dir(".", **kwargs) as testdir:
+            assert sorted(testdir.glob("**")) == ["subdir1", "subdir1/subsubdir1"]
+
+        # unhealthy connections are not reused
+        first_ssh.close()
+        with change_dir(".", **kwargs) as testdir:
+            assert testdir._ssh is not first_ssh
+
+        # connections are only leased on entry, and returned if entering fails
+        change_dir(".", **kwargs)
+        assert not pool._leased
+        with open(os.path.join(test_folder, "file.txt"), "w") as f:
+            f.write("file content")
+        with pytest.raises(Exception):
+            with change_dir("file.txt", **kwargs):
+                pass
+        assert not pool._leased
+
+    pool.close_all()
+
+
+@pytest.mark.parametrize("pattern", [
+    "*", "**", "**/*", "subdir1/**/*", "subdir1/*/*.txt", "*/*", "subdir1/sub dir2", "**/*.txt",
+    "linkdir/*", "linkdir/**/*"])
+def test_remote_glob_exec(remote, pattern):
+    testdir, test_external = remote
+    testdir.makedirs("subdir1/sub dir2")
+    testdir.copy_from(os.path.join(testdir.getabs("file.txt")), "subdir1/sub dir2")
+    # links are listed as the type they link to, but not walked into (and broken links are ignored)
+    os.symlink(testdir.getabs("subdir1"), testdir.getabs("linkdir"))
+    os.symlink(str(test_external), testdir.getabs("subdir1/external"))
+    os.symlink(str(test_external.joinpath("file.txt")), testdir.getabs("subdir1/linkfile.txt"))
+    os.symlink(str(test_external.joinpath("missing.txt")), testdir.getabs("subdir1/broken.txt"))
+
+    testdir._exec_available = True
+    assert testdir._glob_exec("", "**/*") is not None
+    exec_paths = sorted(testdir.glob(pattern))
+    testdir._exec_available = False
+    sftp_paths = sorted(testdir.glob(pattern))
+    assert exec_paths == sftp_paths
+    assert exec_paths
+
+
+@pytest.mark.parametrize("exec_available", [True, False])
+def test_remote_rmtree(remote, exec_available):
+    testdir, _ = remote
+    testdir._exec_available = exec_available
+    testdir.makedirs("subdir1/subdir2/subdir3")
+    testdir.copy_from(testdir.getabs("file.txt"), "subdir1/subdir2")
+
+    with pytest.raises(IOError):
+        testdir.rmtree(".")
+    with pytest.raises(IOError):
+        testdir.rmtree("subdir1/../..")
+    with pytest.raises(IOError):
+        testdir.rmtree("file.txt")
+
+    testdir.rmtree("subdir1/subdir2")
+    assert sorted(testdir.glob("**/*")) == ["file.txt", "subdir1"]
+    testdir.rmtree(testdir.getabs("subdir1"))
+    assert sorted(testdir.glob("**/*")) == ["file.txt"]
+
+
+@pytest.mark.parametrize("exec_available", [True, False])
+def test_remote_rmtree_links(remote, exec_available):
+    testdir, test_external = remote
+    testdir._exec_available = exec_available
+    testdir.makedirs("tree/subdir")
+    os.symlink(str(test_external), testdir.getabs("tree/external"))
+    os.symlink(testdir.getabs("tree"), testdir.getabs("tree/subdir/loop"))
+
+    # links are not walked into by glob, but are followed (except cycles) when copying
+    assert sorted(testdir.glob("tree/**/*")) == ["tree/external", "tree/subdir", "tree/subdir/loop"]
+    local_path = pathlib.Path(mkdtemp())
+    try:
+        testdir.copy_to("tree", local_path)
+        assert local_path.joinpath("tree", "external", "file.txt").exists()
+        assert not local_path.joinpath("tree", "subdir", "loop", "subdir").exists()
+    finally:
+        shutil.rmtree(str(local_path))
+
+    with pytest.raises(IOError):
+        testdir.rmtree("tree/external")
+    testdir.rmtree("tree")
+    assert not testdir.exists("tree")
+    assert test_external.joinpath("file.txt").exists()
+
+
+@pytest.mark.parametrize("hardlink", [True, False])
+def test_local_link(local_pathlib, hardlink):
+    testdir, _ = local_pathlib
+    if hardlink:
+        testdir.link("file.txt", "linked.txt")
+    else:
+        with mock.patch("os.link", side_effect=OSError("hard links not supported")):
+            testdir.link("file.txt", "linked.txt")
+    # never a symbolic link, which would dangle once retrieved without its target
+    assert not os.path.islink(testdir.getabs("linked.txt"))
+    assert os.path.samefile(testdir.getabs("file.txt"), testdir.getabs("linked.txt")) == hardlink
+    with testdir.open("linked.txt") as f:
+        assert f.read() == "file content"
+
+
+@pytest.mark.parametrize("exec_available", [True, False])
+def test_remote_link(remote, exec_available):
+    testdir, _ = remote
+    testdir._exec_available = exec_available
+    testdir.link("file.txt", "linked.txt")
+    assert not os.path.islink(testdir.getabs("linked.txt"))
+    assert os.path.samefile(testdir.getabs("file.txt"), testdir.getabs("linked.txt")) == exec_available
+    with testdir.open("linked.txt") as f:
+        assert f.read() == "file content"
+
+
+@pytest.mark.parametrize("transfer_streams", [1, 3])
+def test_remote_transfer_streams(remote, transfer_streams):
+    testdir, test_external = remote
+    testdir._transfer_streams = transfer_streams
+    # force the large file to be split into byte ranges
+    testdir._chunk_size = 1000
+
+    source = test_external.joinpath("source")
+    source.joinpath("subdir").mkdir(parents=True)
+    content = os.urandom(10500)
+    with source.joinpath("large.bin").open("wb") as f:
+        f.write(content)
+    for i in range(5):
+        with source.joinpath("subdir", "file{}.txt".format(i)).open("w") as f:
+            f.write(u"file content {}".format(i))
+
+    progress = []
+    testdir.copy_from(source, ".", callback=lambda n, total: progress.append((n, total)))
+    assert progress[-1] == (10500 + 5 * 14, 10500 + 5 * 14)
+    assert sorted(testdir.glob("source/**/*")) == sorted(
+        ["source/large.bin", "source/subdir"] + ["source/subdir/file{}.txt".format(i) for i in range(5)])
+
+    target = test_external.joinpath("target")
+    target.mkdir()
+    progress = []
+    testdir.copy_to("source", target, callback=lambda n, total: progress.append((n, total)))
+    assert progress[-1] == (10500 + 5 * 14, 10500 + 5 * 14)
+    with target.joinpath("source", "large.bin").open("rb") as f:
+        assert f.read() == content
+    for i in range(5):
+        with target.joinpath("source", "subdir", "file{}.txt".format(i)).open() as f:
+            assert f.read() == "file content {}".format(i)
+
+
+@pytest.mark.parametrize("exec_available", [True, False])
+def test_remote_checksums(remote, exec_available):
+    testdir, _ = remote
+    testdir._exec_available = exec_available
+    testdir.makedirs("sub dir")
+    testdir.copy_from(testdir.getabs("file.txt"), "sub dir")
+    expected = hashlib.sha256(b"file content").hexdigest()
+    assert testdir.checksums(["file.txt", "sub dir/file.txt"]) == {
+        "file.txt": expected, "sub dir/file.txt": expected}
+    assert sorted([p for p, _ in testdir.walk_files(".")]) == ["file.txt", "sub dir/file.txt"]
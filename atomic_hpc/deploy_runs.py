@@ -2,12 +2,19 @@
 module to deploy runs
 """
 import copy
+import hashlib
+import json
 import os
 import logging
-import re
+import shutil
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
 
 # python 2/3 compatibility
 import time
+import uuid
+from collections import OrderedDict
 from fnmatch import fnmatch
 
 from ruamel.yaml import YAML
@@ -24,15 +31,19 @@ try:
     unicode
 except NameError:
     unicode = str
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
 from atomic_hpc import context_folder
+from atomic_hpc.config_yaml import RunMapping
+from atomic_hpc.job_status import poll_jobs, _FINAL_STATES
+from atomic_hpc.template import compile_template, MissingInsertError
 from atomic_hpc.utils import add_loglevel
 import atomic_hpc
 
 
-_REGEX_VAR = r"(?:\@v\{[^}]+\})"
-_REGEX_FILE = r"(?:\@f\{[^}]+\})"
-
 try:
     add_loglevel("EXEC", logging.INFO + 1)
 except AttributeError:
@@ -53,19 +64,182 @@ def _replace_in_cmnd(cmndline, variables, rid):
     -------
 
     """
-    var_error = "error in run {id}: variable name; {var_name} not available to replace in cmndline; {cmnd}"
-    for tag in re.findall(_REGEX_VAR, cmndline):
-        var = tag[3:-1]
-        if variables is None:
-            raise KeyError(var_error.format(id=rid, var_name=var, cmnd=cmndline))
-        elif var not in variables:
-            raise KeyError(var_error.format(id=rid, var_name=var, cmnd=cmndline))
-        cmndline = cmndline.replace(tag, str(variables[var]))
-    return cmndline
+    try:
+        # (file contents are not inserted into command lines)
+        return compile_template(cmndline).render(variables)
+    except MissingInsertError as err:
+        raise KeyError("error in run {id}: variables not available to replace in cmndline; {cmnd}: {missing}".format(
+            id=rid, cmnd=cmndline, missing=err))
+
+
+class InputCache(object):
+    """ a thread-safe cache of input file contents, to share between runs of a deployment
+
+    contents are keyed by (host, absolute path, modification time, size, mode),
+    with the least recently used contents evicted once the total size exceeds max_bytes
+
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+
+        Parameters
+        ----------
+        max_bytes: int
+            the maximum total size of the cached contents (contents larger than this are not cached)
+
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._contents = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def read(self, folder, path, host=None, mode="r"):
+        """ read the contents of a file, from the cache if it is unchanged
+
+        Parameters
+        ----------
+        folder: atomic_hpc.context_folder.abstract.VirtualDir
+        path: str
+        host: str or None
+            the host of the folder (None if local)
+        mode: str
+            the mode to open the file in
+
+        Returns
+        -------
+        content: str or bytes
+        fstat: object
+            the attributes of the file (see VirtualDir.stat)
+
+        """
+        fstat = folder.stat(path)
+        key = (host, folder.getabs(path), fstat.st_mtime, fstat.st_size, mode)
+        content = self._get(key)
+        if content is None:
+            with folder.open(path, mode=mode) as f:
+                content = f.read()
+            self._put(key, content)
+        return content, fstat
+
+    def checksum(self, folder, path, host=None):
+        """ the sha256 checksum of a file, from the cache if it is unchanged
+
+        Parameters
+        ----------
+        folder: atomic_hpc.context_folder.abstract.VirtualDir
+        path: str
+        host: str or None
+            the host of the folder (None if local)
+
+        Returns
+        -------
+        hexdigest: str
+
+        """
+        fstat = folder.stat(path)
+        key = (host, folder.getabs(path), fstat.st_mtime, fstat.st_size, "sha256")
+        digest = self._get(key)
+        if digest is None:
+            digest = folder.checksums([path])[path]
+            self._put(key, digest)
+        return digest
+
+    def _get(self, key):
+        with self._lock:
+            if key not in self._contents:
+                return None
+            self.hits += 1
+            content = self._contents.pop(key)
+            self._contents[key] = content
+            return content
+
+    def _put(self, key, content):
+        with self._lock:
+            self.misses += 1
+            if key not in self._contents and len(content) <= self.max_bytes:
+                self._contents[key] = content
+                self._nbytes += len(content)
+                while self._nbytes > self.max_bytes:
+                    _, evicted = self._contents.popitem(last=False)
+                    self._nbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._contents.clear()
+            self._nbytes = 0
+
+
+class BinaryRef(object):
+    """ a lazy reference to an input binary file, which is streamed to its destination
+    (rather than read into memory)
+
+    """
+
+    def __init__(self, folder_kwargs, path, cache=None):
+        """
+
+        Parameters
+        ----------
+        folder_kwargs: dict
+            keyword arguments for context_folder.change_dir, to open the folder containing the binary
+        path: str
+            the path of the binary in the folder
+        cache: InputCache or None
+            a cache for the binary's checksum
+
+        """
+        self.folder_kwargs = folder_kwargs
+        self.path = path
+        self.cache = cache
+
+    def __repr__(self):
+        return "BinaryRef({0!r}, {1!r})".format(self.folder_kwargs.get("hostname", None), self.path)
+
+    def checksum(self):
+        """ the sha256 checksum of the binary (computed on its host, where possible)
+
+        Returns
+        -------
+        hexdigest: str
+
+        """
+        with context_folder.change_dir(**self.folder_kwargs) as source:
+            if self.cache is None:
+                return source.checksums([self.path])[self.path]
+            return self.cache.checksum(source, self.path, self.folder_kwargs.get("hostname", None))
+
+    def copy_to(self, folder, path):
+        """ copy the binary to a directory in a folder (with the same file name)
+
+        Parameters
+        ----------
+        folder: atomic_hpc.context_folder.abstract.VirtualDir
+        path: str
+            the directory to copy to
+
+        """
+        with context_folder.change_dir(**self.folder_kwargs) as source:
+            local_source = isinstance(source, context_folder.LocalPath)
+            local_folder = isinstance(folder, context_folder.LocalPath)
+            if local_source and not source._virtual and not (local_folder and folder._virtual):
+                # cloned or zero-copied locally, or streamed by sftp
+                folder.copy_from(source.getabs(self.path), path)
+            elif not local_source and local_folder and not folder._virtual:
+                source.copy_to(self.path, folder.getabs(path))
+            else:
+                # between virtual folders, or remote hosts
+                outpath = os.path.join(path, source.name(self.path))
+                with source.open(self.path, "rb") as src, folder.open(outpath, "wb") as dst:
+                    if hasattr(dst, "set_pipelined"):
+                        dst.set_pipelined(True)
+                    shutil.copyfileobj(src, dst, 2 ** 20)
 
 
 # TODO should have option to store script/file contents in tempdir (between input & output)
-def get_inputs(run, config_path):
+def get_inputs(run, config_path, cache=None):
     """ get the inputs and resolve regex insertions
 
     Parameters
@@ -74,13 +248,15 @@ def get_inputs(run, config_path):
         conforming to run schema
     config_path: str or path like
         path to configuration file
+    cache: InputCache or None
+        a cache of input contents, shared between runs
 
     Returns
     -------
     inputs: dct
         with keys:
             files: dict
-                {filename, content_text}
+                {filename: (content_text or BinaryRef, stat)}
             scripts: dict
                 {scriptname: content_text}
             cmnds: list
@@ -89,6 +265,8 @@ def get_inputs(run, config_path):
     files = {}
     scripts = {}
     variables = {}
+    if cache is None:
+        cache = InputCache()
 
     if run["input"] is not None:
 
@@ -99,6 +277,7 @@ def get_inputs(run, config_path):
         else:
             inpath = run["input"]["path"]
         if run["input"]["remote"] is None:
+            hostname = None
             kwargs = dict(path=config_path.joinpath(inpath))
         else:
             remote = run["input"]["remote"].copy()
@@ -118,11 +297,8 @@ def get_inputs(run, config_path):
                         raise ValueError("run {0}: files path is not a file: {1}".format(run["id"], fpath))
                     if fid not in variables:
                         variables[fid] = folder.name(fpath)
-                    fstat = folder.stat(fpath)
-                    with folder.open(fpath) as f:
-                        files[fid] = (folder.name(fpath), (f.read(), fstat))
+                    files[fid] = (folder.name(fpath), cache.read(folder, fpath, hostname))
 
-            # TODO shouldn't be able to add binary to script
             if run["input"]["binaries"] is not None:
                 for fid, fpath in run["input"]["binaries"].items():
                     if not folder.exists(fpath):
@@ -131,11 +307,11 @@ def get_inputs(run, config_path):
                         raise ValueError("run {0}: files path is not a file: {1}".format(run["id"], fpath))
                     if fid not in variables:
                         variables[fid] = folder.name(fpath)
-                    fstat = folder.stat(fpath)
-                    with folder.open(fpath, mode="rb") as f:
-                        files[fid] = (folder.name(fpath), (f.read(), fstat))
+                    files[fid] = (folder.name(fpath), (BinaryRef(kwargs, fpath, cache), folder.stat(fpath)))
 
             if run["input"]["scripts"] is not None:
+                contents = dict([(fid, content) for fid, (_, (content, _)) in files.items()
+                                 if not isinstance(content, BinaryRef)])
                 for spath in run["input"]["scripts"]:
 
                     # create main script
@@ -148,25 +324,19 @@ def get_inputs(run, config_path):
                     if scriptname in scripts:
                         raise ValueError("run {0}: two scripts with same name: {1}".format(run["id"], scriptname))
 
-                    sstat = folder.stat(spath)
-                    with folder.open(spath) as f:
-                        script = f.read()
-
-                    # insert variables
-                    var_error = "run {id}: no replacement found for @v{{{var_name}}} in script; {spath}"
-                    for tag in re.findall(_REGEX_VAR, script):
-                        var = tag[3:-1]
-                        if var not in variables:
-                            raise KeyError(var_error.format(id=run["id"], var_name=var, spath=spath))
-                        script = script.replace(tag, str(variables[var]))
-
-                    # insert file contents
-                    file_error = "run {id}: no replacement found for @f{{{path_name}}} in script; {spath}"
-                    for tag in re.findall(_REGEX_FILE, script):
-                        var = tag[3:-1]
-                        if var not in files:
-                            raise KeyError(file_error.format(id=run["id"], path_name=var, spath=spath))
-                        script = script.replace(tag, files[var][1][0])
+                    script, sstat = cache.read(folder, spath, hostname)
+
+                    # insert variables and file contents
+                    template = compile_template(script)
+                    for var in template.names("f"):
+                        if var in files and isinstance(files[var][1][0], BinaryRef):
+                            raise ValueError("run {0}: cannot insert binary @f{{{1}}} in script; {2}".format(
+                                run["id"], var, spath))
+                    try:
+                        script = template.render(variables, contents)
+                    except MissingInsertError as err:
+                        raise KeyError("run {0}: no replacement found for {1} in script; {2}".format(
+                            run["id"], err, spath))
 
                     scripts[scriptname] = (script, sstat)
 
@@ -179,13 +349,69 @@ def get_inputs(run, config_path):
     return {"files": dict(files.values()), "scripts": scripts, "cmnds": cmnds}
 
 
-def deploy_runs(runs, root_path, if_exists="abort", exec_errors=False, test_run=False):
+def _deploy_run(run, root_path, if_exists="abort", exec_errors=False, test_run=False, cache=None, store=False,
+                submit=True, jobids=None):
+    """ gather the inputs for, and deploy, a single run
+
+    Parameters
+    ----------
+    run: dict
+    root_path: str or path_like
+    if_exists: ["abort", "remove", "use"]
+    exec_errors: bool
+    test_run: bool
+    cache: InputCache or None
+    store: bool
+    submit: bool
+        if False, qsub runs are not submitted
+    jobids: None or dict
+        if a dict, the job ids of submitted qsub runs are added to it
+
+    Returns
+    -------
+    success: bool
+
+    """
+    logger.info("gathering inputs for run: {0}: {1}".format(run["id"], run["name"]))
+
+    # get inputs
+    inputs = get_inputs(run, root_path, cache=cache)
+    fnames = list(inputs["scripts"].keys())
+    fnames += list(inputs["files"].keys())
+    if not len(set(fnames)) == len(fnames):
+        logging.critical("aborting run: there is a script or file name clash in the inputs: {}".format(fnames))
+        return False
+
+    if run["environment"] in ["unix", "windows"]:
+        return deploy_run_normal(run, inputs, root_path, if_exists=if_exists, exec_errors=exec_errors,
+                                 test_run=test_run, store=store)
+    elif run["environment"] == "qsub":
+        return deploy_run_qsub(run, inputs, root_path, if_exists=if_exists, exec_errors=exec_errors,
+                               test_run=test_run, store=store, submit=submit, jobids=jobids)
+    else:
+        raise ValueError("unknown environment: {}".format(run["environment"]))
+
+
+def _deploy_run_in_thread(args):
+    """ deploy a single run in a worker thread, named after the run (so that log records are attributable) """
+    run = args[0]
+    thread = threading.current_thread()
+    thread_name = thread.name
+    thread.name = "{0}_{1}".format(run["id"], run["name"])
+    try:
+        return run, _deploy_run(*args)
+    finally:
+        thread.name = thread_name
+
+
+def deploy_runs(runs, root_path, if_exists="abort", exec_errors=False, test_run=False, max_workers=1,
+                store=False, qsub_array=False, qsub_batch=True, qsub_pack=0, ledger=None):
     """
 
     Parameters
     ----------
-    runs: list
-        runs
+    runs: iterable of dict
+        runs (consumed lazily, e.g. from config_yaml.iter_config_yaml)
     root_path: str or path_like
         the path of the config file
     if_exists: ["abort", "remove", "use"]
@@ -194,43 +420,164 @@ def deploy_runs(runs, root_path, if_exists="abort", exec_errors=False, test_run=
         if True, raise Error if exec commands return with errorcode
     test_run: bool
         if True, don't run any executables
+    max_workers: int
+        the maximum number of runs to deploy concurrently (in a thread pool).
+        Note, if an exception is raised by one run, runs already in progress will still complete
+        (and any qsub runs already deployed are still submitted, before the exception is raised)
+    store: bool
+        if True, input files are stored once per output root (by content hash),
+        and linked into each run's output directory (see create_output_dir)
+    qsub_array: bool
+        if True, qsub runs sharing the same output location and resources are submitted as PBS job arrays
+    qsub_batch: bool
+        if True, qsub runs are submitted once all runs are deployed, with one shell session per host
+        (rather than one per run, as each is deployed). This is implied by qsub_array and qsub_pack
+    qsub_pack: int
+        if greater than 1, (single node) qsub runs sharing the same output location and resources
+        are packed into single jobs, of up to this many runs, which run concurrently (one per core)
+    ledger: None or atomic_hpc.ledger.JobLedger
+        if not None, submitted qsub runs are recorded in the ledger
 
     Returns
     -------
+    jobids: dict
+        {run id: job id} for submitted qsub runs
+
     """
     if if_exists not in ["abort", "remove", "use"]:
         raise ValueError("if_exists must be one of; abort, remove or append")
+    if max_workers < 1:
+        raise ValueError("max_workers must be greater than 0")
     failed_runs = []
-
-    for run in runs:
-
-        logger.info("gathering inputs for run: {0}: {1}".format(run["id"], run["name"]))
-
-        # get inputs
-        inputs = get_inputs(run, root_path)
-        fnames = list(inputs["scripts"].keys())
-        fnames += list(inputs["files"].keys())
-        if not len(set(fnames)) == len(fnames):
-            logging.critical("aborting run: there is a script or file name clash in the inputs: {}".format(fnames))
+    qsub_runs = []
+    # input contents are shared between runs, so that each unique input is only read once
+    cache = InputCache()
+    if qsub_array and qsub_pack > 1:
+        raise ValueError("qsub runs cannot be both submitted as job arrays and packed")
+    submit = not (qsub_array or qsub_batch or qsub_pack > 1)
+    jobids = {}
+
+    def collect(run, success):
+        if not success:
             failed_runs.append("{0}: {1}".format(run["id"], run["name"]))
-            continue
-
-        if run["environment"] in ["unix", "windows"]:
-            if not deploy_run_normal(run, inputs, root_path, if_exists=if_exists, exec_errors=exec_errors,
-                                     test_run=test_run):
-                failed_runs.append("{0}: {1}".format(run["id"], run["name"]))
         elif run["environment"] == "qsub":
-            if not deploy_run_qsub(run, inputs, root_path, if_exists=if_exists, exec_errors=exec_errors,
-                                   test_run=test_run):
+            qsub_runs.append(run)
+
+    def submit_deployed():
+        if not submit and qsub_runs and not test_run:
+            failed, batch_jobids = submit_qsub_runs(qsub_runs, root_path, exec_errors, array=qsub_array,
+                                                    pack=qsub_pack)
+            jobids.update(batch_jobids)
+            for run in failed:
                 failed_runs.append("{0}: {1}".format(run["id"], run["name"]))
-        else:
-            raise ValueError("unknown environment: {}".format(run["environment"]))
+
+        if ledger is not None and jobids:
+            try:
+                ledger.record_many([(run, jobids[run["id"]]) for run in qsub_runs if run["id"] in jobids])
+            except sqlite3.Error as err:
+                # the jobs have already been submitted, so this should not abort the deployment
+                logger.error("could not record the submitted jobs in the ledger: {0}: {1}".format(ledger.path, err))
+
+    pool = None
+    if max_workers == 1:
+        results = ((run, _deploy_run(run, root_path, if_exists, exec_errors, test_run, cache, store, submit, jobids))
+                   for run in runs)
+    else:
+        pool = ThreadPool(max_workers)
+        args = ((run, root_path, if_exists, exec_errors, test_run, cache, store, submit, jobids) for run in runs)
+        results = pool.imap(_deploy_run_in_thread, args)
+    deployed = False
+    try:
+        try:
+            for run, success in results:
+                collect(run, success)
+            deployed = True
+        finally:
+            if pool is not None:
+                if not deployed:
+                    # the pool still deploys the remaining runs, so collect them (to be submitted)
+                    while True:
+                        try:
+                            run, success = next(results)
+                        except StopIteration:
+                            break
+                        except Exception as err:
+                            logger.error("run deployment failed: {}".format(err))
+                        else:
+                            collect(run, success)
+                pool.close()
+                pool.join()
+    finally:
+        if not deployed:
+            # runs already deployed must still be submitted, since a rerun (with if_exists="abort") would skip them
+            try:
+                submit_deployed()
+            except Exception as err:
+                logger.error("could not submit the deployed qsub runs: {}".format(err))
+    logger.debug("input cache: {0} hits, {1} misses".format(cache.hits, cache.misses))
+
+    submit_deployed()
 
     if failed_runs:
         raise RuntimeError("The following runs did not complete: \n{}".format("\n".join(failed_runs)))
 
+    return jobids
+
+
+# the directory, in each output root, of the content-addressed input store
+_STORE_NAME = ".atomic_hpc_store"
+
+
+def _store_input(folder, outdir, fname, fcontent, fstat):
+    """ add an input file to the content-addressed store (if not already present), then link it into outdir
+
+    Parameters
+    ----------
+    folder: atomic_hpc.context_folder.abstract.VirtualDir
+    outdir: str
+    fname: str
+    fcontent: str or BinaryRef
+    fstat: object
+
+    Returns
+    -------
 
-def create_output_dir(folder, run, if_exists, files, scripts):
+    """
+    if isinstance(fcontent, BinaryRef):
+        digest = fcontent.checksum()
+    else:
+        digest = hashlib.sha256(fcontent if isinstance(fcontent, bytes) else fcontent.encode("utf-8")).hexdigest()
+    entry = os.path.join(_STORE_NAME, digest)
+
+    if not folder.exists(entry):
+        logger.debug("adding {0} to input store: {1}".format(fname, digest))
+        # populate a temporary entry then rename it, so that concurrent runs never link to a partial file
+        tmpentry = os.path.join(_STORE_NAME, "tmp-{}".format(uuid.uuid4().hex))
+        folder.makedirs(tmpentry)
+        if isinstance(fcontent, BinaryRef):
+            fcontent.copy_to(folder, tmpentry)
+        else:
+            with folder.open(os.path.join(tmpentry, fname), 'w') as f:
+                f.write(fcontent)
+        folder.chmod(os.path.join(tmpentry, fname), fstat.st_mode)
+        try:
+            folder.rename(tmpentry, digest)
+        except (IOError, OSError):
+            if not folder.exists(entry):
+                raise
+            folder.rmtree(tmpentry)
+
+    stored = os.path.join(entry, fname)
+    if not folder.exists(stored):
+        # the same content was first stored under a different file name
+        stored = next(iter(folder.glob(os.path.join(entry, "*"))))
+    outpath = os.path.join(outdir, fname)
+    if folder.exists(outpath):
+        folder.remove(outpath)
+    folder.link(stored, outpath)
+
+
+def create_output_dir(folder, run, if_exists, files, scripts, store=False):
     """
 
     Parameters
@@ -240,6 +587,10 @@ def create_output_dir(folder, run, if_exists, files, scripts):
     if_exists: ["abort", "remove", "use"]
     files: dict
     scripts: dict
+    store: bool
+        if True, files are stored once in the content-addressed store of the folder
+        (.atomic_hpc_store/<sha256>), and hard linked into the output directory
+        (falling back to copies). NB: runs must not modify their input files in place
 
     Returns
     -------
@@ -270,12 +621,18 @@ def create_output_dir(folder, run, if_exists, files, scripts):
         yaml.indent(mapping=2, sequence=4, offset=2)
         run["config_version"] = atomic_hpc.__version__
         run["created"] = time.strftime("%c")
-        yaml.dump(run, f)
+        yaml.dump(run.to_dict() if isinstance(run, RunMapping) else run, f)
 
     for fname, (fcontent, fstat) in files.items():
-        with folder.open(os.path.join(outdir, fname), 'w') as f:
-            f.write(fcontent)
-        folder.chmod(os.path.join(outdir, fname), fstat.st_mode)
+        if store:
+            _store_input(folder, outdir, fname, fcontent, fstat)
+        elif isinstance(fcontent, BinaryRef):
+            fcontent.copy_to(folder, outdir)
+            folder.chmod(os.path.join(outdir, fname), fstat.st_mode)
+        else:
+            with folder.open(os.path.join(outdir, fname), 'w') as f:
+                f.write(fcontent)
+            folder.chmod(os.path.join(outdir, fname), fstat.st_mode)
 
     for sname, (scontent, sstat) in scripts.items():
         with folder.open(os.path.join(outdir, sname), 'w') as f:
@@ -285,7 +642,7 @@ def create_output_dir(folder, run, if_exists, files, scripts):
     return outdir
 
 
-def deploy_run_normal(run, inputs, root_path, if_exists="abort", exec_errors=False, test_run=False):
+def deploy_run_normal(run, inputs, root_path, if_exists="abort", exec_errors=False, test_run=False, store=False):
     """ deploy run and child runs (recursively)
 
     Parameters
@@ -301,6 +658,8 @@ def deploy_run_normal(run, inputs, root_path, if_exists="abort", exec_errors=Fal
         if True, raise Error if exec commands return with errorcode
     test_run: bool
         if True, don't run any executables
+    store: bool
+        if True, link input files from the output root's content-addressed store (see create_output_dir)
 
     Returns
     -------
@@ -335,7 +694,7 @@ def deploy_run_normal(run, inputs, root_path, if_exists="abort", exec_errors=Fal
         logger.info("executing run: {0}: {1}".format(run["id"], run["name"]))
 
         # create output folder
-        outdir = create_output_dir(folder, run, if_exists, files, scripts)
+        outdir = create_output_dir(folder, run, if_exists, files, scripts, store=store)
         if not outdir:
             return False
 
@@ -393,10 +752,16 @@ echo "<qstat -f $PBS_JOBID>"
 qstat -f $PBS_JOBID
 echo "</qstat -f $PBS_JOBID>"
 
-# number of cores per node used
-export NCORES={ncores}
-# number of processes
-export NPROCESSES={nprocs}
+if [ -n "${{ATOMIC_HPC_PACKED:-}}" ]; then
+    # the run is packed with others into a single job, with one core per run
+    export NCORES=1
+    export NPROCESSES=1
+else
+    # number of cores per node used
+    export NCORES={ncores}
+    # number of processes
+    export NPROCESSES={nprocs}
+fi
 
 # Make sure any symbolic links are resolved to absolute path
 readlink -f "." &> /dev/null || readlink_fail=true
@@ -417,6 +782,8 @@ echo Running: {run_name}
 {load_modules}
 
 start_in_temp={start_in_temp}
+# the maximum number of concurrent copies, when staging files to/from $TMPDIR
+stage_parallel={stage_parallel}
 
 if [ "$start_in_temp" = true ] ; then
 
@@ -429,6 +796,10 @@ if [ "$start_in_temp" = true ] ; then
         exit 1
     fi
     echo "running in: $TMPDIR"
+
+    # select the input files to copy (from the top-level of the working directory)
+    cd {wrkpath}
+{stage_in}
     cd $TMPDIR
     
     # copy required input files from $WORKDIR to $TMPDIR
@@ -443,14 +814,25 @@ if [ "$start_in_temp" = true ] ; then
         unset IFS
         # echo "running on nodes: ${{PCLIST[*]}}"
 
+        # the copy command for the remote shell, with each file name quoted
+        if [ ${{#STAGE_IN[@]}} -gt 0 ]; then
+            STAGE_IN_CMND="cp -pR $(printf '%q ' "${{STAGE_IN[@]}}") $(printf '%q' "$TMPDIR")"
+        else
+            STAGE_IN_CMND="true"
+        fi
+
+        # copy to the nodes concurrently
         for PC in "${{PCLIST[@]}}"; do
+            while [ "$(jobs -rp | wc -l)" -ge "$stage_parallel" ]; do
+                # wait -n requires bash >= 4.3
+                wait -n 2> /dev/null || sleep 1
+            done
             echo "copying input files to node $PC"
-            ssh $PC "if [ ! -d $TMPDIR ];then mkdir -p $TMPDIR;echo 'temporary directory on '$PC;fi"
-            ssh $PC cp -pR {wrkpath}/* $TMPDIR
-            # echo `ssh $PC ls $TMPDIR`
+            ssh $PC "if [ ! -d $TMPDIR ];then mkdir -p $TMPDIR;echo 'temporary directory on '$PC;fi; cd {wrkpath} && $STAGE_IN_CMND" &
         done
-    else
-        cp -pR {wrkpath}/* $TMPDIR
+        wait
+    elif [ ${{#STAGE_IN[@]}} -gt 0 ]; then
+        (cd {wrkpath} && cp -pR "${{STAGE_IN[@]}}" $TMPDIR)
     fi
 
 else
@@ -471,8 +853,19 @@ fi
 
 if [ "$start_in_temp" = true ] ; then
 
-    # copy output files from $TMPDIR to $WORKDIR
-    cp -pR $TMPDIR/* {wrkpath}
+    # select the output files to copy (from the top-level of $TMPDIR)
+    cd $TMPDIR
+{stage_out}
+
+    # copy output files from $TMPDIR to $WORKDIR (each top-level path concurrently)
+    for path in "${{STAGE_OUT[@]}}"; do
+        while [ "$(jobs -rp | wc -l)" -ge "$stage_parallel" ]; do
+            # wait -n requires bash >= 4.3
+            wait -n 2> /dev/null || sleep 1
+        done
+        cp -pR "$path" {wrkpath} &
+    done
+    wait
     
     cd {wrkpath}
     
@@ -531,21 +924,6 @@ def _create_qsub(run, wrkpath, cmnds):
 
     # get qsub options
     jobname = qsub["jobname"] if qsub["jobname"] is not None else '{0}_{1}'.format(run["id"], run["name"])
-    walltime = _resolve_walltime(qsub["walltime"])
-    nnodes = qsub["nnodes"]
-    ncores = qsub["cores_per_node"]
-    nprocs = nnodes * ncores
-    additional_resources = ""
-    if qsub["tmpspace"] is not None:
-        additional_resources += ":tmpspace={}".format(qsub["tmpspace"])
-    if qsub["memory_per_node"] is not None:
-        additional_resources += ":mem={}".format(qsub["memory_per_node"])
-    pbs_optional = ""
-    pbs_optional += "#PBS -q " + qsub["queue"] if qsub["queue"] is not None else "\n"
-    # Sends email to the submitter when the job begins/ends/aborts
-    if qsub.get("email", None) is not None:
-        pbs_optional += "#PBS -M {}\n".format(qsub["email"])
-        pbs_optional += "#PBS -m bae\n"
 
     run_name = '{0}_{1}'.format(run["id"], run["name"])
 
@@ -553,6 +931,9 @@ def _create_qsub(run, wrkpath, cmnds):
     load_modules = "module load " + " ".join(qsub["modules"]) if qsub["modules"] is not None else ""
 
     start_in_temp = "true" if qsub["start_in_temp"] else "false"
+    stage_parallel = qsub["stage_parallel"]
+    stage_in = _stage_select("STAGE_IN", **qsub["stage_in"])
+    stage_out = _stage_select("STAGE_OUT", **qsub["stage_out"])
 
     # exec runs
     exec_run = "\n".join(cmnds).replace("@{wrkpath}", wrkpath)
@@ -574,20 +955,271 @@ def _create_qsub(run, wrkpath, cmnds):
             rnlist.append(rncmnd.format(inname=inname, outname=outname))
     rename = "\n".join(rnlist)
 
-    out = _qsub_top_template.format(run_name=run_name, wrkpath=wrkpath,
-                                    jobname=jobname, walltime=walltime, nnodes=nnodes,
-                                    ncores=ncores, nprocs=nprocs, additional_resources=additional_resources,
-                                    pbs_optional=pbs_optional,
+    out = _qsub_top_template.format(run_name=run_name, wrkpath=wrkpath, jobname=jobname,
                                     load_modules=load_modules, start_in_temp=start_in_temp,
-                                    exec_run=exec_run, remove=remove, rename=rename)
+                                    stage_parallel=stage_parallel, stage_in=stage_in, stage_out=stage_out,
+                                    exec_run=exec_run, remove=remove, rename=rename,
+                                    **_qsub_resources(qsub))
     return out
 
 
+def _quote_glob(pattern):
+    """ escape a glob pattern for a bash case statement, so that only its wildcards (``*``, ``?`` and ``[...]``)
+    are special
+
+    Parameters
+    ----------
+    pattern: str
+
+    Returns
+    -------
+    pattern: str
+
+    Examples
+    --------
+    >>> print(_quote_glob("out put;rm -rf .)|*.[ch]"))
+    out\\ put\\;rm\\ -rf\\ .\\)\\|*.[ch]
+
+    """
+    escaped = []
+    for char in pattern:
+        if char.isalnum() or char in "*?[]!^_.-/":
+            escaped.append(char)
+        elif char == "\n":
+            # a backslash-newline would be removed, as a line continuation
+            escaped.append("$'\\n'")
+        else:
+            escaped.append("\\" + char)
+    return "".join(escaped)
+
+
+def _stage_select(name, include=None, exclude=None):
+    """ bash lines, to select the top-level paths of the current directory into an array,
+    by include and exclude glob patterns (exclusion taking precedence)
+
+    Parameters
+    ----------
+    name: str
+        the name of the bash array
+    include: None or list of str
+        if None, include all paths
+    exclude: None or list of str
+
+    Returns
+    -------
+    lines: str
+
+    Examples
+    --------
+    >>> print(_stage_select("STAGE_IN", exclude=["config_*.yaml"]))
+        STAGE_IN=()
+        for path in *; do
+            case "$path" in
+                config_*.yaml) ;;
+                *) STAGE_IN+=("$path");;
+            esac
+        done
+
+    """
+    lines = ['{}=()'.format(name), 'for path in *; do', '    case "$path" in']
+    if exclude:
+        lines.append('        {}) ;;'.format("|".join([_quote_glob(pattern) for pattern in exclude])))
+    lines.append('        {0}) {1}+=("$path");;'.format(
+        "|".join([_quote_glob(pattern) for pattern in include or ["*"]]), name))
+    lines += ['    esac', 'done']
+    return "\n".join(["    " + line for line in lines])
+
+
+def _qsub_resources(qsub):
+    """ get the PBS resource options
+
+    Parameters
+    ----------
+    qsub: dict
+        conforming to the process qsub schema
+
+    Returns
+    -------
+    resources: dict
+        with keys; walltime, nnodes, ncores, nprocs, additional_resources, pbs_optional
+
+    """
+    walltime = _resolve_walltime(qsub["walltime"])
+    nnodes = qsub["nnodes"]
+    ncores = qsub["cores_per_node"]
+    nprocs = nnodes * ncores
+    additional_resources = ""
+    if qsub["tmpspace"] is not None:
+        additional_resources += ":tmpspace={}".format(qsub["tmpspace"])
+    if qsub["memory_per_node"] is not None:
+        additional_resources += ":mem={}".format(qsub["memory_per_node"])
+    pbs_optional = ""
+    pbs_optional += "#PBS -q " + qsub["queue"] if qsub["queue"] is not None else "\n"
+    # Sends email to the submitter when the job begins/ends/aborts
+    if qsub.get("email", None) is not None:
+        pbs_optional += "#PBS -M {}\n".format(qsub["email"])
+        pbs_optional += "#PBS -m bae\n"
+    return dict(walltime=walltime, nnodes=nnodes, ncores=ncores, nprocs=nprocs,
+                additional_resources=additional_resources, pbs_optional=pbs_optional)
+
+
+# the qsub options which must be shared by runs, to be submitted in the same job array
+_QSUB_ARRAY_RESOURCES = ("walltime", "nnodes", "cores_per_node", "tmpspace", "memory_per_node", "queue", "email")
+
+_qsub_array_template = """#!/bin/bash --login
+#PBS -N {jobname:.14}
+#PBS -l walltime={walltime}
+#PBS -l select={nnodes}:ncpus={ncores}{additional_resources}
+#PBS -j oe
+#PBS -J 1-{njobs}
+{pbs_optional}
+
+# the working directory of each run, selected by the array index
+WRKPATHS=(
+{wrkpaths}
+)
+WRKPATH=${{WRKPATHS[$((PBS_ARRAY_INDEX - 1))]}}
+
+echo "array index $PBS_ARRAY_INDEX running in: $WRKPATH"
+cd "$WRKPATH"
+# the output of each sub-job is kept with its run (rather than in the directory the array was submitted from)
+exec bash --login run.qsub > run.qsub.out 2>&1
+"""
+
+
+def _create_qsub_array(runs, wrkpaths):
+    """ create a dispatcher script, to run multiple runs (sharing the same resources) as a PBS job array
+
+    each sub-job executes the run.qsub in the working directory selected by $PBS_ARRAY_INDEX
+
+    Parameters
+    ----------
+    runs: list of dict
+    wrkpaths: list of str
+        absolute path of the working directory of each run
+
+    Returns
+    -------
+    qsub: str
+        contents of qsub file
+
+    """
+    jobname = "array_{0}-{1}".format(runs[0]["id"], runs[-1]["id"])
+    return _qsub_array_template.format(jobname=jobname, njobs=len(runs),
+                                       wrkpaths="\n".join([quote(p) for p in wrkpaths]),
+                                       **_qsub_resources(runs[0]["process"]["qsub"]))
+
+
+def _qsub_array_key(run):
+    """ the key to group runs by, for submission in the same job array """
+    remote = run["output"]["remote"]
+    qsub = run["process"]["qsub"]
+    return (None if remote is None else tuple(sorted(remote.items())), run["output"]["path"],
+            tuple([qsub.get(name, None) for name in _QSUB_ARRAY_RESOURCES]))
+
+
+_qsub_pack_template = """#!/bin/bash --login
+#PBS -N {jobname:.14}
+#PBS -l walltime={walltime}
+#PBS -l select=1:ncpus={ncores}{additional_resources}
+#PBS -j oe
+{pbs_optional}
+
+# the working directory of each run
+WRKPATHS=(
+{wrkpaths}
+)
+
+# run (at most) NCORES runs concurrently, as background processes
+NCORES={ncores}
+JOBTMPDIR="${{TMPDIR:-}}"
+
+for WRKPATH in "${{WRKPATHS[@]}}"; do
+    while [ "$(jobs -rp | wc -l)" -ge "$NCORES" ]; do
+        # wait -n requires bash >= 4.3
+        wait -n 2> /dev/null || sleep 1
+    done
+    echo "running in: $WRKPATH"
+    (
+        cd "$WRKPATH"
+        # each run has its own temporary directory, and runs on a single core of a single node
+        if [ -n "$JOBTMPDIR" ]; then
+            export TMPDIR="$JOBTMPDIR/$(basename "$WRKPATH")"
+            mkdir -p "$TMPDIR"
+        fi
+        unset PBS_NODEFILE
+        export ATOMIC_HPC_PACKED=1
+        bash --login run.qsub > run.qsub.out 2>&1
+        echo "finished (exit status $?): $WRKPATH"
+    ) &
+done
+wait
+"""
+
+
+def _scale_walltime(walltime, factor):
+    """ multiply a walltime, in format HH:MM:SS, by an integer factor
+
+    Parameters
+    ----------
+    walltime: str
+    factor: int
+
+    Returns
+    -------
+    walltime: str
+
+    Examples
+    --------
+    >>> _scale_walltime("1:30:00", 3)
+    '4:30:00'
+
+    """
+    hours, minutes, seconds = [int(c) for c in _resolve_walltime(walltime).split(":")]
+    seconds = (hours * 3600 + minutes * 60 + seconds) * factor
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def _create_qsub_pack(runs, wrkpaths):
+    """ create a script, to run multiple runs (sharing the same resources) concurrently within a single PBS job
+
+    the job requests a single node, with the runs' cores_per_node, and runs one run per core at a time
+    (each executing the run.qsub in its working directory). The walltime is scaled by the number of 'waves' of runs
+
+    Parameters
+    ----------
+    runs: list of dict
+    wrkpaths: list of str
+        absolute path of the working directory of each run
+
+    Returns
+    -------
+    qsub: str
+        contents of qsub file
+
+    """
+    jobname = "pack_{0}-{1}".format(runs[0]["id"], runs[-1]["id"])
+    resources = _qsub_resources(runs[0]["process"]["qsub"])
+    waves = -(-len(runs) // resources["ncores"])
+    resources["walltime"] = _scale_walltime(resources["walltime"], waves)
+    return _qsub_pack_template.format(jobname=jobname,
+                                      wrkpaths="\n".join([quote(p) for p in wrkpaths]),
+                                      **resources)
+
+
 #_QSUB_CMNDLINE = "source /etc/bashrc; source /etc/profile; qsub run.qsub"
 _QSUB_CMNDLINE = 'bash -l -c "qsub run.qsub"'
+# for submitting multiple qsub files in one execution
+_QSUB_BATCH_CMNDLINE = 'bash -l -c {script}'
+# the maximum length of a batch script (a single command line argument is limited to 128 KB on Linux)
+_QSUB_BATCH_MAX_LENGTH = 100000
+_QSUB_SUBMIT = 'qsub {qsub_file}'
+_QSUB_SUBMITTED = "atomic_hpc_qsub_submitted"
+_QSUB_FAILED = "atomic_hpc_qsub_failed"
 
 
-def deploy_run_qsub(run, inputs, root_path, if_exists="abort", exec_errors=False, test_run=False):
+def deploy_run_qsub(run, inputs, root_path, if_exists="abort", exec_errors=False, test_run=False, store=False,
+                    submit=True, jobids=None):
     """ deploy run and child runs (recursively)
 
     Parameters
@@ -603,6 +1235,12 @@ def deploy_run_qsub(run, inputs, root_path, if_exists="abort", exec_errors=False
         if True, abort run if exec commands return with errorcode
     test_run: bool
         if True, don't run any executables
+    store: bool
+        if True, link input files from the output root's content-addressed store (see create_output_dir)
+    submit: bool
+        if False, only create the run.qsub file (e.g. for later submission in a job array)
+    jobids: None or dict
+        if a dict, the job id of the submitted run is added to it, as {run id: job id}
 
     Returns
     -------
@@ -636,7 +1274,7 @@ def deploy_run_qsub(run, inputs, root_path, if_exists="abort", exec_errors=False
         logger.info("executing qsub run: {0}: {1}".format(run["id"], run["name"]))
 
         # create output folder
-        outdir = create_output_dir(folder, run, if_exists, files, scripts)
+        outdir = create_output_dir(folder, run, if_exists, files, scripts, store=store)
         if not outdir:
             return False
 
@@ -648,13 +1286,21 @@ def deploy_run_qsub(run, inputs, root_path, if_exists="abort", exec_errors=False
 
         if test_run:
             logger.info("test_run=True, so skipping command line execution")
+        elif not submit:
+            logger.info("submit=False, so skipping qsub submission")
         else:
             # run
             cmndline = _QSUB_CMNDLINE
             getattr(logger, "exec")("{0}-{1} running cmnd: {2}".format(run["id"], run["name"], cmndline))
+            stdout = []
             try:
-                folder.exec_cmnd(cmndline, outdir, raise_error=True)
-                logger.info("successfully submitted: {}".format(cmndline))
+                folder.exec_cmnd(cmndline, outdir, raise_error=True, stdout=stdout)
+                # qsub prints the job id (as its last line of output)
+                stdout = [line.strip() for line in stdout if line.strip()]
+                jobid = stdout[-1] if stdout else None
+                logger.info("successfully submitted: {0} as job: {1}".format(cmndline, jobid))
+                if jobids is not None and jobid is not None:
+                    jobids[run["id"]] = jobid
             except RuntimeError:
                 if exec_errors:
                     logger.critical("aborting run on command line failure: {}".format(cmndline))
@@ -664,28 +1310,278 @@ def deploy_run_qsub(run, inputs, root_path, if_exists="abort", exec_errors=False
     return True
 
 
-# TODO add tests for retrieve_outputs
-def retrieve_outputs(runs, local_path, root_path, if_exists="abort", path_regex="*", ignore_regex=None):
-    """
+def _output_kwargs(run, root_path):
+    """ the keyword arguments for context_folder.change_dir, to open the output folder of a run """
+    outpath = "" if run["output"]["path"] is None else run["output"]["path"]
+    if run["output"]["remote"] is None:
+        return dict(path=root_path.joinpath(outpath))
+    remote = run["output"]["remote"].copy()
+    hostname = remote.pop("hostname")
+    return dict(path=outpath, remote=True, hostname=hostname, **remote)
+
+
+def submit_qsub_runs(runs, root_path, exec_errors=False, array=False, pack=0):
+    """ submit deployed qsub runs (see deploy_run_qsub with submit=False),
+    with a single shell session (execution) per host
 
     Parameters
     ----------
     runs: list
         runs
+    root_path: str or path_like
+        the path to resolve (local) relative paths from
+    exec_errors: bool
+        if True, consider runs failed if their submission fails
+    array: bool
+        if True, runs with the same output location and resources are grouped into PBS job arrays
+    pack: int
+        if greater than 1, (single node) runs with the same output location and resources
+        are packed into single jobs, of up to this many runs, which run the runs concurrently (one per core)
+
+    Returns
+    -------
+    failed: list
+        the runs that failed to be submitted
+    jobids: dict
+        {run id: job id} for the submitted runs
+
+    """
+    if array and pack > 1:
+        raise ValueError("runs cannot be both submitted as job arrays and packed")
+    if isinstance(root_path, basestring):
+        root_path = pathlib.Path(root_path)
+
+    hosts = OrderedDict()
+    for run in runs:
+        remote = run["output"]["remote"]
+        hosts.setdefault(None if remote is None else tuple(sorted(remote.items())), []).append(run)
+
+    failed = []
+    jobids = {}
+    for host_runs in hosts.values():
+
+        # (runs, absolute directory to submit from, qsub file)
+        submissions = []
+        outpaths = OrderedDict()
+        for run in host_runs:
+            outpaths.setdefault(run["output"]["path"], []).append(run)
+        for outpath_runs in outpaths.values():
+            kwargs = _output_kwargs(outpath_runs[0], root_path)
+            with context_folder.change_dir(**kwargs) as folder:
+                if array:
+                    groups = OrderedDict()
+                    for run in outpath_runs:
+                        groups.setdefault(_qsub_array_key(run), []).append(run)
+                    groups = list(groups.values())
+                elif pack > 1:
+                    groups = OrderedDict()
+                    for run in outpath_runs:
+                        if run["process"]["qsub"]["nnodes"] == 1:
+                            groups.setdefault(_qsub_array_key(run), []).append(run)
+                        else:
+                            groups[run["id"]] = [run]
+                    groups = [group[i:i + pack] for group in groups.values() for i in range(0, len(group), pack)]
+                else:
+                    groups = [[run] for run in outpath_runs]
+                for group in groups:
+                    outdirs = ["{0}_{1}".format(r["id"], r["name"]) for r in group]
+                    if len(group) == 1:
+                        submissions.append((group, folder.getabs(outdirs[0]), "run.qsub"))
+                        continue
+                    if array:
+                        qsub_file = "array_{0}-{1}.qsub".format(group[0]["id"], group[-1]["id"])
+                        qsub = _create_qsub_array(group, [folder.getabs(outdir) for outdir in outdirs])
+                    else:
+                        qsub_file = "pack_{0}-{1}.qsub".format(group[0]["id"], group[-1]["id"])
+                        qsub = _create_qsub_pack(group, [folder.getabs(outdir) for outdir in outdirs])
+                    with folder.open(qsub_file, 'w') as f:
+                        f.write(unicode(qsub))
+                    submissions.append((group, folder.getabs("."), qsub_file))
+
+        # submit all qsub files, from one (login) shell per batch of submissions
+        batches = [[]]
+        length = 0
+        for i, (_, dirpath, qsub_file) in enumerate(submissions):
+            line = 'cd {0} && jobid=$({1}) && echo "{2} {3} $jobid" || echo "{4} {3}"'.format(
+                quote(dirpath), _QSUB_SUBMIT.format(qsub_file=quote(qsub_file)),
+                _QSUB_SUBMITTED, i, _QSUB_FAILED)
+            if length + len(quote(line)) > _QSUB_BATCH_MAX_LENGTH and batches[-1]:
+                batches.append([])
+                length = 0
+            batches[-1].append(line)
+            length += len(quote(line)) + 1
+        stdout = []
+        with context_folder.change_dir(**kwargs) as folder:
+            for batch in batches:
+                cmndline = _QSUB_BATCH_CMNDLINE.format(script=quote("\n".join(batch)))
+                getattr(logger, "exec")("submitting {0} qsub files: {1}".format(len(batch), cmndline))
+                folder.exec_cmnd(cmndline, ".", stdout=stdout)
+
+        submitted = {}
+        for line in stdout:
+            fields = line.split()
+            if len(fields) == 3 and fields[0] == _QSUB_SUBMITTED:
+                submitted[int(fields[1])] = fields[2]
+
+        for i, (group, dirpath, qsub_file) in enumerate(submissions):
+            run_ids = ", ".join([str(r["id"]) for r in group])
+            if i in submitted:
+                logger.info("successfully submitted runs {0} as job: {1}".format(run_ids, submitted[i]))
+                for index, run in enumerate(group):
+                    jobid = submitted[i]
+                    if len(group) > 1 and array:
+                        # the sub-job of the array
+                        jobid = jobid.replace("[]", "[{}]".format(index + 1))
+                    jobids[run["id"]] = jobid
+            elif exec_errors:
+                logger.critical("aborting runs {0} on qsub failure: {1}".format(
+                    run_ids, os.path.join(dirpath, qsub_file)))
+                failed.extend(group)
+            else:
+                logger.error("qsub failure for runs {0}: {1}".format(run_ids, os.path.join(dirpath, qsub_file)))
+
+    return failed, jobids
+
+
+# the file name, in each local output directory, of the record of retrieved (synced) files
+_MANIFEST_NAME = ".atomic_hpc_manifest.json"
+
+
+def _sync_outputs(folder, pnames, outname, local_outpath, checksum=False, bulk=False, compress=False):
+    """ copy only new or changed files to the local output directory, and record them in its manifest
+
+    a file is unchanged if a local copy of the same size exists, and the remote modification time
+    matches either the manifest entry or the local copy (whose modification time is set on retrieval)
+
+    Parameters
+    ----------
+    folder: atomic_hpc.context_folder.abstract.VirtualDir
+    pnames: list of str
+        the paths to retrieve (files or directories)
+    outname: str
+        the run's output directory in folder
+    local_outpath: pathlib.Path
+        the local run output directory
+    checksum: bool
+        if True, files of the same size, but different modification time,
+        are compared by their sha256 checksums before copying
+    bulk: bool
+    compress: bool
+
+    Returns
+    -------
+
+    """
+    manifest_path = local_outpath.joinpath(_MANIFEST_NAME)
+    manifest = {}
+    if manifest_path.exists():
+        try:
+            with open(str(manifest_path)) as file_obj:
+                manifest = json.load(file_obj)
+        except ValueError:
+            logger.warning("ignoring corrupt manifest: {}".format(manifest_path))
+
+    changed = []
+    candidates = []
+    attrs = {}
+    for pname in pnames:
+        for fpath, attr in folder.walk_files(pname):
+            relpath = os.path.relpath(fpath, outname)
+            mtime = int(attr.st_mtime)
+            attrs[relpath] = (fpath, attr.st_size, mtime)
+            localfile = local_outpath.joinpath(relpath)
+            if not localfile.exists():
+                changed.append(relpath)
+                continue
+            local_stat = localfile.stat()
+            entry = manifest.get(relpath, {})
+            if local_stat.st_size != attr.st_size:
+                changed.append(relpath)
+            elif mtime == int(local_stat.st_mtime) or (entry.get("size"), entry.get("mtime")) == (attr.st_size, mtime):
+                continue
+            elif checksum:
+                candidates.append(relpath)
+            else:
+                changed.append(relpath)
+
+    checksums = {}
+    if candidates:
+        remote_sums = folder.checksums([attrs[relpath][0] for relpath in candidates])
+        with context_folder.change_dir(local_outpath) as local:
+            local_sums = local.checksums(candidates)
+        for relpath in candidates:
+            remote_sum = remote_sums.get(attrs[relpath][0])
+            if remote_sum is not None and remote_sum == local_sums[relpath]:
+                checksums[relpath] = remote_sum
+                localfile = str(local_outpath.joinpath(relpath))
+                os.utime(localfile, (attrs[relpath][2], attrs[relpath][2]))
+            else:
+                changed.append(relpath)
+
+    logger.info("{0} of {1} files in {2} are new or changed".format(len(changed), len(attrs), outname))
+
+    # group the files by their local directory, so that each group can be copied to a single target
+    groups = {}
+    for relpath in changed:
+        groups.setdefault(os.path.dirname(relpath), []).append(relpath)
+    for dirname, relpaths in sorted(groups.items()):
+        target = local_outpath.joinpath(dirname)
+        if not target.exists():
+            target.mkdir(parents=True)
+        fpaths = [attrs[relpath][0] for relpath in relpaths]
+        if bulk:
+            folder.copy_many_to(fpaths, target, compress=compress)
+        else:
+            for fpath in fpaths:
+                folder.copy_to(fpath, target)
+        for relpath in relpaths:
+            mtime = attrs[relpath][2]
+            os.utime(str(local_outpath.joinpath(relpath)), (mtime, mtime))
+
+    for relpath, (_, size, mtime) in attrs.items():
+        entry = {"size": size, "mtime": mtime}
+        if relpath in checksums:
+            entry["sha256"] = checksums[relpath]
+        elif relpath not in changed and manifest.get(relpath, {}).get("mtime") == mtime:
+            if "sha256" in manifest[relpath]:
+                entry["sha256"] = manifest[relpath]["sha256"]
+        manifest[relpath] = entry
+    with open(str(manifest_path), "w") as file_obj:
+        file_obj.write(json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def retrieve_outputs(runs, local_path, root_path, if_exists="abort", path_regex="*", ignore_regex=None,
+                     bulk=False, compress=False, checksum=False):
+    """
+
+    Parameters
+    ----------
+    runs: iterable of dict
+        runs (consumed lazily, e.g. from config_yaml.iter_config_yaml)
     local_path: str or path_like
         the path to output to
     root_path: str or path_like
         the path of the config file
-    if_exists: ["abort", "remove", "use"]
-        either; raise an IOError if the output path already exists, remove the output path or use it without change
+    if_exists: ["abort", "remove", "use", "sync"]
+        either; raise an IOError if the output path already exists, remove the output path, use it without change
+        or sync it (only copying new or changed files)
     path_regex: str
         regex to search for files
+    ignore_regex: None or list of str
+        file regexes to ignore (not copy)
+    bulk: bool
+        if True, copy all files for a run in a single transfer
+        (for remote hosts, as a tar stream over one ssh channel)
+    compress: bool
+        if True (and bulk), compress the transfer
+    checksum: bool
+        if True (and sync), compare files of the same size but different modification time by checksum
 
     Returns
     -------
     """
-    if if_exists not in ["abort", "remove", "use"]:
-        raise ValueError("if_exists must be one of; abort, remove or append")
+    if if_exists not in ["abort", "remove", "use", "sync"]:
+        raise ValueError("if_exists must be one of; abort, remove, use or sync")
     failed_runs = []
 
     if isinstance(local_path, basestring):
@@ -713,6 +1609,8 @@ def retrieve_outputs(runs, local_path, root_path, if_exists="abort", path_regex=
                     logger.info("removing existing output dir: {}".format(outname))
                     local.rmtree(outname)
                     local.makedirs(outname)
+                elif if_exists == "sync":
+                    logger.info("syncing existing output dir: {}".format(outname))
                 else:
                     logger.info("using existing output dir: {}".format(outname))
             else:
@@ -742,6 +1640,7 @@ def retrieve_outputs(runs, local_path, root_path, if_exists="abort", path_regex=
                 continue
 
             logger.info("copying {0} to {1}".format(outname, local_path))
+            pnames = []
             for pname in folder.glob(os.path.join(outname, path_regex)):
                 ignore = False
                 if ignore_regex:
@@ -751,9 +1650,107 @@ def retrieve_outputs(runs, local_path, root_path, if_exists="abort", path_regex=
                             ignore = True
                             break
                 if not ignore:
+                    pnames.append(pname)
+
+            if if_exists == "sync":
+                _sync_outputs(folder, pnames, outname, local_path.joinpath(outname),
+                              checksum=checksum, bulk=bulk, compress=compress)
+            elif bulk:
+                folder.copy_many_to(pnames, local_path.joinpath(outname), compress=compress)
+            else:
+                for pname in pnames:
                     folder.copy_to(pname, local_path.joinpath(outname))
-                
+
             logger.info("finished copying {0} to {1}".format(outname, local_path))
 
     if failed_runs:
         raise RuntimeError("The following runs did not complete: \n{}".format("\n".join(failed_runs)))
+
+
+def watch_outputs(runs, local_path, root_path, ledger, interval=60., max_transfers=1, path_regex="*",
+                  ignore_regex=None, bulk=False, compress=False, checksum=False):
+    """ watch the jobs of submitted qsub runs, and retrieve the outputs of each run as soon as its job finishes
+
+    Job states are polled in bulk (see atomic_hpc.job_status.poll_jobs),
+    and outputs are retrieved incrementally (see retrieve_outputs with if_exists="sync")
+
+    Parameters
+    ----------
+    runs: list
+        runs
+    local_path: str or path_like
+        the path to output to
+    root_path: str or path_like
+        the path of the config file
+    ledger: atomic_hpc.ledger.JobLedger
+        the ledger the runs' jobs were recorded in, at submission
+    interval: float
+        seconds between polls of the job states
+    max_transfers: int
+        the maximum number of runs to retrieve concurrently
+    path_regex: str
+        regex to search for files
+    ignore_regex: None or list of str
+        file regexes to ignore (not copy)
+    bulk: bool
+        if True, copy all files for a run in a single transfer
+    compress: bool
+        if True (and bulk), compress the transfer
+    checksum: bool
+        if True, compare files of the same size but different modification time by checksum
+
+    Returns
+    -------
+
+    """
+    if max_transfers < 1:
+        raise ValueError("max_transfers must be greater than 0")
+    runs = OrderedDict([(run["id"], run) for run in runs])
+    pending = set([job["run_id"] for job in ledger.jobs(list(runs.keys()))])
+    untracked = [rid for rid in runs if rid not in pending]
+    if untracked:
+        logger.warning("runs with no job recorded in the ledger will not be retrieved: {}".format(untracked))
+    kwargs = dict(if_exists="sync", path_regex=path_regex, ignore_regex=ignore_regex,
+                  bulk=bulk, compress=compress, checksum=checksum)
+    # the credentials for polling are not stored in the ledger
+    remotes = {rid: run["output"]["remote"] for rid, run in runs.items()}
+
+    failed_runs = []
+    in_flight = OrderedDict()
+    pool = ThreadPool(max_transfers)
+    try:
+        while pending or in_flight:
+
+            for rid, result in list(in_flight.items()):
+                if not result.ready():
+                    continue
+                del in_flight[rid]
+                try:
+                    result.get()
+                except Exception as err:
+                    # any failure (e.g. of the connection) only fails this run, the others carry on
+                    logger.error("failed retrieving run {0}: {1}: {2}".format(rid, runs[rid]["name"], err))
+                    failed_runs.append("{0}: {1}".format(rid, runs[rid]["name"]))
+
+            if pending:
+                for job in poll_jobs(ledger, sorted(pending), ttl=0, local_path=str(root_path), remotes=remotes):
+                    # jobs stay pending if they were not polled (e.g. qstat failed)
+                    if job["state"] in _FINAL_STATES:
+                        logger.info("job {0} finished for run: {1}: {2}".format(
+                            job["jobid"], job["run_id"], job["name"]))
+                        pending.discard(job["run_id"])
+                        in_flight[job["run_id"]] = pool.apply_async(
+                            retrieve_outputs, ([runs[job["run_id"]]], local_path, root_path), kwargs)
+                logger.info("{0} jobs pending, {1} runs retrieving".format(len(pending), len(in_flight)))
+
+            if pending:
+                time.sleep(interval)
+            else:
+                for result in in_flight.values():
+                    result.wait()
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed_runs:
+        raise RuntimeError("The following runs did not complete: \n{}".format("\n".join(failed_runs)))
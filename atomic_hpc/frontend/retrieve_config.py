@@ -5,8 +5,9 @@ import argparse
 import logging
 import logging.handlers
 from atomic_hpc import __version__
-from atomic_hpc.config_yaml import format_config_yaml
-from atomic_hpc.deploy_runs import retrieve_outputs
+from atomic_hpc.config_yaml import iter_config_yaml
+from atomic_hpc.deploy_runs import retrieve_outputs, watch_outputs
+from atomic_hpc.ledger import JobLedger, ledger_path
 from atomic_hpc.utils import cmndline_prompt, str2intlist
 from jsonschema import ValidationError
 
@@ -14,7 +15,9 @@ logger = logging.getLogger('atomic_hpc.retrieve_config')
 
 
 def run(fpath, runs=None, outpath="", basepath="", log_level='INFO',
-        if_exists="abort", path_regex="*", ignore_regex=None):
+        if_exists="abort", path_regex="*", ignore_regex=None,
+        bulk=False, compress=False, checksum=False,
+        watch=False, interval=60., max_transfers=1, cache=True):
     """
 
     Parameters
@@ -24,13 +27,29 @@ def run(fpath, runs=None, outpath="", basepath="", log_level='INFO',
     outpath: str
     basepath: str
     log_level: str
-    if_exists: ["abort", "remove", "use"]
+    if_exists: ["abort", "remove", "use", "sync"]
         either; raise an IOError if the output path already exists,
-        remove the output path or use it without change
+        remove the output path, use it without change
+        or sync it (only copying new or changed files)
    path_regex: str
         regex to search for files
    ignore_regex: None or list of str
         file regexes to ignore (not copy)
+    bulk: bool
+        copy all files for a run in a single transfer
+    compress: bool
+        compress bulk transfers
+    checksum: bool
+        when syncing, compare files with different modification times by checksum
+    watch: bool
+        watch the submitted qsub jobs, and sync the outputs of each run as soon as its job finishes
+    interval: float
+        if watch, seconds between polls of the job states
+    max_transfers: int
+        if watch, the maximum number of runs to retrieve concurrently
+    cache: bool
+        if True, cache the formatted config (keyed by its content), to be reused while the file is unchanged
+        (the runs are formatted lazily, one at a time, either way)
 
     Returns
     -------
@@ -67,19 +86,31 @@ def run(fpath, runs=None, outpath="", basepath="", log_level='INFO',
     fpath = os.path.abspath(fpath)
     basepath = os.path.abspath(basepath)
 
-    try:
-        runs_to_deploy = format_config_yaml(fpath, errormsg_only=True)
-    except ValidationError as err:
-        logger.critical(err)
+    # formatted lazily, one run at a time (so errors in the config are only raised, and reported, once reached),
+    # unless the whole config is already cached
+    runs_to_deploy = iter_config_yaml(fpath, errormsg_only=True, run_ids=runs, cache=cache)
+
+    if watch:
+        lpath = ledger_path(fpath)
+        if not os.path.exists(lpath):
+            logger.critical("no job ledger exists for the config (no qsub jobs have been submitted): {}".format(lpath))
+            return
+        with JobLedger(lpath) as ledger:
+            try:
+                watch_outputs(
+                    runs_to_deploy, outpath, basepath, ledger, interval=interval, max_transfers=max_transfers,
+                    path_regex=path_regex, ignore_regex=ignore_regex,
+                    bulk=bulk, compress=compress, checksum=checksum)
+            except (RuntimeError, ValidationError) as err:
+                logger.critical(err)
         return
-    if runs is not None:
-        runs_to_deploy = [r for r in runs_to_deploy if r["id"] in runs]
 
     try:
         retrieve_outputs(
             runs_to_deploy, outpath, basepath, if_exists=if_exists,
-            path_regex=path_regex, ignore_regex=ignore_regex)
-    except RuntimeError as err:
+            path_regex=path_regex, ignore_regex=ignore_regex,
+            bulk=bulk, compress=compress, checksum=checksum)
+    except (RuntimeError, ValidationError) as err:
         logger.critical(err)
 
 
@@ -117,12 +148,13 @@ def main(sys_args=None):
                         help=("subset of run ids, in delimited list, "
                               "e.g. -r 1,5-6,7"))
     parser.add_argument("-ie", "--if-exists", type=str, default='abort',
-                        choices=['abort', 'remove', 'use'],
+                        choices=['abort', 'remove', 'use', 'sync'],
                         help=(
                             "if a run's output directory already exists "
                             "either; abort the run, remove its contents, "
-                            "or use it without removal "
-                            "(existing files will be overwritten)"))
+                            "use it without removal "
+                            "(existing files will be overwritten), "
+                            "or sync it (only new or changed files are copied)"))
     parser.add_argument("-log", "--log-level", type=str, default='info',
                         choices=['debug_full', 'debug', 'info',
                                  'exec', 'warning', 'error'],
@@ -135,15 +167,35 @@ def main(sys_args=None):
     parser.add_argument("-ix", "--ignore-regex", type=str,
                         metavar='str', nargs='*',
                         help='file regexes to ignore')
+    parser.add_argument("--bulk", action="store_true",
+                        help=('copy the files for each run in a single transfer '
+                              '(for remote hosts, a tar stream over ssh)'))
+    parser.add_argument("--compress", action="store_true",
+                        help='compress bulk transfers')
+    parser.add_argument("--checksum", action="store_true",
+                        help=('when syncing, compare files with the same size '
+                              'but different modification times by checksum'))
+    parser.add_argument("--watch", action="store_true",
+                        help=('watch the submitted qsub jobs, and sync the outputs of each run '
+                              'as soon as its job finishes (ignores --if-exists)'))
+    parser.add_argument("--interval", type=float, default=60., metavar='SECONDS',
+                        help='with --watch, seconds between polls of the job states')
+    parser.add_argument("-n", "--max-transfers", type=int, default=1, metavar='N',
+                        help='with --watch, the maximum number of runs to retrieve concurrently')
     # parser.add_argument("--test-run", action="store_true",
     #                     help=('do not run any executables '
     # '(only create directories and create/copy files)'))
+    parser.add_argument("--no-cache", action="store_false", dest="cache",
+                        help=('do not use (or store) the cached, formatted config '
+                              '(by default, this is reused while the config file is unchanged)'))
     parser.add_argument('--version', action='version', version=__version__)
 
     args = parser.parse_args(sys_args)
     options = vars(args)
 
-    if options["if_exists"] == "remove":
+    if options["watch"]:
+        pass
+    elif options["if_exists"] == "remove":
         if not cmndline_prompt(
                 "Are you sure you wish to remove existing outputs?"):
             sys.exit()
@@ -6,15 +6,17 @@ import logging
 import logging.handlers
 from jsonschema import ValidationError
 from atomic_hpc import __version__
-from atomic_hpc.config_yaml import format_config_yaml
+from atomic_hpc.config_yaml import iter_config_yaml
 from atomic_hpc.deploy_runs import deploy_runs
+from atomic_hpc.ledger import JobLedger, ledger_path
 from atomic_hpc.utils import cmndline_prompt, str2intlist
 
 logger = logging.getLogger('atomic_hpc.run_config')
 
 
 def run(fpath, runs=None, basepath="", log_level='INFO',
-        ignore_fail=False, if_exists="abort", test_run=False):
+        ignore_fail=False, if_exists="abort", test_run=False, jobs=1, store=False,
+        qsub_array=False, qsub_batch=True, qsub_pack=0, cache=True):
     """
 
     Parameters
@@ -30,6 +32,21 @@ def run(fpath, runs=None, basepath="", log_level='INFO',
         remove the output path or use it without change
     test_run: bool
         if True don't run any executables
+    jobs: int
+        number of runs to deploy concurrently
+    store: bool
+        if True, store input files once per output root (by content hash),
+        and link them into each run's output directory
+    qsub_array: bool
+        if True, submit qsub runs with the same output location and resources as PBS job arrays
+    qsub_batch: bool
+        if True, submit qsub runs once all are deployed, with one shell session per host
+    qsub_pack: int
+        if greater than 1, pack (single node) qsub runs with the same output location and resources
+        into single jobs of up to this many runs, which run concurrently (one per core)
+    cache: bool
+        if True, cache the formatted config (keyed by its content), to be reused while the file is unchanged
+        (the runs are formatted lazily, one at a time, either way)
 
     Returns
     -------
@@ -47,7 +64,11 @@ def run(fpath, runs=None, basepath="", log_level='INFO',
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setLevel(getattr(logging, log_level.upper()))
     # TODO align messages
-    formatter = logging.Formatter('%(levelname)8s: %(module)10s: %(message)s')
+    if jobs > 1:
+        # prefix messages by the run (thread) they originate from
+        formatter = logging.Formatter('%(levelname)8s: %(module)10s: %(threadName)s: %(message)s')
+    else:
+        formatter = logging.Formatter('%(levelname)8s: %(module)10s: %(message)s')
     stream_handler.setFormatter(formatter)
     stream_handler.propogate = False
     if filter_ext:
@@ -66,23 +87,25 @@ def run(fpath, runs=None, basepath="", log_level='INFO',
     fpath = os.path.abspath(fpath)
     basepath = os.path.abspath(basepath)
 
-    try:
-        runs_to_deploy = format_config_yaml(fpath, errormsg_only=True)
-    except ValidationError as err:
-        logger.critical(err)
-        return
-
-    if runs is not None:
-        runs_to_deploy = [r for r in runs_to_deploy if r["id"] in runs]
+    # formatted lazily, one run at a time (so errors in the config are only raised, and reported, once reached),
+    # unless the whole config is already cached
+    runs_to_deploy = iter_config_yaml(fpath, errormsg_only=True, run_ids=runs, cache=cache)
 
     exec_errors = not ignore_fail
 
+    # submitted qsub jobs are recorded in a ledger next to the config file (only created if there are any)
+    ledger = None if test_run else JobLedger(ledger_path(fpath))
     try:
         deploy_runs(runs_to_deploy, basepath, if_exists=if_exists,
-                    exec_errors=exec_errors, test_run=test_run)
-    except RuntimeError as err:
+                    exec_errors=exec_errors, test_run=test_run, max_workers=jobs,
+                    store=store, qsub_array=qsub_array,
+                    qsub_batch=qsub_batch, qsub_pack=qsub_pack, ledger=ledger)
+    except (RuntimeError, ValidationError) as err:
         logger.critical(err)
         return
+    finally:
+        if ledger is not None:
+            ledger.close()
 
 
 class ErrorParser(argparse.ArgumentParser):
@@ -124,6 +147,8 @@ def main(sys_args=None):
                         help=(
                             'if a command line execution fails, '
                             'continue the run (default is to abort the run)'))
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar='N',
+                        help='number of runs to deploy concurrently')
     parser.add_argument("-log", "--log-level", type=str, default='info',
                         choices=['debug_full', 'debug', 'info',
                                  'exec', 'warning', 'error'],
@@ -131,10 +156,27 @@ def main(sys_args=None):
                             'the logging level to output to screen/file (NB: '
                             'debug_full allows logging from external packages)'
                         ))
+    parser.add_argument("--store", action="store_true",
+                        help=('store input files once per output root (by content hash), '
+                              'and hard link them into each run\'s output directory '
+                              '(runs must not modify their input files in place)'))
+    parser.add_argument("--qsub-array", action="store_true",
+                        help=('submit qsub runs with the same output location '
+                              'and resources as PBS job arrays (#PBS -J)'))
+    parser.add_argument("--qsub-pack", type=int, default=0, metavar='N',
+                        help=('pack (single node) qsub runs with the same output location '
+                              'and resources into single jobs of up to N runs, '
+                              'which run concurrently (one per core)'))
+    parser.add_argument("--no-qsub-batch", action="store_false", dest="qsub_batch",
+                        help=('submit each qsub run as it is deployed '
+                              '(rather than all runs, once deployed, with one shell session per host)'))
     parser.add_argument("--test-run", action="store_true",
                         help=(
                             'do not run any executables '
                             '(only create directories and create/copy files)'))
+    parser.add_argument("--no-cache", action="store_false", dest="cache",
+                        help=('do not use (or store) the cached, formatted config '
+                              '(by default, this is reused while the config file is unchanged)'))
     parser.add_argument('--version', action='version', version=__version__)
 
     args = parser.parse_args(sys_args)
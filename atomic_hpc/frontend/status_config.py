@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import logging
+import logging.handlers
+import time
+from jsonschema import ValidationError
+from atomic_hpc import __version__
+from atomic_hpc.config_yaml import iter_config_yaml
+from atomic_hpc.job_status import poll_jobs, cancel_jobs
+from atomic_hpc.ledger import JobLedger, ledger_path
+from atomic_hpc.utils import cmndline_prompt, str2intlist
+
+logger = logging.getLogger('atomic_hpc.status_config')
+
+_TABLE_FIELDS = (("run_id", "id"), ("name", "name"), ("host", "host"), ("jobid", "job id"),
+                 ("submitted", "submitted"), ("state", "state"), ("exit_status", "exit"))
+
+
+def format_table(jobs):
+    """ format jobs (from the ledger) as a table
+
+    Parameters
+    ----------
+    jobs: list of dict
+
+    Returns
+    -------
+    table: str
+
+    """
+    rows = [[title for _, title in _TABLE_FIELDS]]
+    for job in jobs:
+        row = []
+        for field, _ in _TABLE_FIELDS:
+            value = job[field]
+            if field == "submitted":
+                value = time.strftime("%Y-%m-%d %H:%M", time.localtime(value))
+            elif field == "host" and value is None:
+                value = "localhost"
+            elif value is None:
+                value = "-"
+            row.append(str(value))
+        rows.append(row)
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(_TABLE_FIELDS))]
+    return "\n".join(["  ".join([value.ljust(width) for value, width in zip(row, widths)]).rstrip()
+                      for row in rows])
+
+
+def config_remotes(fpath, run_ids):
+    """ read the remote output configs of runs from the config, since their credentials are not stored in the ledger
+
+    Parameters
+    ----------
+    fpath: str
+    run_ids: list of int
+
+    Returns
+    -------
+    remotes: dict
+        {run_id: remote output config}
+
+    """
+    if not run_ids:
+        return {}
+    try:
+        # only the selected runs are formatted
+        return {run["id"]: run["output"]["remote"]
+                for run in iter_config_yaml(fpath, errormsg_only=True, run_ids=run_ids, cache=True)}
+    except (IOError, OSError, ValidationError) as err:
+        logger.warning("could not read the remote hosts' credentials from the config: {}".format(err))
+        return {}
+
+
+def run(fpath, runs=None, log_level='WARNING', ttl=60., cancel=False):
+    """
+
+    Parameters
+    ----------
+    fpath: str
+    runs: list of ints or None
+    log_level: str
+    ttl: float
+        seconds for which a polled job state is considered current (and not polled again)
+    cancel: bool
+        if True, cancel (qdel) the unfinished jobs
+
+    Returns
+    -------
+
+    """
+    if log_level.upper() == "DEBUG_FULL":
+        log_level = "DEBUG"
+        filter_ext = False
+    else:
+        filter_ext = True
+
+    root = logging.getLogger()
+    root.handlers = []  # remove any existing handlers
+    root.setLevel(logging.DEBUG)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setLevel(getattr(logging, log_level.upper()))
+    formatter = logging.Formatter('%(levelname)8s: %(module)10s: %(message)s')
+    stream_handler.setFormatter(formatter)
+    stream_handler.propogate = False
+    if filter_ext:
+        stream_handler.addFilter(logging.Filter('atomic_hpc'))
+    root.addHandler(stream_handler)
+
+    fpath = os.path.abspath(fpath)
+    lpath = ledger_path(fpath)
+    if not os.path.exists(lpath):
+        logger.critical("no job ledger exists for the config (no qsub jobs have been submitted): {}".format(lpath))
+        return
+
+    with JobLedger(lpath) as ledger:
+        remotes = config_remotes(fpath, [job["run_id"] for job in ledger.jobs(runs) if job["host"] is not None])
+        if cancel:
+            cancelled = cancel_jobs(ledger, runs, local_path=os.path.dirname(fpath), remotes=remotes)
+            logger.info("cancelled {} jobs".format(len(cancelled)))
+            ttl = 0
+        jobs = poll_jobs(ledger, runs, ttl=ttl, local_path=os.path.dirname(fpath), remotes=remotes)
+
+    print(format_table(jobs))
+
+
+class ErrorParser(argparse.ArgumentParser):
+    """
+    on error; print help string
+    """
+
+    def error(self, message):
+        sys.stderr.write('error: %s\n' % message)
+        self.print_help()
+        sys.exit(2)
+
+
+def main(sys_args=None):
+
+    if sys_args is None:
+        sys_args = sys.argv[1:]
+
+    parser = ErrorParser(
+        description=(
+            'show the status of qsub jobs submitted '
+            'from a config.yaml file (polling each host once)')
+    )
+    parser.add_argument("configpath", type=str,
+                        help='yaml config file path', metavar='filepath')
+    parser.add_argument('-r', '--runs', type=str2intlist, default=None,
+                        help=("subset of run ids, in delimited list, "
+                              "e.g. -r 1,5-6,7"))
+    parser.add_argument("-t", "--ttl", type=float, default=60., metavar='SECONDS',
+                        help=('seconds for which a polled job state is considered current '
+                              '(and is not polled again)'))
+    parser.add_argument("--cancel", action="store_true",
+                        help='cancel (qdel) the unfinished jobs')
+    parser.add_argument("-log", "--log-level", type=str, default='warning',
+                        choices=['debug_full', 'debug', 'info',
+                                 'exec', 'warning', 'error'],
+                        help=(
+                            'the logging level to output to screen/file '
+                            '(NB: debug_full '
+                            'allows logging from external packages)'))
+    parser.add_argument('--version', action='version', version=__version__)
+
+    args = parser.parse_args(sys_args)
+    options = vars(args)
+
+    if options["cancel"]:
+        if not cmndline_prompt(
+                "Are you sure you wish to cancel the unfinished jobs?"):
+            sys.exit()
+
+    filepath = options.pop('configpath')
+    run(filepath, **options)
@@ -1,6 +1,6 @@
 import pytest
 
-from atomic_hpc.frontend import run_config, retrieve_config
+from atomic_hpc.frontend import run_config, retrieve_config, status_config
 
 
 def test_run_config_help():
@@ -13,3 +13,9 @@ def test_retrieve_config_help():
     with pytest.raises(SystemExit) as out:
         retrieve_config.main(['-h'])
         assert out.value.code == 0
+
+
+def test_status_config_help():
+    with pytest.raises(SystemExit) as out:
+        status_config.main(['-h'])
+        assert out.value.code == 0
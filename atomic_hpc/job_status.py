@@ -0,0 +1,322 @@
+""" a module to poll (and cancel) the submitted qsub jobs recorded in a job ledger,
+with a single qstat (or qdel) execution per host
+
+"""
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from atomic_hpc import context_folder
+from atomic_hpc.ledger import _REMOTE_SECRETS
+
+logger = logging.getLogger(__name__)
+
+_QSTAT_CMNDLINE = 'bash -l -c {cmnd}'
+# the exit status of the command is reported on stderr, since qstat exits non-zero if any job is unknown
+# (e.g. if its history has expired) but still reports the others, and so a failed execution (e.g. qstat not found)
+# has to be distinguished from the login shell or connection failing
+_EXIT_STATUS = 'atomic_hpc exit status: '
+_QSTAT = 'qstat -f -x {jobids}'
+_QDEL = 'qdel {jobids}'
+# e.g. "qstat: Unknown Job Id 10.pbs" (PBS Pro) or "qstat: Unknown Job Id Error 10.pbs" (Torque)
+_REGEX_UNKNOWN = re.compile(r"Unknown Job Id(?: Error)?:?\s+(\S+)")
+
+_JOB_STATES = {
+    "B": "running",  # job array, with at least one sub-job running
+    "E": "exiting",
+    "H": "held",
+    "Q": "queued",
+    "R": "running",
+    "S": "suspended",
+    "T": "transiting",
+    "U": "suspended",
+    "W": "waiting",
+    "M": "moved",
+    "C": "finished",  # Torque
+    "F": "finished",
+    "X": "finished",  # job array sub-job
+}
+# states after which a job's state will not change ("expired" jobs are no longer known to qstat)
+_FINAL_STATES = ("finished", "expired")
+
+
+def parse_qstat_full(lines):
+    """ parse the output of ``qstat -f``
+
+    Parameters
+    ----------
+    lines: list of str
+
+    Returns
+    -------
+    jobs: OrderedDict
+        {jobid: {attribute: value}}
+
+    Examples
+    --------
+    >>> jobs = parse_qstat_full([
+    ...     "Job Id: 10.pbs",
+    ...     "    Job_Name = run",
+    ...     "    job_state = F",
+    ...     "    Variable_List = PBS_O_HOME=/home/user,",
+    ...     "\\tPBS_O_LANG=C",
+    ...     "    Exit_status = 0",
+    ...     "",
+    ...     "Job Id: 11.pbs",
+    ...     "    job_state = R"])
+    >>> jobs["10.pbs"]["Variable_List"]
+    'PBS_O_HOME=/home/user,PBS_O_LANG=C'
+    >>> [(jobid, attrs["job_state"]) for jobid, attrs in jobs.items()]
+    [('10.pbs', 'F'), ('11.pbs', 'R')]
+
+    """
+    jobs = OrderedDict()
+    attrs = None
+    key = None
+    for line in lines:
+        if line.startswith("Job Id:"):
+            attrs = jobs[line[len("Job Id:"):].strip()] = {}
+            key = None
+        elif attrs is None or not line.strip():
+            continue
+        elif line.startswith("\t") and key is not None:
+            # long values are wrapped onto tab indented lines
+            attrs[key] += line.strip()
+        elif " = " in line:
+            key, value = line.strip().split(" = ", 1)
+            attrs[key] = value
+    return jobs
+
+
+def _job_key(jobid):
+    """ the job id, without the server name (which qstat may report differently to qsub) """
+    return jobid.split(".")[0]
+
+
+def parse_unknown_jobs(lines):
+    """ parse the job ids reported as unknown by qstat (or qdel), from its stderr
+
+    Parameters
+    ----------
+    lines: list of str
+
+    Returns
+    -------
+    jobids: list of str
+
+    Examples
+    --------
+    >>> parse_unknown_jobs(["qstat: Unknown Job Id 10.pbs", "qstat: Unknown Job Id Error 11.pbs", "other"])
+    ['10.pbs', '11.pbs']
+
+    """
+    return [match.group(1) for match in [_REGEX_UNKNOWN.search(line) for line in lines] if match]
+
+
+def parse_rejected_jobs(lines, jobids):
+    """ parse which of the jobids are reported on by qdel, from its stderr
+    (qdel reports nothing for the jobs it has accepted, and an error for each job it has rejected)
+
+    Parameters
+    ----------
+    lines: list of str
+    jobids: list of str
+
+    Returns
+    -------
+    jobids: list of str
+        the jobids (in the given order) reported in lines
+
+    Examples
+    --------
+    >>> lines = ["qdel: Job has finished 10.pbs.server", "qdel: Request invalid for state of job 12.pbs"]
+    >>> parse_rejected_jobs(lines, ["10.pbs", "11.pbs", "12.pbs", "110.pbs"])
+    ['10.pbs', '12.pbs']
+
+    """
+    reported = set([_job_key(word) for line in lines for word in line.split()])
+    return [jobid for jobid in jobids if _job_key(jobid) in reported]
+
+
+def _job_state(attrs):
+    """ the (state, exit_status) of a job, from its qstat attributes """
+    state = _JOB_STATES.get(attrs.get("job_state"), "unknown")
+    exit_status = attrs.get("Exit_status", attrs.get("exit_status"))
+    try:
+        exit_status = int(exit_status)
+    except (TypeError, ValueError):
+        exit_status = None
+    return state, exit_status
+
+
+def _exec_per_host(jobs, cmnd, local_path=".", remotes=None):
+    """ execute a command, for all the jobs on each host, in a single (login) shell per host
+
+    Parameters
+    ----------
+    jobs: list of dict
+        jobs from the ledger
+    cmnd: str
+        the command, with a {jobids} field
+    local_path: str
+        the path to execute in, for jobs submitted locally
+    remotes: None or dict
+        {run_id: remote output config}, to supply the credentials (which are not stored in the ledger)
+        for connecting to the same host
+
+    Yields
+    -------
+    host_jobs: list of dict
+    stdout: list of str
+    stderr: list of str
+    exit_status: int or None
+        None if the command could not be executed (e.g. the login shell or connection failed)
+
+    """
+    hosts = OrderedDict()
+    for job in jobs:
+        hosts.setdefault(json.dumps(job["remote"], sort_keys=True), []).append(job)
+
+    for host_jobs in hosts.values():
+        remote = host_jobs[0]["remote"]
+        if remote is None:
+            kwargs = dict(path=local_path)
+        else:
+            remote = remote.copy()
+            for job in host_jobs:
+                config = (remotes or {}).get(job["run_id"])
+                if config is not None and config["hostname"] == remote["hostname"]:
+                    remote.update({key: config[key] for key in _REMOTE_SECRETS if config.get(key) is not None})
+                    break
+            hostname = remote.pop("hostname")
+            kwargs = dict(path="", remote=True, hostname=hostname, **remote)
+
+        host_cmnd = cmnd.format(jobids=" ".join([quote(job["jobid"]) for job in host_jobs]))
+        cmndline = _QSTAT_CMNDLINE.format(
+            cmnd=quote('({0}); echo "{1}$?" >&2'.format(host_cmnd, _EXIT_STATUS)))
+        getattr(logger, "exec")("{0} jobs on {1}: {2}".format(
+            len(host_jobs), host_jobs[0]["host"] or "localhost", host_cmnd))
+        stdout = []
+        stderr = []
+        with context_folder.change_dir(**kwargs) as folder:
+            folder.exec_cmnd(cmndline, ".", stdout=stdout, stderr=stderr)
+        exit_status = None
+        for line in stderr:
+            if line.startswith(_EXIT_STATUS):
+                exit_status = int(line[len(_EXIT_STATUS):])
+        stderr = [line for line in stderr if not line.startswith(_EXIT_STATUS)]
+        yield host_jobs, stdout, stderr, exit_status
+
+
+def poll_jobs(ledger, run_ids=None, ttl=60, local_path=".", remotes=None):
+    """ update the state of jobs in a ledger, with a single ``qstat -f -x`` execution per host
+
+    Parameters
+    ----------
+    ledger: atomic_hpc.ledger.JobLedger
+    run_ids: None or list of int
+        if not None, only poll jobs for these run ids
+    ttl: float
+        seconds for which a polled state is considered current (and so not polled again).
+        Jobs in a final state (i.e. finished or expired) are never polled again
+    local_path: str
+        the path to execute qstat in, for jobs submitted locally
+    remotes: None or dict
+        {run_id: remote output config}, to supply the credentials (e.g. password) for remote hosts
+
+    Returns
+    -------
+    jobs: list of dict
+        the (updated) jobs from the ledger
+
+    Notes
+    -----
+    jobs reported by qstat as unknown are set as expired (i.e. their history has expired),
+    but if qstat itself failed (e.g. it was not found, or the server was down), then the jobs it did not report on
+    are left with their previous state
+
+    """
+    now = time.time()
+    stale = [job for job in ledger.jobs(run_ids)
+             if job["state"] not in _FINAL_STATES and (job["polled"] is None or now - job["polled"] >= ttl)]
+    states = {}
+    for host_jobs, stdout, stderr, exit_status in _exec_per_host(stale, _QSTAT, local_path, remotes):
+        qstat = {_job_key(jobid): attrs for jobid, attrs in parse_qstat_full(stdout).items()}
+        expired = set([_job_key(jobid) for jobid in parse_unknown_jobs(stderr)])
+        failed = []
+        for job in host_jobs:
+            key = _job_key(job["jobid"])
+            if key in qstat:
+                states[job["jobid"]] = _job_state(qstat[key])
+            elif key in expired:
+                states[job["jobid"]] = ("expired", None)
+            elif exit_status == 0:
+                states[job["jobid"]] = ("unknown", None)
+            else:
+                failed.append(job["jobid"])
+        if failed:
+            logger.error("qstat failed on {0} (exit status {1}), the states of jobs {2} were not updated: {3}".format(
+                host_jobs[0]["host"] or "localhost", exit_status, failed, "\n".join(stderr)))
+    if states:
+        ledger.update_states(states, polled=now)
+    logger.info("polled {0} jobs (the states of {1} were current)".format(
+        len(states), len(ledger.jobs(run_ids)) - len(states)))
+
+    return ledger.jobs(run_ids)
+
+
+def cancel_jobs(ledger, run_ids=None, local_path=".", remotes=None):
+    """ cancel the unfinished jobs in a ledger, with a single ``qdel`` execution per host
+
+    Parameters
+    ----------
+    ledger: atomic_hpc.ledger.JobLedger
+    run_ids: None or list of int
+        if not None, only cancel jobs for these run ids
+    local_path: str
+        the path to execute qdel in, for jobs submitted locally
+    remotes: None or dict
+        {run_id: remote output config}, to supply the credentials (e.g. password) for remote hosts
+
+    Returns
+    -------
+    jobs: list of dict
+        the jobs that were cancelled
+
+    Notes
+    -----
+    only the jobs whose cancellation qdel accepted are set as cancelled,
+    i.e. those it reported no error for (unless it failed without reporting on any job, e.g. it was not found)
+
+    """
+    jobs = [job for job in ledger.jobs(run_ids) if job["state"] not in _FINAL_STATES]
+    states = {}
+    cancelled = []
+    for host_jobs, _, stderr, exit_status in _exec_per_host(jobs, _QDEL, local_path, remotes):
+        host = host_jobs[0]["host"] or "localhost"
+        if exit_status is None:
+            logger.error("qdel could not be executed on {0}: {1}".format(host, "\n".join(stderr)))
+            continue
+        rejected = parse_rejected_jobs(stderr, [job["jobid"] for job in host_jobs])
+        if exit_status != 0 and not rejected:
+            logger.error("qdel failed on {0} (exit status {1}), no jobs were cancelled: {2}".format(
+                host, exit_status, "\n".join(stderr)))
+            continue
+        if rejected:
+            logger.error("qdel did not cancel jobs {0} on {1}: {2}".format(rejected, host, "\n".join(stderr)))
+        for job in host_jobs:
+            if job["jobid"] in rejected:
+                continue
+            # leave the state stale, so that it is updated on the next poll
+            states[job["jobid"]] = ("cancelled", None)
+            cancelled.append(job)
+    if states:
+        ledger.update_states(states, polled=0)
+    return cancelled
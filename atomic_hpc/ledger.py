@@ -0,0 +1,184 @@
+""" a persistent (sqlite) ledger of submitted jobs, stored next to the config file
+
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+_LEDGER_SUFFIX = ".jobs.sqlite"
+
+_LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    host TEXT,
+    remote TEXT,
+    outpath TEXT NOT NULL,
+    jobid TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    state TEXT,
+    exit_status INTEGER,
+    polled REAL
+)
+"""
+
+# remote (connection) config keys which are never written to the ledger
+# (so the credentials have to be supplied again, from the config, to connect)
+_REMOTE_SECRETS = ("password", "pkey")
+
+_LEDGER_FIELDS = ("run_id", "name", "host", "remote", "outpath", "jobid", "submitted",
+                  "state", "exit_status", "polled")
+
+
+def ledger_path(config_path):
+    """ the path of the job ledger for a config file
+
+    Parameters
+    ----------
+    config_path: str
+
+    Returns
+    -------
+    path: str
+
+    """
+    return os.path.splitext(str(config_path))[0] + _LEDGER_SUFFIX
+
+
+def _run_outpath(run):
+    """ the output directory of a run, as given in the config (relative to the output root) """
+    outpath = "" if run["output"]["path"] is None else run["output"]["path"]
+    return os.path.join(outpath, "{0}_{1}".format(run["id"], run["name"]))
+
+
+class JobLedger(object):
+    """ a persistent record of submitted jobs, keyed by run id
+
+    the database is only opened (and created if it does not exist) when first used
+
+    Parameters
+    ----------
+    path: str
+        the sqlite database file
+
+    Examples
+    --------
+    >>> with JobLedger(":memory:") as ledger:
+    ...     ledger.record({"id": 1, "name": "a", "output": {"path": "out", "remote": None}}, "10.pbs")
+    ...     [(job["run_id"], job["jobid"]) for job in ledger.jobs()]
+    [(1, '10.pbs')]
+
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._connection = None
+
+    @property
+    def _conn(self):
+        """ the database connection, opened on first use """
+        if self._connection is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            with conn:
+                conn.execute(_LEDGER_SCHEMA)
+            self._connection = conn
+        return self._connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def record(self, run, jobid, submitted=None):
+        """ record the submission of a run (replacing any previous submission of the same run id)
+
+        Parameters
+        ----------
+        run: dict
+        jobid: str
+        submitted: None or float
+            the submission time (seconds since the epoch), if None use the current time
+
+        """
+        self.record_many([(run, jobid)], submitted)
+
+    def record_many(self, submissions, submitted=None):
+        """ record the submission of multiple runs, in a single transaction
+        (the remote output config of each run is stored without its credentials, see _REMOTE_SECRETS)
+
+        Parameters
+        ----------
+        submissions: list of (dict, str)
+            (run, jobid)
+        submitted: None or float
+            the submission time (seconds since the epoch), if None use the current time
+
+        """
+        submitted = time.time() if submitted is None else submitted
+        rows = []
+        for run, jobid in submissions:
+            remote = run["output"]["remote"]
+            host = None if remote is None else remote["hostname"]
+            if remote is not None:
+                remote = json.dumps({key: value for key, value in dict(remote).items()
+                                     if key not in _REMOTE_SECRETS}, sort_keys=True)
+            rows.append((run["id"], run["name"], host, remote, _run_outpath(run), jobid, submitted,
+                         None, None, None))
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO jobs ({0}) VALUES ({1})".format(
+                    ", ".join(_LEDGER_FIELDS), ", ".join(["?"] * len(_LEDGER_FIELDS))), rows)
+        logger.debug("recorded {0} jobs in ledger: {1}".format(len(rows), self.path))
+
+    def update_states(self, states, polled=None):
+        """ update the (last known) state of jobs
+
+        Parameters
+        ----------
+        states: dict
+            {jobid: (state, exit_status)}
+        polled: None or float
+            the time the states were polled (seconds since the epoch), if None use the current time
+
+        """
+        polled = time.time() if polled is None else polled
+        with self._conn:
+            self._conn.executemany("UPDATE jobs SET state = ?, exit_status = ?, polled = ? WHERE jobid = ?",
+                                   [(state, exit_status, polled, jobid)
+                                    for jobid, (state, exit_status) in states.items()])
+
+    def jobs(self, run_ids=None):
+        """ the recorded jobs, ordered by run id
+
+        Parameters
+        ----------
+        run_ids: None or list of int
+            if not None, only return jobs for these run ids
+
+        Returns
+        -------
+        jobs: list of dict
+            with keys; run_id, name, host, remote (dict or None), outpath, jobid, submitted,
+            state, exit_status and polled
+
+        """
+        rows = self._conn.execute("SELECT {} FROM jobs ORDER BY run_id".format(", ".join(_LEDGER_FIELDS)))
+        jobs = []
+        for row in rows:
+            if run_ids is not None and row["run_id"] not in run_ids:
+                continue
+            job = dict(zip(_LEDGER_FIELDS, row))
+            job["remote"] = None if job["remote"] is None else json.loads(job["remote"])
+            jobs.append(job)
+        return jobs
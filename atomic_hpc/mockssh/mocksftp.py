@@ -110,6 +110,15 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
         st = os.stat(path)
         return paramiko.SFTPAttributes.from_stat(st, path)
 
+    @returns_sftp_error
+    def lstat(self, path):
+        st = os.lstat(path)
+        return paramiko.SFTPAttributes.from_stat(st, path)
+
+    def canonicalize(self, path):
+        # as for OpenSSH, symbolic links are resolved
+        return os.path.realpath(super(SFTPServerInterface, self).canonicalize(path))
+
     @returns_sftp_error
     def chattr(self, path, attr):
         if hasattr(attr, "st_mode"):
@@ -121,10 +130,10 @@ class SFTPServerInterface(paramiko.SFTPServerInterface):
 
     @returns_sftp_error
     def list_folder(self, path):
-        """Looks up folder contents of `path.`"""
+        """Looks up folder contents of `path.` (as for OpenSSH, without following symbolic links)"""
         folder_contents = []
         for f in os.listdir(path):
-            attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, f)))
+            attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, f)))
             attr.filename = f
             folder_contents.append(attr)
         return folder_contents
@@ -0,0 +1,152 @@
+""" a module to insert variables (@v{name}) and file contents (@f{name}) into scripts and command lines
+
+each distinct text is parsed once (and cached), into literal segments and insertion tags,
+which can then be rendered for each run in a single pass
+
+"""
+import re
+import threading
+from collections import OrderedDict
+
+_REGEX_TAG = re.compile(r"\@([vf])\{([^}]+)\}")
+
+_TAG_FORMAT = {"v": "@v{{{0}}}", "f": "@f{{{0}}}"}
+
+
+class MissingInsertError(KeyError):
+    """ raised when there is no replacement for one or more tags in a template
+
+    Parameters
+    ----------
+    missing: list of str
+        the missing tags, e.g. ["@v{var1}", "@f{file1}"]
+
+    """
+
+    def __init__(self, missing):
+        super(MissingInsertError, self).__init__(", ".join(missing))
+        self.missing = missing
+
+    def __str__(self):
+        return ", ".join(self.missing)
+
+
+class Template(object):
+    """ a text, parsed into literal segments and @v{}/@f{} insertion tags
+
+    Parameters
+    ----------
+    text: str
+
+    Examples
+    --------
+    >>> template = Template("a @v{x} b @f{y} c @v{x}")
+    >>> sorted(template.names("v"))
+    ['x']
+    >>> template.render({"x": 1}, {"y": "file"})
+    'a 1 b file c 1'
+    >>> template.render({"x": 1})
+    'a 1 b @f{y} c 1'
+    >>> template.render({}, {})
+    Traceback (most recent call last):
+     ...
+    atomic_hpc.template.MissingInsertError: @v{x}, @f{y}
+
+    """
+    __slots__ = ("_literals", "_tags")
+
+    def __init__(self, text):
+        # split gives [literal, kind, name, literal, kind, name, ..., literal]
+        parts = _REGEX_TAG.split(text)
+        self._literals = parts[0::3]
+        self._tags = list(zip(parts[1::3], parts[2::3]))
+
+    def names(self, kind):
+        """ the names of the tags of a kind
+
+        Parameters
+        ----------
+        kind: str
+            'v' (variables) or 'f' (files)
+
+        Returns
+        -------
+        names: set of str
+
+        """
+        return set([name for tkind, name in self._tags if tkind == kind])
+
+    def render(self, variables=None, files=None):
+        """ insert variables and file contents
+
+        Parameters
+        ----------
+        variables: dict or None
+            {name: value}, values are converted to str
+        files: dict or None
+            {name: content}, if None @f{} tags are left unchanged
+
+        Returns
+        -------
+        text: str
+
+        Raises
+        ------
+        MissingInsertError
+            listing all tags with no replacement
+
+        """
+        if not self._tags:
+            return self._literals[0]
+        inserts = {"v": variables or {}, "f": files}
+        missing = []
+        for kind, name in self._tags:
+            if inserts[kind] is None:
+                continue
+            tag = _TAG_FORMAT[kind].format(name)
+            if name not in inserts[kind] and tag not in missing:
+                missing.append(tag)
+        if missing:
+            raise MissingInsertError(missing)
+
+        out = [self._literals[0]]
+        for (kind, name), literal in zip(self._tags, self._literals[1:]):
+            if inserts[kind] is None:
+                out.append(_TAG_FORMAT[kind].format(name))
+            elif kind == "v":
+                out.append(str(inserts[kind][name]))
+            else:
+                out.append(inserts[kind][name])
+            out.append(literal)
+        return "".join(out)
+
+
+_TEMPLATE_CACHE = OrderedDict()
+_TEMPLATE_CACHE_SIZE = 1024
+_TEMPLATE_LOCK = threading.Lock()
+
+
+def compile_template(text):
+    """ get the (cached) parsed template of a text
+
+    Parameters
+    ----------
+    text: str
+
+    Returns
+    -------
+    template: Template
+
+    """
+    with _TEMPLATE_LOCK:
+        template = _TEMPLATE_CACHE.pop(text, None)
+        if template is not None:
+            # move to the most recently used position
+            _TEMPLATE_CACHE[text] = template
+            return template
+    template = Template(text)
+    with _TEMPLATE_LOCK:
+        _TEMPLATE_CACHE[text] = template
+        while len(_TEMPLATE_CACHE) > _TEMPLATE_CACHE_SIZE:
+            _TEMPLATE_CACHE.popitem(last=False)
+    return template
@@ -1,3 +1,5 @@
+import copy
+import json
 import logging
 import os
 import shutil
@@ -12,13 +14,19 @@ try:
     import pathlib
 except ImportError:
     import pathlib2 as pathlib
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
 from jsonextended.utils import MockPath
 from atomic_hpc.config_yaml import format_config_yaml
+from atomic_hpc.ledger import JobLedger
 from atomic_hpc.mockssh import mockserver
-from atomic_hpc.deploy_runs import (get_inputs, deploy_runs, _replace_in_cmnd,
+from atomic_hpc.deploy_runs import (get_inputs, InputCache, BinaryRef, deploy_runs, _replace_in_cmnd,
                                     _create_qsub,
-                                    deploy_run_normal, deploy_run_qsub)
+                                    deploy_run_normal, deploy_run_qsub,
+                                    retrieve_outputs, watch_outputs)
 
 logging.basicConfig(level="INFO")
 
@@ -163,6 +171,80 @@ def test_get_inputs(context):
         "mkdir deletefolder; echo c > deletefolder/some.text"]
 
 
+def test_get_inputs_cached(context):
+    runs, path = context
+    cache = InputCache()
+    inputs = get_inputs(runs[0], path, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 3)
+    cached_inputs = get_inputs(runs[0], path, cache=cache)
+    assert (cache.hits, cache.misses) == (3, 3)
+    assert cached_inputs["scripts"]["script.in"][0] == inputs["scripts"]["script.in"][0]
+    assert cached_inputs["files"]["frag.in"][0] == inputs["files"]["frag.in"][0]
+
+    # contents larger than the cache are not stored
+    cache = InputCache(max_bytes=12)
+    get_inputs(runs[0], path, cache=cache)
+    assert cache._nbytes == 12
+    assert list(cache._contents.values()) == ["another file"]
+
+
+@pytest.mark.parametrize("source,local_output", [
+    ("local_pathlib", True), ("local_mock", True), ("remote", True), ("remote", False)])
+def test_deploy_binaries(request, source, local_output):
+    runs, path = request.getfixturevalue(source)
+    if hasattr(path, "to_string"):
+        # virtual files hold lines of text
+        content = "binary content"
+        path["input"].add_child(MockPath("data.bin", is_file=True, content=content))
+    else:
+        content = os.urandom(1000)
+        with open(os.path.join(path, "input", "data.bin"), "wb") as f:
+            f.write(content)
+    run = runs[0]
+    run["input"]["binaries"] = {"data": "input/data.bin"}
+    if local_output:
+        run["output"]["remote"] = None
+
+    inputs = get_inputs(run, path)
+    assert isinstance(inputs["files"]["data.bin"][0], BinaryRef)
+
+    deploy_runs([run], path, if_exists="abort", exec_errors=True)
+    if hasattr(path, "to_string"):
+        assert path["output/1_run_test_name/data.bin"]._content == [content]
+    else:
+        with open(os.path.join(path, "output", "1_run_test_name", "data.bin"), "rb") as f:
+            assert f.read() == content
+
+
+@pytest.mark.parametrize("source", ["local_pathlib", "remote"])
+def test_deploy_store(request, source):
+    runs, path = request.getfixturevalue(source)
+    with open(os.path.join(path, "input", "data.bin"), "wb") as f:
+        f.write(b"binary content")
+    runs[0]["input"]["binaries"] = {"data": "input/data.bin"}
+    run2 = copy.deepcopy(runs[0])
+    run2["id"] = 2
+
+    deploy_runs([runs[0], run2], path, if_exists="abort", exec_errors=True, store=True)
+
+    storepath = os.path.join(path, "output", ".atomic_hpc_store")
+    assert len(os.listdir(storepath)) == 3
+    for fname, content in [("frag.in", "replace frag"), ("data.bin", "binary content")]:
+        path1 = os.path.join(path, "output", "1_run_test_name", fname)
+        path2 = os.path.join(path, "output", "2_run_test_name", fname)
+        with open(path2) as f:
+            assert f.read() == content
+        assert os.stat(path1).st_ino == os.stat(path2).st_ino
+
+
+def test_get_inputs_binary_in_script(context):
+    runs, path = context
+    run = runs[0]
+    run["input"]["binaries"] = {"frag1": "input/frag.in"}
+    with pytest.raises(ValueError):
+        _ = get_inputs(run, path)
+
+
 def test_get_inputs_missing_variable_in_script(context):
     runs, path = context
     run = runs[0]
@@ -179,6 +261,16 @@ def test_get_inputs_missing_file_in_script(context):
         _ = get_inputs(run, path)
 
 
+def test_get_inputs_missing_all_reported(context):
+    runs, path = context
+    run = runs[0]
+    run["input"]["variables"] = {}
+    run["input"]["files"] = {}
+    with pytest.raises(KeyError) as err:
+        _ = get_inputs(run, path)
+    assert "@v{var1}, @f{frag1}" in str(err.value)
+
+
 def test_get_inputs_missing_file(context):
     runs, path = context
     run = runs[0]
@@ -234,6 +326,36 @@ def test_full_normal(context):
     deploy_runs(runs, path, if_exists="abort", exec_errors=True)
 
 
+def test_full_normal_ledger(context):
+    """ the ledger is only created when there are qsub jobs to record """
+    runs, path = context
+    temppath = mkdtemp()
+    try:
+        ledger_file = os.path.join(temppath, "config.jobs.sqlite")
+        with JobLedger(ledger_file) as ledger:
+            deploy_runs(runs, path, if_exists="abort", exec_errors=True, ledger=ledger)
+        assert not os.path.exists(ledger_file)
+    finally:
+        shutil.rmtree(temppath)
+
+
+def test_full_normal_concurrent(context):
+    runs, path = context
+    for i in range(2, 5):
+        new_run = copy.deepcopy(runs[0])
+        new_run["id"] = i
+        runs.append(new_run)
+    deploy_runs(runs, path, if_exists="abort", exec_errors=True, max_workers=3)
+
+    if not hasattr(path, "to_string"):
+        for i in range(1, 5):
+            assert os.path.exists(os.path.join(
+                str(path), 'output/{}_run_test_name/output2.other'.format(i)))
+
+    with pytest.raises(RuntimeError):
+        deploy_runs(runs, path, if_exists="abort", exec_errors=True, max_workers=3)
+
+
 def test_create_qsub(context):
     runs, path = context
 
@@ -253,10 +375,16 @@ echo "<qstat -f $PBS_JOBID>"
 qstat -f $PBS_JOBID
 echo "</qstat -f $PBS_JOBID>"
 
-# number of cores per node used
-export NCORES=16
-# number of processes
-export NPROCESSES=16
+if [ -n "${ATOMIC_HPC_PACKED:-}" ]; then
+    # the run is packed with others into a single job, with one core per run
+    export NCORES=1
+    export NPROCESSES=1
+else
+    # number of cores per node used
+    export NCORES=16
+    # number of processes
+    export NPROCESSES=16
+fi
 
 # Make sure any symbolic links are resolved to absolute path
 readlink -f "." &> /dev/null || readlink_fail=true
@@ -277,6 +405,8 @@ echo Running: 1_run_test_name
 module load quantum-espresso intel-suite mpi
 
 start_in_temp=true
+# the maximum number of concurrent copies, when staging files to/from $TMPDIR
+stage_parallel=8
 
 if [ "$start_in_temp" = true ] ; then
 
@@ -289,6 +419,15 @@ if [ "$start_in_temp" = true ] ; then
         exit 1
     fi
     echo "running in: $TMPDIR"
+
+    # select the input files to copy (from the top-level of the working directory)
+    cd path/to/dir
+    STAGE_IN=()
+    for path in *; do
+        case "$path" in
+            *) STAGE_IN+=("$path");;
+        esac
+    done
     cd $TMPDIR
     
     # copy required input files from $WORKDIR to $TMPDIR
@@ -303,14 +442,25 @@ if [ "$start_in_temp" = true ] ; then
         unset IFS
         # echo "running on nodes: ${PCLIST[*]}"
 
+        # the copy command for the remote shell, with each file name quoted
+        if [ ${#STAGE_IN[@]} -gt 0 ]; then
+            STAGE_IN_CMND="cp -pR $(printf '%q ' "${STAGE_IN[@]}") $(printf '%q' "$TMPDIR")"
+        else
+            STAGE_IN_CMND="true"
+        fi
+
+        # copy to the nodes concurrently
         for PC in "${PCLIST[@]}"; do
+            while [ "$(jobs -rp | wc -l)" -ge "$stage_parallel" ]; do
+                # wait -n requires bash >= 4.3
+                wait -n 2> /dev/null || sleep 1
+            done
             echo "copying input files to node $PC"
-            ssh $PC "if [ ! -d $TMPDIR ];then mkdir -p $TMPDIR;echo 'temporary directory on '$PC;fi"
-            ssh $PC cp -pR path/to/dir/* $TMPDIR
-            # echo `ssh $PC ls $TMPDIR`
+            ssh $PC "if [ ! -d $TMPDIR ];then mkdir -p $TMPDIR;echo 'temporary directory on '$PC;fi; cd path/to/dir && $STAGE_IN_CMND" &
         done
-    else
-        cp -pR path/to/dir/* $TMPDIR
+        wait
+    elif [ ${#STAGE_IN[@]} -gt 0 ]; then
+        (cd path/to/dir && cp -pR "${STAGE_IN[@]}" $TMPDIR)
     fi
 
 else
@@ -336,8 +486,24 @@ find . -depth -name '*2.txt*' -execdir bash -c 'mv -i "$1" "${1//2.txt/2.other}"
 
 if [ "$start_in_temp" = true ] ; then
 
-    # copy output files from $TMPDIR to $WORKDIR
-    cp -pR $TMPDIR/* path/to/dir
+    # select the output files to copy (from the top-level of $TMPDIR)
+    cd $TMPDIR
+    STAGE_OUT=()
+    for path in *; do
+        case "$path" in
+            *) STAGE_OUT+=("$path");;
+        esac
+    done
+
+    # copy output files from $TMPDIR to $WORKDIR (each top-level path concurrently)
+    for path in "${STAGE_OUT[@]}"; do
+        while [ "$(jobs -rp | wc -l)" -ge "$stage_parallel" ]; do
+            # wait -n requires bash >= 4.3
+            wait -n 2> /dev/null || sleep 1
+        done
+        cp -pR "$path" path/to/dir &
+    done
+    wait
     
     cd path/to/dir
     
@@ -399,6 +565,49 @@ def test_run_deploy_qsub_pass_local(local_pathlib):
         assert "test value replace frag" == f.read()
 
 
+# on multiple nodes, input files are copied to each node by ssh (mocked by a function running locally)
+_mock_multinode = 'ssh() {{ shift; bash -c "$1"; }}; export -f ssh; export PBS_NODEFILE={0}; {1}'
+
+
+@pytest.mark.parametrize("multinode,include,staged", [
+    (False, ["*.in"], ["a b.in", "frag.in", "script.in", "staged.txt"]),
+    (True, ["*.in"], ["a b.in", "frag.in", "script.in", "staged.txt"]),
+    (True, ["none"], ["staged.txt"]),
+    (False, ["a b.*", "x;) echo $(ls)|*"], ["a b.in", "staged.txt"])])
+def test_run_deploy_qsub_stage(local_pathlib, multinode, include, staged):
+
+    runs, path = local_pathlib
+    run = runs[0]
+    run["environment"] = "qsub"
+    with open(os.path.join(path, "input", "a b.in"), "w") as f:
+        f.write("spaced")
+    run["input"]["files"]["spaced"] = "input/a b.in"
+    run["process"]["qsub"]["run"].insert(0, "ls > staged.txt")
+    run["process"]["qsub"]["stage_in"] = {"include": include, "exclude": ["other.*"]}
+    run["process"]["qsub"]["stage_out"] = {"include": None, "exclude": ["output.txt", "*.in"]}
+    inputs = get_inputs(run, path)
+
+    temppath = mkdtemp()
+    try:
+        cmndline = "TMPDIR={0}; chmod +x run.qsub; ./run.qsub".format(str(temppath))
+        if multinode:
+            nodefile = os.path.join(path, "nodefile")
+            with open(nodefile, "w") as f:
+                f.write("node1\nnode1\n")
+            cmndline = "bash -c {}".format(quote(_mock_multinode.format(nodefile, cmndline)))
+        with mock.patch("atomic_hpc.deploy_runs._QSUB_CMNDLINE", cmndline):
+            assert deploy_run_qsub(run, inputs, path, exec_errors=True) == True
+    finally:
+        shutil.rmtree(temppath)
+
+    outpath = pathlib.Path(os.path.join(str(path), 'output/1_run_test_name'))
+    with outpath.joinpath("staged.txt").open() as f:
+        assert f.read().splitlines() == staged
+    assert sorted([p.name for p in outpath.iterdir()]) == [
+        'a b.in', 'config_1.yaml', 'frag.in', 'other.in', 'output2.other', 'run.qsub', 'script.in', 'staged.txt',
+        'subfolder']
+
+
 def test_run_deploy_qsub_pass_remote(remote):
 
     runs, path = remote
@@ -439,3 +648,286 @@ def test_run_deploy_qsub_pass_remote(remote):
         str(path), 'output/1_run_test_name/output2.other'))
     with outfile.open() as f:
         assert "test value replace frag" == f.read()
+
+
+# mimic qsub, by running the qsub file (or each sub-job of an array) and echoing a job id
+_mock_qsub_submit = (
+    'case {{qsub_file}} in '
+    'array*) for i in 1 2; do TMPDIR=$(mktemp -d -p {0}) PBS_ARRAY_INDEX=$i bash {{qsub_file}} > /dev/null; done; '
+    'echo "array[].pbs";; '
+    'pack*) TMPDIR=$(mktemp -d -p {0}) bash {{qsub_file}} > /dev/null; echo "pack.pbs";; '
+    '*) TMPDIR=$(mktemp -d -p {0}) bash {{qsub_file}} > /dev/null; echo "$(basename $PWD).pbs";; '
+    'esac')
+_mock_qsub_cmndline = 'TMPDIR=$(mktemp -d -p {0}) bash run.qsub > /dev/null; echo "$(basename $PWD).pbs"'
+
+
+@pytest.mark.parametrize("source", ["local_pathlib", "remote"])
+# a small maximum length splits the submissions into multiple batches
+@pytest.mark.parametrize("qsub_array,qsub_batch,max_length", [
+    (False, False, 100000), (False, True, 100000), (False, True, 1), (True, True, 100000)])
+def test_deploy_qsub_batch(request, source, qsub_array, qsub_batch, max_length):
+    runs, path = request.getfixturevalue(source)
+    runs[0]["environment"] = "qsub"
+    run2 = copy.deepcopy(runs[0])
+    run2["id"] = 2
+    run3 = copy.deepcopy(runs[0])
+    run3["id"] = 3
+    run3["process"]["qsub"]["nnodes"] = 2
+
+    temppath = mkdtemp()
+    try:
+        with mock.patch("atomic_hpc.deploy_runs._QSUB_SUBMIT", _mock_qsub_submit.format(temppath)), \
+                mock.patch("atomic_hpc.deploy_runs._QSUB_CMNDLINE", _mock_qsub_cmndline.format(temppath)), \
+                mock.patch("atomic_hpc.deploy_runs._QSUB_BATCH_MAX_LENGTH", max_length):
+            with JobLedger(os.path.join(temppath, "config.jobs.sqlite")) as ledger:
+                jobids = deploy_runs([runs[0], run2, run3], path, if_exists="abort", exec_errors=True,
+                                     qsub_array=qsub_array, qsub_batch=qsub_batch, ledger=ledger)
+                jobs = ledger.jobs()
+    finally:
+        shutil.rmtree(temppath)
+
+    assert [(job["run_id"], job["jobid"]) for job in jobs] == sorted(jobids.items())
+    assert [job["outpath"] for job in jobs] == ["output/{}_run_test_name".format(i) for i in [1, 2, 3]]
+    assert {job["host"] for job in jobs} == {None if source == "local_pathlib" else "localhost"}
+
+    if qsub_array:
+        assert jobids == {1: "array[1].pbs", 2: "array[2].pbs", 3: "3_run_test_name.pbs"}
+        with open(os.path.join(path, "output", "array_1-2.qsub")) as f:
+            dispatcher = f.read()
+        assert "#PBS -J 1-2" in dispatcher
+        assert "3_run_test_name" not in dispatcher
+        # the output of each sub-job is kept with its run
+        for rid in [1, 2]:
+            assert os.path.exists(os.path.join(path, "output", "{}_run_test_name".format(rid), "run.qsub.out"))
+    else:
+        assert jobids == {i: "{}_run_test_name.pbs".format(i) for i in [1, 2, 3]}
+    for rid in [1, 2, 3]:
+        with open(os.path.join(path, "output", "{}_run_test_name".format(rid), "output2.other")) as f:
+            assert f.read() == "test value replace frag"
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_deploy_qsub_batch_error(local_pathlib, max_workers):
+    """ qsub runs deployed before a run raises an error are still submitted """
+    runs, path = local_pathlib
+    runs[0]["environment"] = "qsub"
+    run2 = copy.deepcopy(runs[0])
+    run2["id"] = 2
+    run2["input"]["files"] = {"other_file": "other_file.in"}
+
+    temppath = mkdtemp()
+    try:
+        with mock.patch("atomic_hpc.deploy_runs._QSUB_SUBMIT", _mock_qsub_submit.format(temppath)):
+            with JobLedger(os.path.join(temppath, "config.jobs.sqlite")) as ledger:
+                with pytest.raises(ValueError):
+                    deploy_runs([runs[0], run2], path, if_exists="abort", exec_errors=True,
+                                max_workers=max_workers, ledger=ledger)
+                jobs = ledger.jobs()
+    finally:
+        shutil.rmtree(temppath)
+
+    assert [(job["run_id"], job["jobid"]) for job in jobs] == [(1, "1_run_test_name.pbs")]
+
+
+@pytest.mark.parametrize("source", ["local_pathlib", "remote"])
+def test_deploy_qsub_pack(request, source):
+    runs, path = request.getfixturevalue(source)
+    runs[0]["environment"] = "qsub"
+    runs[0]["process"]["qsub"]["cores_per_node"] = 2
+    runs[0]["process"]["qsub"]["run"].insert(0, "echo $NPROCESSES > nprocesses.txt")
+    packed = [runs[0]]
+    for rid in [2, 3, 4]:
+        run = copy.deepcopy(runs[0])
+        run["id"] = rid
+        packed.append(run)
+    # runs on multiple nodes are not packed
+    run5 = copy.deepcopy(runs[0])
+    run5["id"] = 5
+    run5["process"]["qsub"]["nnodes"] = 2
+
+    temppath = mkdtemp()
+    try:
+        with mock.patch("atomic_hpc.deploy_runs._QSUB_SUBMIT", _mock_qsub_submit.format(temppath)):
+            jobids = deploy_runs(packed + [run5], path, if_exists="abort", exec_errors=True, qsub_pack=4)
+    finally:
+        shutil.rmtree(temppath)
+
+    assert jobids == {1: "pack.pbs", 2: "pack.pbs", 3: "pack.pbs", 4: "pack.pbs", 5: "5_run_test_name.pbs"}
+    with open(os.path.join(path, "output", "pack_1-4.qsub")) as f:
+        packer = f.read()
+    assert "#PBS -l select=1:ncpus=2" in packer
+    # 4 runs, 2 at a time
+    assert "#PBS -l walltime=2:20:00" in packer
+    for rid in [1, 2, 3, 4, 5]:
+        outpath = os.path.join(path, "output", "{}_run_test_name".format(rid))
+        with open(os.path.join(outpath, "output2.other")) as f:
+            assert f.read() == "test value replace frag"
+        assert os.path.exists(os.path.join(outpath, "run.qsub.out")) == (rid != 5)
+        # packed runs are run on a single core
+        with open(os.path.join(outpath, "nprocesses.txt")) as f:
+            assert f.read().strip() == ("1" if rid != 5 else "4")
+
+
+@pytest.mark.parametrize("source", ["local_pathlib", "remote"])
+@pytest.mark.parametrize("bulk,compress", [(False, False), (True, False), (True, True)])
+def test_retrieve_outputs(request, source, bulk, compress):
+    runs, path = request.getfixturevalue(source)
+    deploy_runs(runs, path, if_exists="abort", exec_errors=True)
+
+    local_path = mkdtemp()
+    try:
+        retrieve_outputs(runs, local_path, path, path_regex="*", ignore_regex=["*.in"],
+                         bulk=bulk, compress=compress)
+        outpath = pathlib.Path(local_path)
+        assert sorted([str(p.relative_to(outpath)) for p in outpath.glob("**/*")]) == [
+            '1_run_test_name', '1_run_test_name/config_1.yaml',
+            '1_run_test_name/output.txt', '1_run_test_name/output2.other',
+            '1_run_test_name/subfolder', '1_run_test_name/subfolder/dont_delete.txt']
+        with outpath.joinpath('1_run_test_name/output2.other').open() as f:
+            assert f.read() == "test value replace frag"
+    finally:
+        shutil.rmtree(local_path)
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+@pytest.mark.parametrize("loop", [False, True])
+def test_retrieve_outputs_links(remote, bulk, loop):
+    """ symbolic links in the outputs are followed, whether or not they are retrieved in bulk """
+    runs, path = remote
+    deploy_runs(runs, path, if_exists="abort", exec_errors=True)
+    runpath = os.path.abspath(os.path.join(path, "output", "1_run_test_name"))
+    os.symlink(os.path.join(runpath, "output.txt"), os.path.join(runpath, "link.dat"))
+    if loop:
+        # a link cycle is skipped (so the bulk transfer falls back to sftp)
+        os.symlink(os.path.join(runpath, "subfolder"), os.path.join(runpath, "subfolder", "loop"))
+
+    local_path = mkdtemp()
+    try:
+        retrieve_outputs(runs, local_path, path, path_regex="*", ignore_regex=["*.in"], bulk=bulk)
+        linkpath = os.path.join(local_path, "1_run_test_name", "link.dat")
+        assert not os.path.islink(linkpath)
+        with open(linkpath) as f:
+            assert f.read().strip() == "test_echo"
+        assert os.path.exists(os.path.join(local_path, "1_run_test_name", "subfolder", "dont_delete.txt"))
+        assert not os.path.exists(os.path.join(local_path, "1_run_test_name", "subfolder", "loop", "dont_delete.txt"))
+    finally:
+        shutil.rmtree(local_path)
+
+
+@pytest.mark.parametrize("source", ["local_pathlib", "remote"])
+@pytest.mark.parametrize("bulk,checksum", [(False, False), (True, True)])
+def test_retrieve_outputs_sync(request, source, bulk, checksum):
+    runs, path = request.getfixturevalue(source)
+    deploy_runs(runs, path, if_exists="abort", exec_errors=True)
+    runpath = os.path.join(path, "output", "1_run_test_name")
+
+    local_path = mkdtemp()
+    try:
+        retrieve_outputs(runs, local_path, path, if_exists="sync", ignore_regex=["*.in"],
+                         bulk=bulk, checksum=checksum)
+        outpath = pathlib.Path(local_path).joinpath("1_run_test_name")
+        with outpath.joinpath(".atomic_hpc_manifest.json").open() as f:
+            manifest = json.load(f)
+        assert sorted(manifest.keys()) == [
+            'config_1.yaml', 'output.txt', 'output2.other', 'subfolder/dont_delete.txt']
+
+        # an unchanged file (by size and modification time) is not copied again
+        mtime = manifest["output.txt"]["mtime"]
+        with outpath.joinpath("output.txt").open("w") as f:
+            f.write(u"xxxxxxxxx\n")
+        os.utime(str(outpath.joinpath("output.txt")), (mtime, mtime))
+        # new and changed files are copied
+        with open(os.path.join(runpath, "new.txt"), "w") as f:
+            f.write("new")
+        with open(os.path.join(runpath, "output2.other"), "w") as f:
+            f.write("changed")
+        # a file with a new modification time, but the same content
+        touched = os.path.join(runpath, "subfolder", "dont_delete.txt")
+        os.utime(touched, (os.stat(touched).st_mtime + 100, os.stat(touched).st_mtime + 100))
+
+        retrieve_outputs(runs, local_path, path, if_exists="sync", ignore_regex=["*.in"],
+                         bulk=bulk, checksum=checksum)
+        with outpath.joinpath("output.txt").open() as f:
+            assert f.read() == "xxxxxxxxx\n"
+        with outpath.joinpath("new.txt").open() as f:
+            assert f.read() == "new"
+        with outpath.joinpath("output2.other").open() as f:
+            assert f.read() == "changed"
+        assert int(outpath.joinpath("subfolder", "dont_delete.txt").stat().st_mtime) == int(os.stat(touched).st_mtime)
+
+        with outpath.joinpath(".atomic_hpc_manifest.json").open() as f:
+            manifest = json.load(f)
+        assert "new.txt" in manifest
+        assert ("sha256" in manifest["subfolder/dont_delete.txt"]) == checksum
+    finally:
+        shutil.rmtree(local_path)
+
+
+@pytest.mark.parametrize("source", ["local_pathlib", "remote"])
+def test_watch_outputs(request, source):
+    runs, path = request.getfixturevalue(source)
+    runs[0]["environment"] = "qsub"
+    run2 = copy.deepcopy(runs[0])
+    run2["id"] = 2
+
+    temppath = mkdtemp()
+    local_path = mkdtemp()
+    try:
+        with JobLedger(os.path.join(temppath, "config.jobs.sqlite")) as ledger:
+            with mock.patch("atomic_hpc.deploy_runs._QSUB_SUBMIT", _mock_qsub_submit.format(temppath)):
+                deploy_runs([runs[0], run2], path, if_exists="abort", exec_errors=True, ledger=ledger)
+
+            # qstat fails on the first poll, then run 1 has finished, and run 2 has expired by the third poll
+            first = os.path.join(temppath, "first.out")
+            with open(first, "w") as f:
+                f.write("Job Id: 1_run_test_name.pbs.server\n    job_state = F\n"
+                        "Job Id: 2_run_test_name.pbs.server\n    job_state = R\n")
+            flag = os.path.join(temppath, "polled")
+            qstat = ('n=$(cat {0} 2>/dev/null | wc -l); echo polled >> {0}; '
+                     'if [ $n -eq 0 ]; then echo "qstat: command not found" >&2; exit 127; '
+                     'elif [ $n -eq 1 ]; then cat {1}; '
+                     'else echo "qstat: Unknown Job Id {{jobids}}" >&2; exit 153; fi').format(flag, first)
+            with mock.patch("atomic_hpc.job_status._QSTAT", qstat):
+                watch_outputs([runs[0], run2], local_path, path, ledger, interval=0.1, max_transfers=2,
+                              ignore_regex=["*.in"])
+            assert [job["state"] for job in ledger.jobs()] == ["finished", "expired"]
+
+        with open(flag) as f:
+            assert len(f.read().splitlines()) == 3
+        for rid in [1, 2]:
+            outpath = os.path.join(local_path, "{}_run_test_name".format(rid))
+            with open(os.path.join(outpath, "output2.other")) as f:
+                assert f.read() == "test value replace frag"
+            assert os.path.exists(os.path.join(outpath, ".atomic_hpc_manifest.json"))
+    finally:
+        shutil.rmtree(temppath)
+        shutil.rmtree(local_path)
+
+
+def test_watch_outputs_error(local_pathlib):
+    """ an error retrieving one run does not stop the others being retrieved """
+    runs, path = local_pathlib
+    run2 = copy.deepcopy(runs[0])
+    run2["id"] = 2
+    retrieved = []
+
+    def retrieve(runs, *args, **kwargs):
+        if runs[0]["id"] == 1:
+            raise ValueError("bad pattern")
+        retrieved.append(runs[0]["id"])
+
+    temppath = mkdtemp()
+    try:
+        with JobLedger(os.path.join(temppath, "config.jobs.sqlite")) as ledger:
+            for run in [runs[0], run2]:
+                ledger.record(run, "{}.pbs".format(run["id"]))
+            qstat = 'printf "Job Id: 1.pbs\\n    job_state = F\\nJob Id: 2.pbs\\n    job_state = F\\n"'
+            with mock.patch("atomic_hpc.job_status._QSTAT", qstat), \
+                    mock.patch("atomic_hpc.deploy_runs.retrieve_outputs", side_effect=retrieve):
+                with pytest.raises(RuntimeError) as err:
+                    watch_outputs([runs[0], run2], temppath, path, ledger, interval=0.1, max_transfers=2)
+    finally:
+        shutil.rmtree(temppath)
+
+    assert "1: run_test_name" in str(err.value)
+    assert retrieved == [2]
@@ -0,0 +1,98 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
+import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from atomic_hpc.job_status import poll_jobs, cancel_jobs
+from atomic_hpc.ledger import JobLedger
+from atomic_hpc.mockssh import mockserver
+
+qstat_output = """Job Id: 10.pbs.server.domain
+    Job_Name = run.qsub
+    job_state = F
+    Exit_status = 0
+
+Job Id: 11.pbs.server.domain
+    Job_Name = run.qsub
+    job_state = {state}
+
+"""
+
+
+@pytest.mark.parametrize("source", ["local", "remote"])
+def test_poll_jobs(source):
+    temppath = mkdtemp()
+    try:
+        with mockserver.Server({"user": {"password": "password"}}, temppath) as server:
+            remote = None
+            if source == "remote":
+                remote = dict(hostname=server.host, port=server.port, username="user", password="password")
+            qstat_path = os.path.join(temppath, "qstat.out")
+
+            with JobLedger(os.path.join(temppath, "config.jobs.sqlite")) as ledger:
+                for rid, jobid in [(1, "10.pbs"), (2, "11.pbs"), (3, "12.pbs")]:
+                    ledger.record({"id": rid, "name": "run", "output": {"path": "output", "remote": remote}}, jobid)
+                # the credentials are not stored in the ledger, so are supplied from the config
+                assert all("password" not in (job["remote"] or {}) for job in ledger.jobs())
+                remotes = {rid: remote for rid in [1, 2, 3]}
+
+                with open(qstat_path, "w") as f:
+                    f.write(qstat_output.format(state="R"))
+                with mock.patch("atomic_hpc.job_status._QSTAT", "cat {}".format(qstat_path)):
+                    jobs = poll_jobs(ledger, local_path=temppath, remotes=remotes)
+                assert [(job["state"], job["exit_status"]) for job in jobs] == [
+                    ("finished", 0), ("running", None), ("unknown", None)]
+
+                # polled states are current within the ttl, and finished states are never polled again
+                with open(qstat_path, "w") as f:
+                    f.write(qstat_output.format(state="E").replace("job_state = F", "job_state = R"))
+                with mock.patch("atomic_hpc.job_status._QSTAT", "cat {}".format(qstat_path)):
+                    jobs = poll_jobs(ledger, local_path=temppath, remotes=remotes)
+                    assert [job["state"] for job in jobs] == ["finished", "running", "unknown"]
+                    jobs = poll_jobs(ledger, run_ids=[1, 2], ttl=0, local_path=temppath, remotes=remotes)
+                    assert [job["state"] for job in jobs] == ["finished", "exiting"]
+
+                # a failed qstat leaves the states unchanged, but unknown jobs have expired
+                with mock.patch("atomic_hpc.job_status._QSTAT", "qstat_not_found {jobids}"):
+                    jobs = poll_jobs(ledger, run_ids=[2, 3], ttl=0, local_path=temppath, remotes=remotes)
+                assert [job["state"] for job in jobs] == ["exiting", "unknown"]
+                with mock.patch("atomic_hpc.job_status._QSTAT", "echo 'qstat: Unknown Job Id 12.pbs' >&2; exit 153"):
+                    jobs = poll_jobs(ledger, run_ids=[2, 3], ttl=0, local_path=temppath, remotes=remotes)
+                assert [job["state"] for job in jobs] == ["exiting", "expired"]
+
+                qdel_path = os.path.join(temppath, "qdel.out")
+                with mock.patch("atomic_hpc.job_status._QDEL", "echo {{jobids}} > {}".format(qdel_path)):
+                    cancelled = cancel_jobs(ledger, local_path=temppath, remotes=remotes)
+                assert [job["run_id"] for job in cancelled] == [2]
+                with open(qdel_path) as f:
+                    assert f.read().split() == ["11.pbs"]
+                assert [job["state"] for job in ledger.jobs()] == ["finished", "cancelled", "expired"]
+    finally:
+        shutil.rmtree(temppath)
+
+
+def test_cancel_jobs_rejected():
+    temppath = mkdtemp()
+    try:
+        with JobLedger(os.path.join(temppath, "config.jobs.sqlite")) as ledger:
+            for rid, jobid in [(1, "10.pbs"), (2, "11.pbs"), (3, "12.pbs")]:
+                ledger.record({"id": rid, "name": "run", "output": {"path": "output", "remote": None}}, jobid)
+
+            # a failed qdel, which reports on no jobs, cancels none
+            with mock.patch("atomic_hpc.job_status._QDEL", "qdel_not_found {jobids}"):
+                assert cancel_jobs(ledger, local_path=temppath) == []
+            assert [job["state"] for job in ledger.jobs()] == [None, None, None]
+
+            # only the jobs qdel accepted are cancelled
+            qdel = "echo 'qdel: Request invalid for state of job 11.pbs.server' >&2; exit 168"
+            with mock.patch("atomic_hpc.job_status._QDEL", qdel):
+                cancelled = cancel_jobs(ledger, local_path=temppath)
+            assert [job["run_id"] for job in cancelled] == [1, 3]
+            assert [job["state"] for job in ledger.jobs()] == ["cancelled", None, "cancelled"]
+    finally:
+        shutil.rmtree(temppath)
@@ -1,8 +1,22 @@
 
+import copy
+import os
+import pickle
+import shutil
+import time
+from tempfile import mkdtemp
+
+import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 from jsonextended import edict, utils
-# from jsonschema import ValidationError
+from jsonschema import ValidationError
+from ruamel.yaml import YAML
 
-from atomic_hpc.config_yaml import format_config_yaml, renumber_config_yaml
+from atomic_hpc.config_yaml import format_config_yaml, iter_config_yaml, renumber_config_yaml
+from atomic_hpc.config_yaml import _global_defaults, _validate_run
 
 example_file_minimal = """
 runs:
@@ -39,7 +53,10 @@ expected_output_minimal = [
                 "email": None,
                 "modules": None,
                 "run": None,
-                "start_in_temp": True
+                "start_in_temp": True,
+                "stage_parallel": 8,
+                "stage_in": {"include": None, "exclude": None},
+                "stage_out": {"include": None, "exclude": None}
             }
         },
         "id": 1,
@@ -136,7 +153,8 @@ expected_output_maximal = [
                 "password": None,
                 "pkey": None,
                 "key_filename": None,
-                "timeout": None
+                "timeout": None,
+                "transfer_streams": 1
             }
         },
         "output": {
@@ -147,7 +165,8 @@ expected_output_maximal = [
                 "password": None,
                 "pkey": None,
                 "key_filename": None,
-                "timeout": None
+                "timeout": None,
+                "transfer_streams": 1
             },
             "path": "path/to/top/level/output",
             "remove": [
@@ -181,6 +200,9 @@ expected_output_maximal = [
                     "mpi"
                 ],
                 "start_in_temp": True,
+                "stage_parallel": 8,
+                "stage_in": {"include": None, "exclude": None},
+                "stage_out": {"include": None, "exclude": None},
                 "run": [
                     "mpiexec pw.x -i script2.in > main.qe.scf.out"
                 ],
@@ -214,7 +236,8 @@ expected_output_maximal = [
                 "password": None,
                 "pkey": None,
                 "key_filename": None,
-                "timeout": None
+                "timeout": None,
+                "transfer_streams": 1
             }
         },
         "output": {
@@ -225,7 +248,8 @@ expected_output_maximal = [
                 "password": None,
                 "pkey": None,
                 "key_filename": None,
-                "timeout": None
+                "timeout": None,
+                "transfer_streams": 1
             },
             "path": "path/to/top/level/output",
             "remove": [
@@ -259,6 +283,9 @@ expected_output_maximal = [
                     "mpi"
                 ],
                 "start_in_temp": True,
+                "stage_parallel": 8,
+                "stage_in": {"include": None, "exclude": None},
+                "stage_out": {"include": None, "exclude": None},
                 "run": [
                     "mpiexec pw.x -i script2.in > main.qe.scf.out"
                 ],
@@ -290,6 +317,238 @@ def test_format_maximal():
     assert edict.diff(output, expected_output_maximal) == {}
 
 
+@pytest.mark.parametrize("content,message", [
+    # an invalid override
+    ("""
+runs:
+  - id: 1
+    name: run1
+  - id: 2
+    name: run2
+    process:
+      qsub:
+        nnodes: two
+""", "error in run #2 config: 'two' is not of type 'integer'"),
+    # invalid defaults, which are not overridden
+    ("""
+defaults:
+  output:
+    path: 1
+runs:
+  - id: 1
+    name: run1
+    output:
+      path: out
+  - id: 2
+    name: run2
+""", "error in run #2 config: 1 is not of type 'string', 'null'"),
+    # an unknown key
+    ("""
+runs:
+  - id: 1
+    name: run1
+    other: value
+""", "error in run #1 config: Additional properties are not allowed ('other' was unexpected)"),
+    # a missing key
+    ("""
+runs:
+  - id: 1
+""", "error in run #1 config: 'name' is a required property"),
+])
+def test_format_invalid(content, message):
+    file_obj = utils.MockPath('config.yml', is_file=True, content=content)
+    with pytest.raises(ValidationError) as err:
+        format_config_yaml(file_obj, errormsg_only=True)
+    assert str(err.value) == message
+
+
+def test_format_cached(monkeypatch):
+    temppath = mkdtemp()
+    try:
+        monkeypatch.setenv("XDG_CACHE_HOME", os.path.join(temppath, "cache"))
+        config_path = os.path.join(temppath, "config.yml")
+        with open(config_path, "w") as f:
+            f.write(example_file_minimal)
+
+        output = format_config_yaml(config_path, cache=True)
+        assert len(os.listdir(os.path.join(temppath, "cache", "atomic_hpc"))) == 1
+        # the cached runs are used, while the file is unchanged
+        with mock.patch("atomic_hpc.config_yaml.YAML", side_effect=AssertionError("config parsed")):
+            assert format_config_yaml(config_path, cache=True) == output
+
+        with open(config_path, "a") as f:
+            f.write("  - id: 2\n    name: run2\n")
+        assert len(format_config_yaml(config_path, cache=True)) == 2
+        # only the latest entry for the file is kept
+        assert len(os.listdir(os.path.join(temppath, "cache", "atomic_hpc"))) == 1
+    finally:
+        shutil.rmtree(temppath)
+
+
+def test_format_cache_pruned(monkeypatch):
+    temppath = mkdtemp()
+    try:
+        monkeypatch.setenv("XDG_CACHE_HOME", os.path.join(temppath, "cache"))
+        cache_dir = os.path.join(temppath, "cache", "atomic_hpc")
+        for name in ["config1.yml", "config2.yml"]:
+            with open(os.path.join(temppath, name), "w") as f:
+                f.write(example_file_minimal)
+        format_config_yaml(os.path.join(temppath, "config1.yml"), cache=True)
+        entries1 = os.listdir(cache_dir)
+        # the same content at a different path has its own entry
+        format_config_yaml(os.path.join(temppath, "config2.yml"), cache=True)
+        entries2 = [name for name in os.listdir(cache_dir) if name not in entries1]
+        assert len(entries1) == len(entries2) == 1
+
+        # entries unused for too long are removed, when another is written
+        old_time = time.time() - 31 * 24 * 60 * 60
+        os.utime(os.path.join(cache_dir, entries2[0]), (old_time, old_time))
+        with open(os.path.join(temppath, "config1.yml"), "a") as f:
+            f.write("  - id: 2\n    name: run2\n")
+        format_config_yaml(os.path.join(temppath, "config1.yml"), cache=True)
+        entries = os.listdir(cache_dir)
+        assert len(entries) == 1 and entries[0] not in entries1 + entries2
+    finally:
+        shutil.rmtree(temppath)
+
+
+def test_iter_cached(monkeypatch):
+    temppath = mkdtemp()
+    try:
+        monkeypatch.setenv("XDG_CACHE_HOME", os.path.join(temppath, "cache"))
+        config_path = os.path.join(temppath, "config.yml")
+        with open(config_path, "w") as f:
+            f.write(example_file_minimal + "  - id: 2\n    name: run2\n")
+
+        # selected runs are formatted lazily, without storing the cache
+        assert [run["id"] for run in iter_config_yaml(config_path, run_ids=[2], cache=True)] == [2]
+        assert not os.path.exists(os.path.join(temppath, "cache", "atomic_hpc"))
+
+        # all runs are also formatted lazily, and only cached once they have all been formatted
+        runs = iter_config_yaml(config_path, cache=True)
+        run = next(runs)
+        assert not os.path.exists(os.path.join(temppath, "cache", "atomic_hpc"))
+        run["created"] = "now"
+        assert [run["id"] for run in runs] == [2]
+        assert len(os.listdir(os.path.join(temppath, "cache", "atomic_hpc"))) == 1
+
+        # then the cache is reused (without the consumer's changes to the runs)
+        with mock.patch("atomic_hpc.config_yaml.YAML", side_effect=AssertionError("config parsed")):
+            output = format_config_yaml(config_path, cache=True)
+            assert [run["id"] for run in output] == [1, 2]
+            assert "created" not in output[0]
+            assert list(iter_config_yaml(config_path, run_ids=[2], cache=True)) == output[1:]
+    finally:
+        shutil.rmtree(temppath)
+
+
+def test_iter_config_yaml():
+    file_obj = utils.MockPath('config.yml', is_file=True, content=example_file_maximal)
+    runs = iter_config_yaml(file_obj)
+    assert list(runs) == format_config_yaml(file_obj)
+
+    # unselected runs are not formatted
+    with mock.patch("atomic_hpc.config_yaml._validate_run", wraps=_validate_run) as validate:
+        runs = list(iter_config_yaml(file_obj, run_ids=[2]))
+    assert [run["id"] for run in runs] == [2]
+    assert validate.call_count == 1
+
+
+def test_run_overlay():
+    file_obj = utils.MockPath('config.yml', is_file=True, content=example_file_maximal)
+    run1, run2 = format_config_yaml(file_obj)
+
+    # the runs are equal to the merge of the defaults and the run config
+    dct = YAML().load(example_file_maximal)
+    defaults = edict.merge([_global_defaults, dct["defaults"]], overwrite=True)
+    expected = edict.merge([defaults, dct["runs"][0]], overwrite=True)
+    assert edict.diff(run1.to_dict(), expected) == {}
+
+    # the defaults are shared, but not mutated by changes to a run
+    run1["process"]["qsub"]["cores_per_node"] = 2
+    run1["process"]["qsub"]["modules"].append("intel")
+    del run1["output"]["remote"]
+    assert run2["process"]["qsub"]["cores_per_node"] == 16
+    assert run2["process"]["qsub"]["modules"] == ["quantum-espresso", "intel-suite", "mpi"]
+    assert "remote" in run2["output"]
+
+    for copied in [copy.deepcopy(run1), pickle.loads(pickle.dumps(run1, pickle.HIGHEST_PROTOCOL))]:
+        assert copied == run1
+        assert "remote" not in copied["output"]
+
+
+example_file_sweep = """
+defaults:
+    input:
+        variables:
+            var1: value
+    process:
+        unix:
+            run:
+                - echo @v{var1} @v{var2} @v{var3}
+
+runs:
+  - id: 2
+    name: run2
+
+sweep:
+  - name: run_@v{var2}_@v{var3}
+    variables:
+        var2: [1, 2]
+        var3: [a, b, c]
+  - mode: zip
+    variables:
+        var2: [1, 2]
+        var3: [a, b]
+    run:
+        input:
+            variables:
+                var1: other
+"""
+
+
+def test_format_sweep():
+    file_obj = utils.MockPath('config.yml', is_file=True, content=example_file_sweep)
+    runs = format_config_yaml(file_obj)
+
+    assert [(run["id"], run["name"]) for run in runs] == [
+        (2, "run2"),
+        (3, "run_1_a"), (4, "run_1_b"), (5, "run_1_c"), (6, "run_2_a"), (7, "run_2_b"), (8, "run_2_c"),
+        (9, "sweep_1"), (10, "sweep_2")]
+    assert runs[1]["input"]["variables"].to_dict() == {"var1": "value", "var2": 1, "var3": "a"}
+    assert runs[8]["input"]["variables"].to_dict() == {"var1": "other", "var2": 2, "var3": "b"}
+    assert runs[8]["process"]["unix"]["run"] == ["echo @v{var1} @v{var2} @v{var3}"]
+
+    runs = list(iter_config_yaml(file_obj, run_ids=[2, 7, 9]))
+    assert [(run["id"], run["name"]) for run in runs] == [(2, "run2"), (7, "run_2_b"), (9, "sweep_1")]
+
+
+def test_format_sweep_start_id():
+    content = example_file_sweep.replace("  - mode: zip\n", "  - mode: zip\n    start_id: 100\n")
+    # adding a run does not renumber a sweep with an explicit start_id
+    content = content.replace("\nsweep:", "  - id: 3\n    name: run3\n\nsweep:").replace(
+        "  - name: run_@v", "  - start_id: 10\n    name: run_@v")
+    file_obj = utils.MockPath('config.yml', is_file=True, content=content)
+    runs = format_config_yaml(file_obj)
+    assert [run["id"] for run in runs] == [2, 3, 10, 11, 12, 13, 14, 15, 100, 101]
+
+
+@pytest.mark.parametrize("content,message", [
+    ("sweep:\n  - mode: zip\n    variables:\n      a: [1, 2]\n      b: [1]\n", "different lengths"),
+    ("sweep:\n  - name: run_@v{b}\n    variables:\n      a: [1, 2]\n", "unknown variables"),
+    ("sweep:\n  - variables:\n      a: []\n", "error in top-level config"),
+    ("runs:\n  - id: 3\n    name: run3\nsweep:\n  - start_id: 2\n    variables:\n      a: [1, 2]\n",
+     "the ids of sweep #1 (2 to 3) clash with: [3]"),
+    ("sweep:\n  - variables:\n      a: [1, 2]\n  - start_id: 2\n    variables:\n      a: [1, 2]\n",
+     "the ids of sweep #2 (2 to 3) clash with: ['sweep #1']"),
+])
+def test_format_sweep_invalid(content, message):
+    file_obj = utils.MockPath('config.yml', is_file=True, content=content)
+    with pytest.raises(ValidationError) as err:
+        list(iter_config_yaml(file_obj))
+    assert message in str(err.value)
+
+
 def test_renumber_config_yaml():
     example_file = """
     # a comment
@@ -1,4 +1,5 @@
-from atomic_hpc.utils import walk_path, glob_path, splitall, fnmatch_path
+import stat
+from atomic_hpc.utils import walk_path, walk_path_attr, glob_path, splitall, fnmatch_path
 import pytest
 
 
@@ -32,6 +33,27 @@ def dummy_walk_path(path):
     return walk_path(path, dummy_listdir, dummy_isfile, dummy_isfolder)
 
 
+class DummyAttr(object):
+    def __init__(self, filename, st_mode):
+        self.filename = filename
+        self.st_mode = st_mode
+
+
+def dummy_listdir_attr(path):
+    attrs = []
+    for name in dummy_listdir(path):
+        if dummy_isfile(name):
+            attrs.append(DummyAttr(name, stat.S_IFREG))
+        else:
+            attrs.append(DummyAttr(name, stat.S_IFDIR))
+    return attrs
+
+
+def dummy_walk_path_attr(path):
+    for root, dirattrs, fileattrs in walk_path_attr(path, dummy_listdir_attr):
+        yield root, [a.filename for a in dirattrs], [a.filename for a in fileattrs]
+
+
 def test_splitall():
     assert splitall('a/b/c') == ['a', 'b', 'c']
 
@@ -65,3 +87,45 @@ def test_glob_path():
     assert list(glob_path("", "*/*", dummy_walk_path)) == ['a/c', 'a/d']
     assert list(glob_path("", "a/**/c", dummy_walk_path)) == ['a/c', 'a/d/c']
     assert list(glob_path("", "a/d/**/*", dummy_walk_path)) == ['a/d/c', 'a/d/e', 'a/d/e/f']
+
+
+def test_walk_path_attr():
+    assert list(dummy_walk_path_attr("")) == list(dummy_walk_path(""))
+    assert list(glob_path("", "a/**/*", dummy_walk_path_attr)) == ['a/c', 'a/d', 'a/d/c', 'a/d/e', 'a/d/e/f']
+
+
+def test_walk_path_attr_links():
+
+    def listdir_attr(path):
+        if not path:
+            return [DummyAttr("link", stat.S_IFLNK), DummyAttr("broken", stat.S_IFLNK)]
+        return [DummyAttr("file", stat.S_IFREG)]
+
+    def link_stat(path):
+        if path.endswith("broken"):
+            raise IOError("no such file")
+        return DummyAttr(None, stat.S_IFDIR)
+
+    out = [(root, [a.filename for a in dattrs], [a.filename for a in fattrs])
+           for root, dattrs, fattrs in walk_path_attr("", listdir_attr, link_stat)]
+    assert out == [("", ["link"], [])]
+
+    out = [(root, [a.filename for a in dattrs], [a.filename for a in fattrs])
+           for root, dattrs, fattrs in walk_path_attr("", listdir_attr, link_stat,
+                                                      followlinks=True, realpath=lambda p: "/real/" + p)]
+    assert out == [("", ["link"], []), ("link", [], ["file"])]
+
+
+def test_walk_path_attr_link_cycle():
+
+    def listdir_attr(path):
+        # a/loop -> a
+        return [DummyAttr("loop" if path else "a", stat.S_IFLNK if path else stat.S_IFDIR)]
+
+    def link_stat(path):
+        return DummyAttr(None, stat.S_IFDIR)
+
+    realpaths = {"": "/real", "a/loop": "/real/a"}
+    out = [root for root, _, _ in walk_path_attr("", listdir_attr, link_stat,
+                                                 followlinks=True, realpath=realpaths.get)]
+    assert out == ["", "a"]
@@ -1,6 +1,7 @@
 import logging
 import os
 from fnmatch import fnmatch
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 import sys
 
 try:
@@ -12,6 +13,8 @@ try:
 except ImportError:
     from distutils import strtobool
 
+logger = logging.getLogger(__name__)
+
 
 def splitall(path):
     """ split a path into a list of its components
@@ -167,6 +170,91 @@ def walk_path(path, listdir=os.listdir,
             yield newpath, dirnames, filenames
 
 
+def walk_path_attr(path, listdir_attr, stat=None, maxdepth=None, followlinks=False, realpath=None):
+    """ walk a directory tree, retrieving the names and attributes of each directory's contents in one call
+
+    Parameters
+    ----------
+    path: str
+    listdir_attr: func
+        return list of attribute objects for the subpaths of `path`, without following symbolic links,
+        each with `filename` and `st_mode` attributes (e.g. paramiko.SFTPClient.listdir_attr)
+    stat: func or None
+        return the attributes of a path, following symbolic links.
+        If not None, this is only called for subpaths which are symbolic links,
+        and they are listed as the file or directory they link to (otherwise they are ignored)
+    maxdepth: int or None
+        the maximum number of directory levels to list (None for no limit)
+    followlinks: bool
+        if True, walk into symbolic links to directories (otherwise they are listed, but not walked into)
+    realpath: func or None
+        return the canonical path of a path (resolving symbolic links), required if followlinks,
+        so that links to a directory which is already being walked (i.e. cycles) are not walked into
+
+    Yields
+    -------
+    dirpath: str
+    dirattrs: list
+        attributes of the sub-directories in dirpath
+    fileattrs: list
+        attributes of the (regular) files in dirpath
+
+    """
+    if followlinks and (stat is None or realpath is None):
+        raise ValueError("following symbolic links requires both stat and realpath")
+    ancestors = [realpath(path)] if followlinks else None
+    for dirpath, dirattrs, fileattrs in _walk_path_attr(path, listdir_attr, stat, maxdepth, realpath, ancestors):
+        yield dirpath, dirattrs, fileattrs
+
+
+def _walk_path_attr(path, listdir_attr, stat, maxdepth, realpath, ancestors):
+    """ see walk_path_attr, ancestors is None (not following links) or the real paths of path and its parents """
+    dirattrs = []
+    fileattrs = []
+    # (path, real path) of the sub-directories to walk
+    subdirs = []
+
+    for attr in listdir_attr(path):
+        islink = attr.st_mode is not None and S_ISLNK(attr.st_mode)
+        if islink and stat is not None:
+            try:
+                link_attr = stat(os.path.join(path, attr.filename))
+            except IOError:
+                # broken link
+                continue
+            link_attr.filename = attr.filename
+            attr = link_attr
+        if attr.st_mode is None:
+            continue
+        if S_ISREG(attr.st_mode):
+            fileattrs.append(attr)
+        elif S_ISDIR(attr.st_mode):
+            dirattrs.append(attr)
+            subpath = os.path.join(path, attr.filename)
+            if ancestors is None:
+                if not islink:
+                    subdirs.append((subpath, None))
+                continue
+            real = realpath(subpath) if islink else os.path.join(ancestors[-1], attr.filename)
+            if real in ancestors:
+                logger.warning("not walking into symbolic link cycle: {}".format(subpath))
+                continue
+            subdirs.append((subpath, real))
+
+    yield path, dirattrs, fileattrs
+
+    if maxdepth is not None:
+        if maxdepth <= 1:
+            return
+        maxdepth -= 1
+
+    for subpath, real in subdirs:
+        subancestors = None if ancestors is None else ancestors + [real]
+        for newpath, subdirattrs, subfileattrs in _walk_path_attr(
+                subpath, listdir_attr, stat, maxdepth, realpath, subancestors):
+            yield newpath, subdirattrs, subfileattrs
+
+
 def add_loglevel(name, levelnum, methodname=None):
     """
     Comprehensively adds a new logging level to the `logging` module and the
@@ -63,7 +63,8 @@ with io.open('README.md') as readme:
         entry_points={
             'console_scripts': [
                 'run_config = atomic_hpc.frontend.run_config:main',
-                'retrieve_config = atomic_hpc.frontend.retrieve_config:main'
+                'retrieve_config = atomic_hpc.frontend.retrieve_config:main',
+                'status_config = atomic_hpc.frontend.status_config:main'
             ]
         }
     )